@@ -1,4 +1,6 @@
 from django.contrib.auth.backends import ModelBackend
+from django.core.exceptions import PermissionDenied
+
 from accounts.models import Customer
 
 
@@ -6,25 +8,28 @@ class UserAuthBackend(ModelBackend):
 
     def authenticate(self, request, email=None, password=None, **kwargs):
 
-        if Customer.objects.filter(email=email).exists():
+        if email is None or password is None:
+            # Not an email login (e.g. the admin form), leave it to the next backends
+            return None
 
+        try:
+            # Single fetch through the unique index on email
             user = Customer.objects.get(email=email)
+        except Customer.DoesNotExist:
+            # Hash anyway so unknown emails take as long as wrong passwords (no user enumeration by timing)
+            Customer().set_password(password)
+            raise PermissionDenied
 
-            if user.password:
-                if user.check_password(password):
-
-                    return user
-                else:
-                    return None
-            else:
+        if user.password and user.check_password(password):
+            return user
 
-                return None
-        else:
-            return None
+        # Stop here instead of letting ModelBackend fetch and hash the same user again
+        raise PermissionDenied
 
     def get_user(self, user_id):
+        # AuthenticationMiddleware memoizes the result on the request. Nothing is kept across requests,
+        # so deactivations and password changes apply at once in every worker
         try:
             return Customer.objects.get(pk=user_id)
         except Customer.DoesNotExist:
-
-            return None
\ No newline at end of file
+            return None
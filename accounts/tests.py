@@ -1,3 +1,36 @@
+from django.core.exceptions import PermissionDenied
 from django.test import TestCase
 
-# Create your tests here.
+from accounts.AuthBackend import UserAuthBackend
+from accounts.models import Customer
+
+
+class UserAuthBackendTests(TestCase):
+
+    def setUp(self):
+        self.backend = UserAuthBackend()
+        self.customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.customer.set_password("s3cret-pass")
+        self.customer.save()
+
+    def test_authenticate(self):
+        self.assertEqual(self.backend.authenticate(None, email="rider@example.com", password="s3cret-pass"),
+                         self.customer)
+        with self.assertRaises(PermissionDenied):
+            self.backend.authenticate(None, email="rider@example.com", password="wrong")
+        with self.assertRaises(PermissionDenied):
+            self.backend.authenticate(None, email="nobody@example.com", password="s3cret-pass")
+        # Other login forms are left to the next backends
+        self.assertIsNone(self.backend.authenticate(None, username="admin", password="x"))
+
+    def test_get_user_reads_current_state(self):
+        self.assertTrue(self.backend.get_user(self.customer.pk).is_active)
+
+        # Changed behind the ORM's back (another worker, a bulk update...): seen by the next request
+        Customer.objects.filter(pk=self.customer.pk).update(is_active=False, is_blocked=True)
+        user = self.backend.get_user(self.customer.pk)
+        self.assertFalse(user.is_active)
+        self.assertTrue(user.is_blocked)
+
+        self.customer.delete()
+        self.assertIsNone(self.backend.get_user(self.customer.pk))
@@ -0,0 +1,229 @@
+import csv
+import datetime
+import io
+import posixpath
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from openpyxl.utils import get_column_letter
+from openpyxl.workbook import Workbook
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from sefservices import settings as env_variable
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except the last one
+CONTENT_TYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+}
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Write-only file object streaming into an S3 multipart upload.
+
+    Bytes are buffered until a part is full, so memory stays around ``part_size``
+    whatever the size of the file. ``close()`` completes the upload, ``abort()``
+    discards it; used as a context manager, an exception aborts it.
+    """
+
+    def __init__(self, client, bucket, key, content_type=None, part_size=None):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size or env_variable.EXPORT_PART_SIZE, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._parts = []
+        self._position = 0
+        extra = {'ContentType': content_type} if content_type else {}
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **extra)['UploadId']
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        # Zip writers need the position, seeking stays unsupported
+        return self._position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        number = len(self._parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body,
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._parts:
+                self._upload_part(bytes(self._buffer))
+                self._buffer.clear()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self._parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        self._buffer.clear()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+@contextmanager
+def storage_writer(path, content_type=None, storage=None):
+    """
+    Yields a binary stream whose content ends up at ``path`` on the storage.
+
+    S3 storages (MinIO) get a direct multipart upload. Other backends, such as the local
+    file system in development, get a spooled buffer saved on exit.
+    """
+
+    storage = storage or default_storage
+    if isinstance(storage, S3Boto3Storage):
+        key = posixpath.join(storage.location, path) if storage.location else path
+        with MultipartUploadWriter(storage.connection.meta.client, storage.bucket_name, key, content_type) as stream:
+            yield stream
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=env_variable.EXPORT_PART_SIZE) as stream:
+        yield stream
+        stream.seek(0)
+        storage.save(path, File(stream, name=posixpath.basename(path)))
+
+
+def cell_value(value):
+    # Spreadsheets have no time zones: aware datetimes are written in the local time of the site
+    if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
+def column_widths(headers, sample):
+    widths = [len(str(header)) for header in headers]
+    for row in sample:
+        for index, value in enumerate(row[:len(widths)]):
+            if value is not None:
+                widths[index] = max(widths[index], len(str(value)))
+    return [min(width + 2, env_variable.EXPORT_MAX_COLUMN_WIDTH) for width in widths]
+
+
+def write_xlsx(stream, headers, rows, title=None):
+    """
+    Writes a single sheet workbook in openpyxl's write-only mode.
+
+    Rows are serialised as they come instead of being kept as cells, and the column
+    widths are estimated from the first EXPORT_WIDTH_SAMPLE_ROWS rows. Write-only mode
+    still spools each worksheet to a local temporary file until ``save()`` zips it into
+    ``stream``, so the worker needs disk space for the uncompressed sheet.
+    """
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=title)
+    rows = iter(rows)
+    sample = [[cell_value(value) for value in row] for row in islice(rows, env_variable.EXPORT_WIDTH_SAMPLE_ROWS)]
+    for index, width in enumerate(column_widths(headers, sample), start=1):
+        sheet.column_dimensions[get_column_letter(index)].width = width
+
+    sheet.append(headers)
+    for row in sample:
+        sheet.append(row)
+    for row in rows:
+        sheet.append([cell_value(value) for value in row])
+    workbook.save(stream)
+
+
+def write_csv(stream, headers, rows):
+    # utf-8-sig so Excel detects the encoding when the file is opened directly
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(headers)
+    writer.writerows([cell_value(value) for value in row] for row in rows)
+    text.flush()
+    text.detach()
+
+
+def queryset_rows(queryset, row=None, chunk_size=None):
+    """ Yields ``row(obj)`` for every object, fetched in chunks (server-side cursor on PostgreSQL) """
+
+    for obj in queryset.iterator(chunk_size=chunk_size or env_variable.EXPORT_CHUNK_SIZE):
+        yield row(obj) if row is not None else obj
+
+
+def export_rows(path, headers, rows, file_format='xlsx', title=None):
+    """
+    Streams ``rows`` as an XLSX or CSV file to ``path`` under EXPORT_LOCATION on the media storage.
+
+    Returns a report with the stored path, its URL and the number of rows written.
+    """
+
+    if file_format not in CONTENT_TYPES:
+        raise ValueError(f"Unsupported export format: {file_format}")
+
+    path = posixpath.join(env_variable.EXPORT_LOCATION, f"{path}.{file_format}")
+    report = {'path': path, 'rows': 0}
+
+    def counted(rows):
+        for row in rows:
+            report['rows'] += 1
+            yield row
+
+    with storage_writer(path, CONTENT_TYPES[file_format]) as stream:
+        if file_format == 'xlsx':
+            write_xlsx(stream, headers, counted(rows), title=title)
+        else:
+            write_csv(stream, headers, counted(rows))
+
+    try:
+        report['url'] = default_storage.url(path)
+    except NotImplementedError:
+        report['url'] = None
+    return report
+
+
+def export_name(prefix):
+    return f"{prefix}_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}"
+
+
+def export_queryset(name, columns, queryset, file_format='xlsx', title=None):
+    """ Exports ``queryset`` with ``columns`` as (header, field lookup) pairs, read as chunked tuples """
+
+    started = time.monotonic()
+    report = export_rows(
+        export_name(name),
+        [header for header, _ in columns],
+        queryset_rows(queryset.values_list(*[field for _, field in columns])),
+        file_format=file_format,
+        title=title,
+    )
+    report['seconds'] = round(time.monotonic() - started, 2)
+    return report
@@ -5,6 +5,7 @@ from django.forms.models import ModelChoiceIteratorValue
 from django_countries.widgets import CountrySelectWidget
 
 from accounts.models import Customer
+from coreservice.helpers import is_disposable
 from coreservice.models import *
 from django.utils.translation import gettext_lazy as _
 
@@ -77,6 +78,12 @@ class RegistrationForm(ChangeInputsStyle):
             "password": forms.PasswordInput(attrs={"placeholder": _("Password")}),
         }
 
+    def clean_email(self):
+        email = self.cleaned_data['email']
+        if is_disposable(email):
+            raise forms.ValidationError(_("Disposable email addresses are not allowed."))
+        return email
+
 
 class AdminNewPasswordForm(SingleStyle):
     email = forms.EmailField(label="Email", widget=forms.EmailInput(attrs={'readonly': True}))
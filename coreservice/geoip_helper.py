@@ -0,0 +1,179 @@
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import lru_cache
+
+from sefservices import settings as env_variable
+
+logger = logging.getLogger(__name__)
+
+# Database layout (all integers little-endian except the IP bounds):
+#   header   : magic (8 bytes), record count (uint32), strings offset (uint32)
+#   records  : start ip (16 bytes big-endian), end ip (16 bytes big-endian), country (2 bytes), city offset (uint32)
+#   strings  : city names, each as a uint16 length followed by the utf-8 bytes
+# IPv4 addresses are stored IPv4-mapped (::ffff:a.b.c.d) so both families share one sorted table,
+# and big-endian bounds compare correctly as raw bytes during the binary search.
+GEOIP_MAGIC = b"SEFGEO01"
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<16s16s2sI")
+CITY_LENGTH = struct.Struct("<H")
+IPV4_MAPPED = 0xFFFF << 32
+
+
+def ip_to_key(ip):
+    address = ipaddress.ip_address(str(ip).strip())
+    value = int(address)
+    if address.version == 4:
+        value |= IPV4_MAPPED
+    elif address.ipv4_mapped is not None:
+        value = int(address.ipv4_mapped) | IPV4_MAPPED
+    return value.to_bytes(16, "big")
+
+
+def write_geoip_database(ranges, file_path):
+    """
+    Writes (start_ip, end_ip, country_code, city) ranges to ``file_path``.
+
+    The file is written next to the target and atomically swapped in, so workers
+    that still have the previous version mapped keep reading a consistent file.
+    Overlapping ranges are dropped (the first one wins). Returns the number of ranges written.
+    """
+
+    records = sorted(
+        (ip_to_key(start), ip_to_key(end), (country or "").upper()[:2], city or "")
+        for start, end, country, city in ranges
+    )
+
+    strings, city_offsets = bytearray(), {"": 0}
+    strings += CITY_LENGTH.pack(0)
+    packed, last_end = [], None
+    for start, end, country, city in records:
+        if start > end or (last_end is not None and start <= last_end):
+            continue
+        if city not in city_offsets:
+            encoded = city.encode("utf-8")[:0xFFFF]
+            city_offsets[city] = len(strings)
+            strings += CITY_LENGTH.pack(len(encoded)) + encoded
+        packed.append(RECORD.pack(start, end, country.encode("ascii", "ignore").ljust(2), city_offsets[city]))
+        last_end = end
+
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as database:
+        database.write(HEADER.pack(GEOIP_MAGIC, len(packed), HEADER.size + len(packed) * RECORD.size))
+        database.writelines(packed)
+        database.write(strings)
+    os.replace(tmp_path, file_path)
+
+    return len(packed)
+
+
+class GeoIPDatabase:
+    """
+    Read-only, memory-mapped IP range database with a binary search lookup.
+
+    The file is shared through the page cache by every worker, recent answers are
+    kept in an LRU, and a new file dropped in place is picked up automatically.
+    """
+
+    def __init__(self, file_path, cache_size=4096, reload_interval=60):
+        self.file_path = file_path
+        self.reload_interval = reload_interval
+        self._map = None
+        self._count = 0
+        self._strings_offset = 0
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    @property
+    def available(self):
+        self._refresh()
+        return self._map is not None
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at and now - self._checked_at < self.reload_interval:
+            return
+
+        with self._lock:
+            if self._checked_at and now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.file_path).st_mtime
+            except FileNotFoundError:
+                return
+            if mtime == self._mtime:
+                return
+
+            try:
+                mapped, count, strings_offset = self._open()
+            except (OSError, ValueError, struct.error) as error:
+                # A bad download must not break requests: keep serving the previous file, if any,
+                # and only look at this one again once it is replaced
+                self._mtime = mtime
+                logger.error("GeoIP database %s not loaded: %s", self.file_path, error)
+                return
+
+            # The previous map is left to the garbage collector, a lookup may still be reading it
+            self._map, self._count, self._strings_offset, self._mtime = mapped, count, strings_offset, mtime
+            self.lookup.cache_clear()
+
+    def _open(self):
+        with open(self.file_path, "rb") as database:
+            mapped = mmap.mmap(database.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, count, strings_offset = HEADER.unpack_from(mapped, 0)
+            if magic != GEOIP_MAGIC:
+                raise ValueError("not a GeoIP database")
+            if strings_offset != HEADER.size + count * RECORD.size or strings_offset + CITY_LENGTH.size > len(mapped):
+                raise ValueError("truncated file")
+        except (ValueError, struct.error):
+            mapped.close()
+            raise
+        return mapped, count, strings_offset
+
+    def _lookup(self, ip):
+        """ Returns (country_code, city) for ``ip``, or None when it is not covered """
+
+        try:
+            key = ip_to_key(ip)
+        except ValueError:
+            return None
+
+        mapped, count = self._map, self._count
+        # Last record whose start is <= key
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            if mapped[offset:offset + 16] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+
+        start, end, country, city_offset = RECORD.unpack_from(mapped, HEADER.size + (low - 1) * RECORD.size)
+        if key > end:
+            return None
+
+        city_position = self._strings_offset + city_offset
+        (length,) = CITY_LENGTH.unpack_from(mapped, city_position)
+        city_position += CITY_LENGTH.size
+        return country.decode("ascii").strip(), mapped[city_position:city_position + length].decode("utf-8")
+
+    def locate(self, ip):
+        self._refresh()
+        if self._map is None:
+            return None
+        return self.lookup(ip)
+
+
+geoip_database = GeoIPDatabase(env_variable.GEOIP_DATABASE_PATH)
@@ -1,24 +1,42 @@
+import logging
 import os
-import requests as makeRequest
+import threading
+import time
+
 import stripe
+from asgiref.sync import sync_to_async
 from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from stripe.api_resources import setup_intent
 
 from accounts.models import PaymentMethod as UserPaymentMethod, PaymentMethod
+from coreservice.geoip_helper import geoip_database
+from coreservice.http_helper import outbound
 from sefservices import settings as env_variable
 
+logger = logging.getLogger(__name__)
+
 
 def get_client_location(user_ip=None):
+    # Local memory-mapped database first, the remote lookup only when none has been imported
+    if geoip_database.available:
+        location = geoip_database.locate(user_ip)
+        country, city = location if location else ("", "")
+        return {
+            'country': country,
+            'ip': user_ip,
+            'city': city,
+        }
+
     url = f"https://api.seeip.org/geoip/{user_ip}"
-    response = makeRequest.get(url, verify=False).json()
+    response = outbound.get(url).json()
     data = {
         'country': response['country'],
 
         'ip': response['ip'],
     }
-    if "city" in data:
+    if "city" in response:
         data['city'] = response['city']
     else:
         data['city'] = ""
@@ -26,49 +44,113 @@ def get_client_location(user_ip=None):
     return data
 
 
+class DisposableDomainIndex:
+    """
+    Disposable email domains loaded once per process into a frozenset.
+
+    The source file is re-read when its modification time changes (checked at most
+    every ``reload_interval`` seconds), and subdomains match their listed parent domain.
+    """
+
+    def __init__(self, file_path, reload_interval=60):
+        self.file_path = file_path
+        self.reload_interval = reload_interval
+        self.domains = frozenset()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with open(self.file_path, 'r', encoding='utf-8') as disposable_mails:
+            return frozenset(
+                line.strip().lower() for line in disposable_mails if line.strip() and not line.startswith('#')
+            )
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self.reload_interval:
+            return
+
+        with self._lock:
+            if self._mtime is not None and now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            mtime = os.stat(self.file_path).st_mtime
+            if mtime != self._mtime:
+                self.domains = self._load()
+                self._mtime = mtime
+
+    def __contains__(self, domain):
+        self._refresh()
+        domain = str(domain).strip().lower().rstrip('.')
+        domains = self.domains
+        # mail.foo.disposable.com -> foo.disposable.com -> disposable.com
+        while domain:
+            if domain in domains:
+                return True
+            _, _, domain = domain.partition('.')
+        return False
+
+
+disposable_domains = DisposableDomainIndex(os.path.join(os.path.dirname(__file__), 'disposable.txt'))
+
+
 def is_disposable(email):
     email = email[str(email).find('@') + 1:]
-    emails = []
-    module_dir = os.path.dirname(__file__)
-    file_path = os.path.join(module_dir, 'disposable.txt')
-    disposable_mails = open(file_path, 'r+')
-    for disposable_mail in disposable_mails:
-        emails.append(disposable_mail.rstrip())
-
-    if str(email) in emails:
+
+    if str(email) in disposable_domains:
         return True
     else:
         return False
 
 
+def configure_stripe():
+    """ API key, request timeout and network retries of the Stripe library """
+
+    stripe.api_key = env_variable.STRIPE_API_KEY
+    stripe.max_network_retries = env_variable.STRIPE_MAX_NETWORK_RETRIES
+    if not isinstance(stripe.default_http_client, stripe.RequestsClient):
+        stripe.default_http_client = stripe.RequestsClient(timeout=env_variable.STRIPE_REQUEST_TIMEOUT)
+
+
 class StripeManager:
 
     def __init__(self):
         self.api_key = env_variable.STRIPE_API_KEY
-        stripe.api_key = self.api_key
+        configure_stripe()
 
-    def create_stripe_customer(self, user):
+    def resolve_stripe_customer(self, user):
+        """ Returns the Stripe customer id of ``user``, creating the customer on first use only """
+
+        if user.stripe_customer_id:
+            return user.stripe_customer_id
 
         search = stripe.Customer.search(
             query="email:"'\'' + user.email + "\'",
+            limit=1,
         )
 
         if len(search.data) == 0:
 
+            # Same key for concurrent first uses: Stripe replays the first creation instead of duplicating it
             customer = stripe.Customer.create(
                 name=f"{user.first_name} {user.last_name}",
                 email=user.email,
                 address={"country": user.country},
+                metadata={"customer_id": user.pk},
+                idempotency_key=f"customer-create-{user.pk}",
             )
-            user.stripe_customer_id = customer["id"]
-            user.save()
-            return user.stripe_customer_id
+            customer_id = customer["id"]
         else:
             customer_id = search.data[0]["id"]
-            user.stripe_customer_id = customer_id
-            user.save()
 
-            return user.stripe_customer_id
+        user.stripe_customer_id = customer_id
+        user.save(update_fields=["stripe_customer_id"])
+
+        return user.stripe_customer_id
+
+    # Kept for existing callers
+    create_stripe_customer = resolve_stripe_customer
 
     def create_card_intent(self, user):
 
@@ -79,34 +161,88 @@ class StripeManager:
 
         return setup_intent
 
-    def add_payment_method(self, user, payment_method_id, make_default=False):
-
-        stripe.PaymentMethod.attach(
-            payment_method_id,
-            customer=user.stripe_customer_id,
-        )
-
-        pm = stripe.Customer.retrieve_payment_method(f"{user.stripe_customer_id}", f"{payment_method_id}")
-        card = pm['card']
+    def save_payment_method(self, user, payment_method_id, card, make_default=False):
 
         with transaction.atomic():
-            new_pm = UserPaymentMethod.objects.create(
+            # The payment_method.attached webhook may have recorded the card already
+            new_pm, _ = UserPaymentMethod.objects.update_or_create(
                 user=user,
                 payment_method_id=payment_method_id,
-                brand=card['brand'],
-                last4=card['last4'],
-                exp_month=card['exp_month'],
-                exp_year=card['exp_year'],
-                is_default=make_default,
+                defaults={
+                    'brand': card['brand'],
+                    'last4': card['last4'],
+                    'exp_month': card['exp_month'],
+                    'exp_year': card['exp_year'],
+                    'is_default': make_default,
+                },
             )
 
+        return new_pm
+
+    def add_payment_method(self, user, payment_method_id, make_default=False):
+
+        # The attach response already holds the card details, no need to retrieve it again
+        pm = stripe.PaymentMethod.attach(
+            payment_method_id,
+            customer=user.stripe_customer_id,
+        )
+
+        try:
+            new_pm = self.save_payment_method(user, payment_method_id, pm['card'], make_default)
             if make_default:
                 stripe.Customer.modify(
                     user.stripe_customer_id,
                     invoice_settings={"default_payment_method": payment_method_id}
                 )
-                new_pm.is_default = True
-                new_pm.save()
+        except Exception:
+            self.rollback_payment_method(user, payment_method_id)
+            raise
+
+        return new_pm
+
+    def rollback_payment_method(self, user, payment_method_id):
+        """ Undoes an attach whose following steps failed, so Stripe and the local cards stay in step """
+
+        PaymentMethod.objects.filter(user=user, payment_method_id=payment_method_id).delete()
+        try:
+            stripe.PaymentMethod.detach(payment_method_id)
+        except stripe.error.StripeError:
+            logger.exception("Could not detach payment method %s after a failed add", payment_method_id)
+
+    # Async variants for the async card views. Each Stripe request runs in a thread, bounded by the
+    # client timeout set in configure_stripe(): nothing is abandoned half-way while it still runs.
+
+    async def _call_stripe(self, func, *args, **kwargs):
+        return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+    async def acreate_card_intent(self, user):
+
+        if not user.stripe_customer_id:
+            await sync_to_async(self.resolve_stripe_customer)(user)
+
+        return await self._call_stripe(
+            stripe.SetupIntent.create,
+            customer=user.stripe_customer_id,
+            payment_method_types=["card"],
+        )
+
+    async def aadd_payment_method(self, user, payment_method_id, make_default=False):
+
+        pm = await self._call_stripe(stripe.PaymentMethod.attach, payment_method_id, customer=user.stripe_customer_id)
+
+        try:
+            new_pm = await sync_to_async(self.save_payment_method)(user, payment_method_id, pm['card'], make_default)
+            if make_default:
+                await self._call_stripe(
+                    stripe.Customer.modify,
+                    user.stripe_customer_id,
+                    invoice_settings={"default_payment_method": payment_method_id},
+                )
+        except Exception:
+            await sync_to_async(self.rollback_payment_method)(user, payment_method_id)
+            raise
+
+        return new_pm
 
     def remove_payment_method(self, user, payment_method_id):
 
@@ -124,7 +260,7 @@ class StripeManager:
 
         payment_method = get_object_or_404(PaymentMethod, payment_method_id=payment_method_id, user=user)
         payment_method.is_default = True
-        payment_method.save()
+        payment_method.save(update_fields=["is_default"])
 
         stripe.Customer.modify(
             user.stripe_customer_id,
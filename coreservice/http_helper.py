@@ -0,0 +1,203 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests as makeRequests
+from requests.adapters import HTTPAdapter
+
+from sefservices import settings as env_variable
+
+# Latency histogram upper bounds, in milliseconds (the last bucket is unbounded)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+class CircuitOpenError(makeRequests.ConnectionError):
+    """ Raised without touching the network while a host's circuit breaker is open """
+
+
+class HostStats:
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.short_circuited = 0
+        self.total_ms = 0.0
+
+    def observe(self, elapsed_ms):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        labels = [f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS] + ["le_inf"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "short_circuited": self.short_circuited,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "histogram": dict(zip(labels, self.buckets)),
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after ``threshold`` consecutive failures and rejects calls for ``cooldown``
+    seconds, then lets a single trial call through (half-open) to decide whether to close.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class OutboundClient:
+    """
+    Shared client for every third-party HTTP call.
+
+    Keeps one keep-alive ``requests.Session`` (and connection pool) per host, applies
+    default connect/read timeouts, retries transient failures with jittered exponential
+    backoff, short-circuits hosts that keep failing and records per-host latency.
+    """
+
+    def __init__(self, config=None):
+        config = dict(env_variable.OUTBOUND_HTTP, **(config or {}))
+        self.timeout = config["timeout"]
+        self.retries = config["retries"]
+        self.backoff = config["backoff"]
+        self.backoff_max = config["backoff_max"]
+        self.pool_maxsize = config["pool_maxsize"]
+        self.breaker_threshold = config["breaker_threshold"]
+        self.breaker_cooldown = config["breaker_cooldown"]
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._breakers = {}
+        self._stats = {}
+
+    def session_for(self, host):
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = makeRequests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._sessions[host] = session
+                    self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+                    self._stats[host] = HostStats()
+        return session
+
+    def request(self, method, url, retries=None, idempotent=None, **kwargs):
+        method = method.upper()
+        host = urlsplit(url).netloc
+        session = self.session_for(host)
+        breaker, stats = self._breakers[host], self._stats[host]
+        kwargs.setdefault("timeout", self.timeout)
+
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        if retries is None:
+            retries = self.retries if idempotent else 0
+
+        attempt = 0
+        while True:
+            with self._lock:
+                allowed = breaker.allow()
+                if not allowed:
+                    stats.short_circuited += 1
+            if not allowed:
+                raise CircuitOpenError(f"Circuit open for {host}")
+
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (makeRequests.ConnectionError, makeRequests.Timeout):
+                with self._lock:
+                    stats.observe((time.perf_counter() - started) * 1000)
+                    stats.errors += 1
+                    breaker.record_failure()
+                if attempt >= retries:
+                    raise
+            except Exception:
+                # Not retried (invalid request, decoding error...), but a half-open trial must still be
+                # released, otherwise the breaker would never close again
+                with self._lock:
+                    stats.errors += 1
+                    breaker.record_failure()
+                raise
+            else:
+                failed = response.status_code >= 500 or response.status_code == 429
+                with self._lock:
+                    stats.observe((time.perf_counter() - started) * 1000)
+                    if failed:
+                        stats.errors += 1
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                    return response
+                response.close()
+
+            attempt += 1
+            with self._lock:
+                stats.retries += 1
+            # Full jitter: spreads retries of concurrent callers instead of synchronising them
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt))))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                host: dict(stats.as_dict(), circuit=self._breakers[host].state)
+                for host, stats in self._stats.items()
+            }
+
+
+outbound = OutboundClient()
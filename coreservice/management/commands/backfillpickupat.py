@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from rides.task import backfill_booking_schedule
+
+
+class Command(BaseCommand):
+    help = 'Fill Booking.pickup_at / expected_end_at from the pickup date, time and trip length in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Bookings updated per transaction')
+        parser.add_argument('--all', action='store_true', help='Recompute every booking, not only the missing ones')
+
+    def handle(self, *args, **options):
+        report = backfill_booking_schedule(batch_size=options['batch_size'], only_missing=not options['all'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {report['bookings']} bookings in {report['seconds']}s: {report['updated']} updated, "
+            f"{report['assignments']} assignments re-synced"
+        ))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from rides.task import compact_trip_routes
+
+
+class Command(BaseCommand):
+    help = 'Simplify the GPS traces of closed bookings into stored routes and delete their raw pings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Bookings compacted per transaction')
+        parser.add_argument('--tolerance', type=float, default=None, help='Simplification tolerance in metres')
+
+    def handle(self, *args, **options):
+        report = compact_trip_routes(batch_size=options['batch_size'], tolerance_m=options['tolerance'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Compacted {report['bookings']} routes in {report['seconds']}s: "
+            f"{report['pings']} pings replaced by {report['points']} points"
+        ))
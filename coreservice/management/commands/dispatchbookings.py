@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from rides.task import dispatch_upcoming_bookings
+
+
+class Command(BaseCommand):
+    help = 'Assign the unassigned bookings of the coming window to drivers as one min-cost matching'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window-minutes', type=int, default=None, help='Pickups covered from now on')
+        parser.add_argument('--dry-run', action='store_true', help='Compute the plan without writing assignments')
+
+    def handle(self, *args, **options):
+        report = dispatch_upcoming_bookings(window_minutes=options['window_minutes'], dry_run=options['dry_run'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Assigned {report['assigned']} of {report['bookings']} bookings in {report['seconds']}s "
+            f"({report['deadhead_km']} deadhead km)"
+        ))
@@ -0,0 +1,34 @@
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+EXPORTS = {
+    'bookings': 'rides.task.export_bookings',
+    'payments': 'payments.task.export_payments',
+    'payouts': 'payments.task.export_payouts',
+}
+
+
+def local_day(value):
+    # Midnight in the site's time zone, so the range matches the days shown to the staff
+    return timezone.make_aware(datetime.combine(date.fromisoformat(value), time.min))
+
+
+class Command(BaseCommand):
+    help = 'Stream an export of rides data (XLSX or CSV) to the media storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--since', type=local_day, default=None, help='First day included (YYYY-MM-DD)')
+        parser.add_argument('--until', type=local_day, default=None, help='First day excluded (YYYY-MM-DD)')
+        parser.add_argument('--format', choices=('xlsx', 'csv'), default='xlsx')
+
+    def handle(self, *args, **options):
+        export = import_string(EXPORTS[options['kind']])
+        report = export(since=options['since'], until=options['until'], file_format=options['format'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {report['rows']} rows in {report['seconds']}s to {report['url'] or report['path']}"
+        ))
@@ -0,0 +1,50 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coreservice.geoip_helper import write_geoip_database
+from sefservices import settings as env_variable
+
+
+class Command(BaseCommand):
+    help = 'Build the offline GeoIP database from a CSV of IP ranges (start_ip, end_ip, country_code[, city])'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', type=str, help='CSV file of IP ranges (e.g. DB-IP "IP to City Lite")')
+        parser.add_argument('--output', type=str, default=None, help='Database path (default: GEOIP_DATABASE_PATH)')
+        parser.add_argument('--start-col', type=int, default=0, help='Column of the first IP of the range')
+        parser.add_argument('--end-col', type=int, default=1, help='Column of the last IP of the range')
+        parser.add_argument('--country-col', type=int, default=2, help='Column of the ISO country code')
+        parser.add_argument('--city-col', type=int, default=None, help='Column of the city name, if any')
+        parser.add_argument('--skip-header', action='store_true', help='Ignore the first line of the CSV')
+
+    def handle(self, *args, **options):
+        output = options['output'] or env_variable.GEOIP_DATABASE_PATH
+        start_col, end_col = options['start_col'], options['end_col']
+        country_col, city_col = options['country_col'], options['city_col']
+        started = time.monotonic()
+
+        def ranges():
+            with open(options['csv_file'], newline='', encoding='utf-8') as csv_file:
+                reader = csv.reader(csv_file)
+                if options['skip_header']:
+                    next(reader, None)
+                for row in reader:
+                    if not row:
+                        continue
+                    yield (
+                        row[start_col],
+                        row[end_col],
+                        row[country_col],
+                        row[city_col] if city_col is not None else "",
+                    )
+
+        try:
+            count = write_geoip_database(ranges(), output)
+        except (OSError, ValueError, IndexError) as error:
+            raise CommandError(f'GeoIP import failed: {error}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully imported {count} IP ranges into {output} in {time.monotonic() - started:.1f}s'
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from coreservice.partition_helper import maintain_partitions
+
+
+class Command(BaseCommand):
+    help = 'Create the coming monthly partitions and archive the expired ones (PostgreSQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=None, help='Months of partitions created in advance')
+
+    def handle(self, *args, **options):
+        report = maintain_partitions(months_ahead=options['months_ahead'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(report['created'])} partitions created, {len(report['archived'])} archived"
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from payments.task import reconcile_payment_methods
+
+
+class Command(BaseCommand):
+    help = 'Reconcile saved payment methods with the cards attached to each Stripe customer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None, help='Customers processed per transaction')
+        parser.add_argument('--max-seconds', type=float, default=0, help='Stop and save the cursor after that long')
+        parser.add_argument('--restart', action='store_true', help='Start a new pass from the first customer')
+
+    def handle(self, *args, **options):
+        report = reconcile_payment_methods(chunk_size=options['chunk_size'], max_seconds=options['max_seconds'],
+                                           restart=options['restart'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled {report['customers']} customers in {report['seconds']}s "
+            f"({report['customers_per_second']} customers/s): {report['created']} created, "
+            f"{report['updated']} updated, {report['deleted']} deleted, {report['errors']} errors"
+            f"{'' if report['complete'] else ', the next run resumes where this one stopped'}"
+        ))
@@ -0,0 +1,29 @@
+from django.db import migrations
+
+SCHEDULE_NAME = 'Monthly partitions'
+
+
+def schedule_partitions(apps, schema_editor):
+    # Daily although partitions are monthly: a missed run is caught up the next day, well before
+    # PARTITION_MONTHS_AHEAD runs out, and runs with nothing to do are cheap
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        name=SCHEDULE_NAME,
+        defaults={'func': 'coreservice.partition_helper.maintain_partitions', 'schedule_type': 'D', 'repeats': -1},
+    )
+
+
+def unschedule_partitions(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(name=SCHEDULE_NAME).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreservice', '0001_initial'),
+        ('django_q', '0018_task_success_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(schedule_partitions, unschedule_partitions),
+    ]
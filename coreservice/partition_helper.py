@@ -0,0 +1,203 @@
+import logging
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from sefservices import settings as env_variable
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL only: every other backend keeps plain tables and all of this is a no-op.
+# Partitions are named <table>_pYYYY_MM and cover [first day of the month, first day of the next)
+# in the database time zone; rows outside every monthly partition land in <table>_default.
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+def is_supported(schema_connection=None):
+    return (schema_connection or connection).vendor == "postgresql"
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor, table):
+    """ Names of the monthly partitions attached to ``table``, oldest first """
+
+    cursor.execute(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(%s) AND child.relname ~ '_p[0-9]{4}_[0-9]{2}$' "
+        "ORDER BY child.relname",
+        [table],
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def drop_foreign_keys(cursor, table):
+    """
+    Drops the foreign keys a detached partition kept from its parent.
+
+    Deletes only cascade through the live table: left in place, they would make deleting an
+    old booking or customer fail on the archived rows, which are kept as they are instead.
+    """
+
+    cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'", [table])
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}"')
+
+
+def ensure_partition(cursor, table, column, month):
+    """
+    Creates the partition of ``month`` if missing.
+
+    Rows of that month already caught by the default partition are moved into the new
+    partition before it is attached, otherwise PostgreSQL would refuse the attach.
+    """
+
+    name = partition_name(table, month)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0] is not None:
+        return False
+
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    cursor.execute(f'CREATE TABLE "{name}" (LIKE "{table}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM "{table}_default" WHERE "{column}" >= %s AND "{column}" < %s RETURNING *) '
+        f'INSERT INTO "{name}" SELECT * FROM moved',
+        [start, end],
+    )
+    cursor.execute(f"ALTER TABLE \"{table}\" ATTACH PARTITION \"{name}\" FOR VALUES FROM ('{start}') TO ('{end}')")
+    return True
+
+
+def partition_table(schema_editor, table, column, months_ahead=None):
+    """
+    Migration step turning an existing table into one range-partitioned by month on ``column``.
+
+    The table is renamed, an empty partitioned copy takes its name (same columns, defaults,
+    identity, checks, indexes and constraints, the primary key being widened to
+    (id, column) as PostgreSQL requires), monthly partitions are created from the oldest
+    row to ``months_ahead`` months from now, the rows are copied and the old table dropped.
+    Unique constraints must already include ``column``. Runs in the migration transaction,
+    so the table is locked for the duration of the copy.
+    """
+
+    if not is_supported(schema_editor.connection):
+        return
+    months_ahead = env_variable.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    legacy = f"{table}_legacy"
+
+    with schema_editor.connection.cursor() as cursor:
+        if is_partitioned(cursor, table):
+            return
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+            "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s))",
+            [table, table],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u', 'f')",
+            [table],
+        )
+        constraints = cursor.fetchall()
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence = cursor.fetchone()[0]
+
+        cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+        # Index and constraint names are unique per schema: free them for the new table
+        for name, contype, _ in constraints:
+            cursor.execute(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "{name}" TO "{name[:50]}_legacy"')
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX "{name}" RENAME TO "{name[:50]}_legacy"')
+
+        cursor.execute(
+            f'CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS) '
+            f'PARTITION BY RANGE ("{column}")'
+        )
+        for name, contype, definition in constraints:
+            if contype == "p":
+                definition = f'PRIMARY KEY (id, "{column}")'
+            cursor.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}')
+        for _, definition in indexes:
+            # Definitions were read before the rename, they still point at the new table's name
+            cursor.execute(definition)
+
+        cursor.execute(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT')
+        cursor.execute(f'SELECT min("{column}") FROM "{legacy}"')
+        oldest = cursor.fetchone()[0] or timezone.now()
+        month, last = month_start(oldest), add_months(month_start(timezone.now()), months_ahead)
+        while month <= last:
+            ensure_partition(cursor, table, column, month)
+            month = add_months(month, 1)
+
+        cursor.execute(f'INSERT INTO "{table}" SELECT * FROM "{legacy}"')
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        new_sequence = cursor.fetchone()[0]
+        if new_sequence and new_sequence != sequence:
+            cursor.execute(f'SELECT setval(%s, coalesce((SELECT max(id) FROM "{table}"), 0) + 1, false)', [new_sequence])
+        elif sequence:
+            # Serial column: the copied default still uses the old sequence, keep it alive
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY "{table}".id')
+        cursor.execute(f'DROP TABLE "{legacy}"')
+
+
+def maintain_partitions(months_ahead=None):
+    """
+    Creates the monthly partitions of the coming months and archives the expired ones.
+
+    Expired partitions (older than the table's retention in PARTITIONED_TABLES) are
+    detached, stripped of their foreign keys and moved to the PARTITION_ARCHIVE_SCHEMA
+    schema, where they stay queryable but no longer weigh on the indexes, planning or
+    vacuum of the live table. Runs daily
+    from a django-q schedule (coreservice migration 0002), or on demand with
+    `manage.py managepartitions`.
+    """
+
+    report = {'created': [], 'archived': []}
+    if not is_supported():
+        return report
+    months_ahead = env_variable.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    archive_schema = env_variable.PARTITION_ARCHIVE_SCHEMA
+    current = month_start(timezone.now())
+
+    for table, options in env_variable.PARTITIONED_TABLES.items():
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not is_partitioned(cursor, table):
+                continue
+            for offset in range(months_ahead + 1):
+                month = add_months(current, offset)
+                if ensure_partition(cursor, table, options['column'], month):
+                    report['created'].append(partition_name(table, month))
+
+            retention = options.get('retention_months')
+            if not retention:
+                continue
+            oldest_kept = partition_name(table, add_months(current, -retention))
+            expired = [name for name in list_partitions(cursor, table) if name < oldest_kept]
+            if expired:
+                cursor.execute(f'CREATE SCHEMA IF NOT EXISTS "{archive_schema}"')
+            for name in expired:
+                cursor.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"')
+                drop_foreign_keys(cursor, name)
+                cursor.execute(f'ALTER TABLE "{name}" SET SCHEMA "{archive_schema}"')
+                report['archived'].append(name)
+
+    logger.info("Partitions maintained: %s", report)
+    return report
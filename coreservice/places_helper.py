@@ -0,0 +1,434 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from urllib.parse import quote
+
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.utils.module_loading import import_string
+
+from coreservice.http_helper import outbound
+from rides.models import Place
+from sefservices import settings as env_variable
+
+PLACES_AUTOCOMPLETE_URL = "https://places.googleapis.com/v1/places:autocomplete"
+PLACES_DETAILS_URL = "https://places.googleapis.com/v1/places/{place_id}"
+PLACES_DETAILS_FIELDS = "id,displayName,formattedAddress,location,types"
+PLACES_AUTOCOMPLETE_FIELDS = ",".join([
+    "suggestions.placePrediction.placeId",
+    "suggestions.placePrediction.types",
+    "suggestions.placePrediction.structuredFormat.mainText.text",
+    "suggestions.placePrediction.structuredFormat.secondaryText.text",
+])
+
+
+def normalize_query(query):
+    """ Lowercase, accent-free and single-spaced version of a search input """
+
+    query = unicodedata.normalize("NFKD", str(query or ""))
+    query = "".join(char for char in query if not unicodedata.combining(char))
+    return " ".join(query.lower().split())
+
+
+def suggestion_matches(suggestion, normalized_query):
+    # Every word typed must start one of the words of the suggestion
+    words = normalize_query(f"{suggestion['mainText']} {suggestion['secondaryText']}").replace(",", " ").split()
+    return all(any(word.startswith(term) for word in words) for term in normalized_query.split())
+
+
+def fetch_place_suggestions(query, language):
+    params = {
+        "input": query,
+        "languageCode": f"{language}",
+    }
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": f"{env_variable.GOOGLE_MAP_API_KEY}",
+        "X-Goog-FieldMask": PLACES_AUTOCOMPLETE_FIELDS,
+    }
+    response = outbound.post(PLACES_AUTOCOMPLETE_URL, json=params, headers=headers,
+                             timeout=env_variable.PLACES_API_TIMEOUT, idempotent=True)
+    response.raise_for_status()
+
+    data = []
+    for suggestion in response.json().get("suggestions", []):
+        prediction = suggestion.get("placePrediction")
+        if not prediction:
+            continue
+        structured = prediction.get("structuredFormat", {})
+        data.append({
+            "placeId": prediction["placeId"],
+            "types": prediction.get("types", []),
+            "mainText": structured.get("mainText", {}).get("text", ""),
+            "secondaryText": structured.get("secondaryText", {}).get("text", ""),
+        })
+
+    return data
+
+
+class PlacesAutocompleteCache:
+    """
+    In-process cache of autocomplete suggestions keyed by (normalized prefix, language).
+
+    Entries expire after ``ttl`` seconds and the least recently used one is evicted
+    once ``max_entries`` is reached. Cached prefixes are also indexed in a trie per
+    language so that "paris ch" can be answered by filtering the suggestions already
+    cached for "paris c" without calling the Places API. Only lists shorter than the
+    API page (``page_size``) are filtered that way: a full page may have cut off the
+    suggestions of the longer query.
+    """
+
+    def __init__(self, ttl=None, max_entries=None, min_prefix_length=3, page_size=None):
+        self.ttl = ttl if ttl is not None else env_variable.PLACES_CACHE_TTL
+        self.max_entries = max_entries if max_entries is not None else env_variable.PLACES_CACHE_MAX_ENTRIES
+        self.page_size = page_size or env_variable.PLACES_AUTOCOMPLETE_PAGE_SIZE
+        self.min_prefix_length = min_prefix_length
+        self._entries = OrderedDict()  # (prefix, language) -> (expires_at, suggestions)
+        self._tries = {}  # language -> nested dicts, the "" key flags a cached prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, query, language):
+        prefix = normalize_query(query)
+        now = time.monotonic()
+
+        with self._lock:
+            suggestions = self._get_entry((prefix, language), now)
+            if suggestions is not None:
+                self.hits += 1
+                return suggestions
+
+            for shorter in self._cached_prefixes(prefix, language):
+                cached = self._get_entry((shorter, language), now)
+                if cached is None or len(cached) >= self.page_size:
+                    continue
+                filtered = [suggestion for suggestion in cached if suggestion_matches(suggestion, prefix)]
+                if filtered:
+                    self.prefix_hits += 1
+                    return filtered
+
+            self.misses += 1
+            return None
+
+    def set(self, query, language, suggestions):
+        prefix = normalize_query(query)
+        key = (prefix, language)
+
+        with self._lock:
+            if key not in self._entries:
+                while len(self._entries) >= self.max_entries:
+                    oldest_key, _ = self._entries.popitem(last=False)
+                    self._trie_remove(oldest_key)
+                    self.evictions += 1
+                self._trie_add(key)
+            self._entries[key] = (time.monotonic() + self.ttl, list(suggestions))
+            self._entries.move_to_end(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.prefix_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "prefix_hits": self.prefix_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round((self.hits + self.prefix_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+    def _get_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            self._trie_remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _cached_prefixes(self, prefix, language):
+        """ Cached prefixes of ``prefix``, longest first """
+
+        node = self._tries.get(language)
+        found = []
+        for index, char in enumerate(prefix):
+            if node is None:
+                break
+            node = node.get(char)
+            if node is not None and "" in node and self.min_prefix_length <= index + 1 < len(prefix):
+                found.append(prefix[:index + 1])
+        found.reverse()
+        return found
+
+    def _trie_add(self, key):
+        prefix, language = key
+        node = self._tries.setdefault(language, {})
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def _trie_remove(self, key):
+        prefix, language = key
+        path = [self._tries.get(language)]
+        for char in prefix:
+            if path[-1] is None:
+                return
+            path.append(path[-1].get(char))
+        if path[-1] is None:
+            return
+        path[-1].pop("", None)
+        # Prune the branches left empty
+        for depth in range(len(prefix), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][prefix[depth - 1]]
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing the same key: the first caller runs the
+    function, the others wait for its outcome (result or exception) instead of
+    issuing the same upstream request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = {"event": threading.Event(), "result": None, "error": None}
+                self.leaders += 1
+                is_leader = True
+            else:
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            if not call["event"].wait(timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight call {key!r}")
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as error:
+            call["error"] = error
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+
+class SharedFlightFailed(Exception):
+    """ The worker running a shared single-flight call failed, its message is passed on """
+
+
+def shared_single_flight(key, fn, lock_timeout, wait_timeout, poll_interval=0.05):
+    """
+    Cross-worker variant built on the Django cache: the worker that adds the lock key
+    runs ``fn`` and publishes its outcome, the others poll for it until ``wait_timeout``
+    and only then fall back to their own call. A failure is published too, so the
+    waiters raise SharedFlightFailed at once. Requires a cache shared by the workers.
+    """
+
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    lock_key, result_key = f"singleflight:lock:{digest}", f"singleflight:result:{digest}"
+
+    if cache.add(lock_key, 1, timeout=lock_timeout):
+        # The outcome of a previous flight must not answer the waiters of this one
+        cache.delete(result_key)
+        try:
+            result = fn()
+        except Exception as error:
+            cache.set(result_key, {"error": f"{type(error).__name__}: {error}"}, timeout=lock_timeout)
+            raise
+        else:
+            cache.set(result_key, {"result": result}, timeout=lock_timeout)
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + wait_timeout
+    while time.monotonic() < deadline:
+        outcome = cache.get(result_key)
+        if outcome is not None:
+            if "error" in outcome:
+                raise SharedFlightFailed(outcome["error"])
+            return outcome["result"]
+        time.sleep(poll_interval)
+
+    return fn()
+
+
+places_cache = PlacesAutocompleteCache()
+places_flight = SingleFlight()
+
+
+def get_place_suggestions(query, language):
+    suggestions = places_cache.get(query, language)
+    if suggestions is not None:
+        return suggestions
+
+    key = (normalize_query(query), language)
+    wait_timeout = sum(env_variable.PLACES_API_TIMEOUT)
+
+    def fetch():
+        fetched = fetch_place_suggestions(query, language)
+        places_cache.set(query, language, fetched)
+        return fetched
+
+    def fetch_once():
+        if env_variable.PLACES_SHARED_SINGLE_FLIGHT:
+            return shared_single_flight(key, fetch, lock_timeout=wait_timeout, wait_timeout=wait_timeout)
+        return fetch()
+
+    return places_flight.do(key, fetch_once, timeout=wait_timeout)
+
+
+class PlaceNotFound(Exception):
+    pass
+
+
+class GooglePlaceDetailsProvider:
+    name = "google"
+
+    def get_details(self, place_id):
+        headers = {
+            "X-Goog-Api-Key": f"{env_variable.GOOGLE_MAP_API_KEY}",
+            "X-Goog-FieldMask": PLACES_DETAILS_FIELDS,
+        }
+        # Ids come from the client: escaped so that "/", "?" or "../" cannot change the request
+        response = outbound.get(PLACES_DETAILS_URL.format(place_id=quote(place_id, safe="")), headers=headers,
+                                timeout=env_variable.PLACES_API_TIMEOUT)
+        if response.status_code in (400, 404):
+            raise PlaceNotFound(place_id)
+        response.raise_for_status()
+
+        result = response.json()
+        location = result.get("location") or {}
+        if "latitude" not in location or "longitude" not in location:
+            raise PlaceNotFound(place_id)
+
+        return {
+            "name": result.get("displayName", {}).get("text", ""),
+            "address": result.get("formattedAddress", ""),
+            "lat": location["latitude"],
+            "lng": location["longitude"],
+            "types": result.get("types", []),
+        }
+
+
+class LocalPlaceDetailsProvider:
+    """ Offline stand-in for tests and development, serving places registered in memory """
+
+    name = "local"
+    places = {}
+
+    @classmethod
+    def register(cls, place_id, lat, lng, name="", address="", types=None):
+        cls.places[place_id] = {"name": name, "address": address, "lat": lat, "lng": lng, "types": types or []}
+
+    def get_details(self, place_id):
+        try:
+            return dict(self.places[place_id])
+        except KeyError:
+            raise PlaceNotFound(place_id)
+
+
+class PlaceResolver:
+    """
+    Resolves provider place ids to coordinates, asking the provider only once per place.
+
+    Lookups go through a small in-memory LRU of the hottest places, then the
+    ``rides.Place`` table (unique index on place_id), and only then the provider,
+    whose answer is stored for every later booking.
+    """
+
+    def __init__(self, provider=None, hot_cache_size=None):
+        self.provider = provider
+        self.hot_cache_size = hot_cache_size if hot_cache_size is not None else env_variable.PLACE_HOT_CACHE_SIZE
+        self._hot = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_provider(self):
+        if self.provider is None:
+            self.provider = import_string(env_variable.PLACE_DETAILS_PROVIDER)()
+        return self.provider
+
+    def _remember(self, place):
+        with self._lock:
+            self._hot[place.place_id] = place
+            self._hot.move_to_end(place.place_id)
+            while len(self._hot) > self.hot_cache_size:
+                self._hot.popitem(last=False)
+
+    def _from_hot_cache(self, place_id):
+        with self._lock:
+            place = self._hot.get(place_id)
+            if place is not None:
+                self._hot.move_to_end(place_id)
+            return place
+
+    def _fetch(self, place_id):
+        provider = self.get_provider()
+        details = provider.get_details(place_id)
+        try:
+            place, _ = Place.objects.get_or_create(place_id=place_id, defaults=dict(details, provider=provider.name))
+        except IntegrityError:
+            # Resolved concurrently by another worker
+            place = Place.objects.get(place_id=place_id)
+        return place
+
+    def resolve(self, place_id):
+        place = self._from_hot_cache(place_id)
+        if place is None:
+            place = Place.objects.filter(place_id=place_id).first() or self._fetch(place_id)
+            self._remember(place)
+        return place
+
+    def resolve_many(self, place_ids):
+        """ Returns {place_id: Place} with one query for every place not already hot """
+
+        resolved, missing = {}, []
+        for place_id in dict.fromkeys(place_ids):
+            place = self._from_hot_cache(place_id)
+            if place is None:
+                missing.append(place_id)
+            else:
+                resolved[place_id] = place
+
+        if missing:
+            for place in Place.objects.filter(place_id__in=missing):
+                resolved[place.place_id] = place
+            for place_id in missing:
+                if place_id not in resolved:
+                    resolved[place_id] = self._fetch(place_id)
+                self._remember(resolved[place_id])
+
+        return resolved
+
+    def forget(self, place_id):
+        with self._lock:
+            self._hot.pop(place_id, None)
+
+
+place_resolver = PlaceResolver()
@@ -4,21 +4,17 @@ from io import BytesIO
 import imgkit
 import requests
 from django.contrib.humanize.templatetags.humanize import intcomma
-from django.core.files import File
 from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage, FileSystemStorage
+from django.core.files.storage import default_storage
 from django.core.signing import TimestampSigner
 from django.template.loader import render_to_string
 from django.urls import reverse
-from django.utils import timezone
 from django_countries import countries
-from openpyxl.utils import get_column_letter
-from openpyxl.workbook import Workbook
 from weasyprint import HTML
+from coreservice.export_helper import export_name, export_rows, queryset_rows
 from coreservice.mail_helper import MailSender
 from coreservice.models import Booking, Exhibitor, OTP, Invoice
 import sefservices.settings as env_variable
-import os
 
 
 # Sending Signal for new registered Exhibitor
@@ -98,26 +94,13 @@ def export_invoices(**kwargs):
     invoices = kwargs.get('invoices')
     staff = kwargs.get('staff')
 
-    # Creation du fichier Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Liste des Factures"
-
     # Entête de la feuille excel
     headers = ['Référence', 'Référence Réservation', 'Exposant', 'Montant total facturé (FCFA)', 'Total Payé (FCFA)',
                'Montant dû (FCFA)', 'Date émise', 'Status']
+    statuses = {"Paid": "Payé", "Partially Paid": "Paiement Partiel"}
 
-    ws.append(headers)
-
-    # Écriture des données sur le fichier excel
-    for invoice in invoices:
-        if invoice.status == "Paid":
-            status = "Payé"
-        elif invoice.status == "Partially Paid":
-            status = "Paiement Partiel"
-        else:
-            status = "Non Payé"
-        ws.append([
+    def invoice_row(invoice):
+        return [
             invoice.invoice_number,
             invoice.booking.booking_ref,
             str(invoice.booking.exhibitor.designation).upper(),
@@ -125,127 +108,53 @@ def export_invoices(**kwargs):
             intcomma(int(invoice.amount_paid)),
             intcomma(int(invoice.remaining_balance)),
             invoice.issued_at.strftime("%d-%m-%Y"),
-            status
-        ])
-
-    # Ajustement des colones
-    for col in ws.columns:
-        max_length = max(len(str(cell.value)) for cell in col if cell.value is not None)
-        col_letter = get_column_letter(col[0].column)
-        ws.column_dimensions[col_letter].width = max_length + 2
-
-    # Enregistrement temporaire sur le système
-    file_name = f"Factures_{timezone.now().strftime('%d%m%Y_%H%M%S')}.xlsx"
-    local_dir = 'medias/importations/'
-
-    # Créer le répertoire s'il n'existe pas
-    os.makedirs(local_dir, exist_ok=True)
-
-    # Sauvegarde du fichier excel
-    local_fs = FileSystemStorage(location=local_dir)
-    full_path = local_fs.path(file_name)
-    wb.save(full_path)
-
-    # Téléversement du fichier vers le serveur de stockage
-    with open(full_path, 'rb') as f:
-        django_file = File(f)
-        minio_path = f'Exportations/Factures/{file_name}'
-        default_storage.save(minio_path, django_file)
-
-    # Suppression du fichier local
-    if os.path.exists(full_path):
-        os.remove(full_path)
-
-    # Récupération de l'URL du fichier téléversé
-    if default_storage.exists(minio_path):
-        try:
-            url = default_storage.url(minio_path)
-        except NotImplementedError:
-            url = f"/media/{minio_path}"  # fallback if using file backend
-
-    else:
-        url = None
+            statuses.get(invoice.status, "Non Payé"),
+        ]
+
+    # Écriture en flux, directement téléversée vers le serveur de stockage
+    report = export_rows(
+        export_name('Factures/Factures'), headers,
+        queryset_rows(invoices.select_related('booking__exhibitor'), invoice_row),
+        title="Liste des Factures",
+    )
 
     # Envoi de mail une fois l'exportation terminée
     mail_sender = MailSender()
-    mail_sender.invoices_exportation_mail(**{'staff': staff, 'file_url': f"{url}"})
-    # if default_storage.exists(minio_path):
-    #    default_storage.delete(minio_path)
+    mail_sender.invoices_exportation_mail(**{'staff': staff, 'file_url': f"{report['url']}"})
 
-    print(f"[EXPORT] Invoice export completed. File '{file_name}' sent via email and deleted from Storage Server.")
+    print(f"[EXPORT] Invoice export completed. File '{report['path']}' sent via email.")
 
 
 def export_exhibitor(**kwargs):
     exhibitors = kwargs.get('exhibitors')
     staff = kwargs.get('staff')
 
-    # Creation du fichier Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Liste des exposants"
-
     # Entête de la feuille excel
     headers = ['Date', 'Nom', 'Prénom', 'Nom de la société', 'Email', 'Téléphone', 'Pays']
+    country_names = dict(countries)
 
-    ws.append(headers)
-
-    # Écriture des données sur le fichier excel
-    for exhibitor in exhibitors:
-        ws.append([
+    def exhibitor_row(exhibitor):
+        return [
             exhibitor.created_at.strftime("%d-%m-%Y"),
             str(exhibitor.lastname).upper(),
             str(exhibitor.firstname).title(),
             str(exhibitor.designation).upper(),
             exhibitor.email,
             exhibitor.phone,
-            str(dict(countries)[exhibitor.country]),
-        ])
-
-    # Ajustement des colones
-    for col in ws.columns:
-        max_length = max(len(str(cell.value)) for cell in col if cell.value is not None)
-        col_letter = get_column_letter(col[0].column)
-        ws.column_dimensions[col_letter].width = max_length + 2
-
-    # Enregistrement temporaire sur le système
-    file_name = f"Liste_Exposant_{timezone.now().strftime('%d%m%Y_%H%M%S')}.xlsx"
-    local_dir = 'medias/importations/'
-
-    # Créer le répertoire s'il n'existe pas
-    os.makedirs(local_dir, exist_ok=True)
-
-    # Sauvegarde du fichier excel
-    local_fs = FileSystemStorage(location=local_dir)
-    full_path = local_fs.path(file_name)
-    wb.save(full_path)
-
-    # Téléversement du fichier vers le serveur de stockage
-    with open(full_path, 'rb') as f:
-        django_file = File(f)
-        minio_path = f'Exportations/Exposants/{file_name}'
-        default_storage.save(minio_path, django_file)
-
-    # Suppression du fichier local
-    if os.path.exists(full_path):
-        os.remove(full_path)
-
-    # Récupération de l'URL du fichier téléversé
-    if default_storage.exists(minio_path):
-        try:
-            url = default_storage.url(minio_path)
-        except NotImplementedError:
-            url = f"/media/{minio_path}"  # fallback if using file backend
+            str(country_names[exhibitor.country]),
+        ]
 
-    else:
-        url = None
+    # Écriture en flux, directement téléversée vers le serveur de stockage
+    report = export_rows(
+        export_name('Exposants/Liste_Exposant'), headers, queryset_rows(exhibitors, exhibitor_row),
+        title="Liste des exposants",
+    )
 
     # Envoi de mail une fois l'exportation terminée
     mail_sender = MailSender()
-    mail_sender.invoices_exportation_mail(**{'staff': staff, 'file_url': f"{url}"})
-    # if default_storage.exists(minio_path):
-    #    default_storage.delete(minio_path)
+    mail_sender.invoices_exportation_mail(**{'staff': staff, 'file_url': f"{report['url']}"})
 
-    print(f"[EXPORT] Invoice export completed. File '{file_name}' sent via email and deleted from Storage Server.")
+    print(f"[EXPORT] Exhibitor export completed. File '{report['path']}' sent via email.")
 
 
 def quitus_availability_mail(**kwargs):
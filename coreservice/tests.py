@@ -1,3 +1,615 @@
-from django.test import TestCase
+import csv
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date, datetime, time as day_time, timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+import stripe
+from django.db import connection
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from django_q.models import Schedule
+from openpyxl import load_workbook
+
+from accounts.models import Customer, PaymentMethod
+from coreservice.export_helper import MultipartUploadWriter, write_csv, write_xlsx
+from coreservice.geoip_helper import GeoIPDatabase, write_geoip_database
+from coreservice.forms import RegistrationForm
+from coreservice.helpers import DisposableDomainIndex, StripeManager, configure_stripe
+from coreservice.http_helper import CircuitBreaker, CircuitOpenError, OutboundClient
+from coreservice.partition_helper import (
+    add_months, ensure_partition, list_partitions, maintain_partitions, month_start, partition_name,
+)
+from coreservice.places_helper import (
+    GooglePlaceDetailsProvider, PlaceNotFound, PlacesAutocompleteCache, SharedFlightFailed, SingleFlight,
+    shared_single_flight,
+)
+from rides.models import Booking, CarClass, TripEvent
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def test_opens_after_threshold_and_closes_on_success(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+        breaker.opened_at -= 61
+        self.assertEqual(breaker.state, "half-open")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())  # a single trial at a time
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+    def test_unexpected_error_releases_half_open_trial(self):
+        client = OutboundClient({"retries": 0, "breaker_threshold": 1, "breaker_cooldown": 0})
+        session = client.session_for("api.example.com")
+        breaker = client._breakers["api.example.com"]
+        url = "https://api.example.com/v1"
+
+        with mock.patch.object(session, "request", side_effect=requests.ConnectionError):
+            with self.assertRaises(requests.ConnectionError):
+                client.get(url)
+        self.assertEqual(breaker.state, "half-open")
+
+        with mock.patch.object(session, "request", side_effect=ValueError("bad payload")):
+            with self.assertRaises(ValueError):
+                client.get(url)
+        self.assertFalse(breaker.trial_in_flight)
+
+        with mock.patch.object(session, "request", return_value=mock.Mock(status_code=200)):
+            self.assertEqual(client.get(url).status_code, 200)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_open_circuit_short_circuits(self):
+        client = OutboundClient({"retries": 0, "breaker_threshold": 1, "breaker_cooldown": 60})
+        session = client.session_for("api.example.com")
+
+        with mock.patch.object(session, "request", return_value=mock.Mock(status_code=503)) as request:
+            client.get("https://api.example.com/v1")
+            with self.assertRaises(CircuitOpenError):
+                client.get("https://api.example.com/v1")
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(client.stats()["api.example.com"]["short_circuited"], 1)
+
+
+class PlaceDetailsViewTests(TestCase):
+
+    @mock.patch("coreservice.views.place_resolver")
+    def test_requires_login(self, resolver):
+        response = self.client.get(reverse("core:place_details"), {"place_id": "abc"})
+        self.assertEqual(response.status_code, 302)
+        resolver.resolve.assert_not_called()
+
+    @mock.patch("coreservice.views.place_resolver")
+    def test_resolves_for_customers(self, resolver):
+        resolver.resolve.return_value = SimpleNamespace(place_id="abc", name="Airport", address="Lomé", lat=6.16,
+                                                        lng=1.25, types=["airport"], is_airport=True)
+        self.client.force_login(Customer.objects.create(email="rider@example.com", phone="1"))
+
+        response = self.client.get(reverse("core:place_details"), {"place_id": "abc"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["lat"], 6.16)
+
+
+class UpcomingBookingViewTests(TestCase):
+
+    def setUp(self):
+        self.customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.client.force_login(self.customer)
+
+    def test_lists_the_next_page(self):
+        car_class = CarClass.objects.create(name="Eco", base_price=10, per_km_rate=2, per_hour_rate=30)
+        for index in range(3):
+            Booking.objects.create(reference=f"B{index}", customer=self.customer, booking_type="TRANSFER",
+                                   car_class=car_class, pickup_date=date.today() + timedelta(days=1),
+                                   pickup_time=day_time(10, 0), pickup_address=f"Address {index}",
+                                   status="CONFIRMED")
+
+        with mock.patch("rides.bookings_helper.env_variable.BOOKINGS_PAGE_SIZE", 2):
+            first = self.client.get(reverse("core:upcoming_bookings"), HTTP_HX_REQUEST="true")
+            cursor = first.context["next_cursor"]
+            second = self.client.get(reverse("core:upcoming_bookings"), {"cursor": cursor}, HTTP_HX_REQUEST="true")
+
+        self.assertContains(first, "Address 1")
+        self.assertNotContains(first, "Address 2")
+        self.assertContains(second, "Address 2")
+        self.assertIsNone(second.context["next_cursor"])
+
+    def test_malformed_cursor_is_a_bad_request(self):
+        response = self.client.get(reverse("core:upcoming_bookings"), {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TripEventSearchViewTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(Customer.objects.create(email="staff@example.com", phone="1", is_staff=True))
+
+    def test_bad_queries_are_rejected(self):
+        for params in ({"meta.passenger": "x"}, {"since": "2000-01-01T00:00"}, {"since": "yesterday"}):
+            with self.subTest(**params):
+                response = self.client.get(reverse("core:trip_event_search"), params)
+                self.assertEqual(response.status_code, 400)
+
+    def test_search(self):
+        response = self.client.get(reverse("core:trip_event_search"), {"meta.code": "7"})
+        self.assertEqual(response.json(), {"status": "success", "count": 0, "events": []})
+
+
+class StubS3Client:
+    """ Keeps multipart uploads in memory """
+
+    def __init__(self, fail_complete=False):
+        self.fail_complete = fail_complete
+        self.parts, self.objects, self.aborted = [], {}, []
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts.append(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        if self.fail_complete:
+            raise ConnectionError("complete failed")
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        self.objects[Key] = b''.join(self.parts[number - 1] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+
+@mock.patch("coreservice.export_helper.MIN_PART_SIZE", 1)
+class MultipartUploadWriterTests(SimpleTestCase):
+
+    def test_parts_are_split_at_part_size(self):
+        client = StubS3Client()
+        with MultipartUploadWriter(client, "bucket", "key", part_size=4) as stream:
+            stream.write(b"abc")
+            stream.write(b"defghij")
+            self.assertEqual(stream.tell(), 10)
+            self.assertEqual(client.parts, [b"abcd", b"efgh"])
+
+        self.assertEqual(client.parts, [b"abcd", b"efgh", b"ij"])
+        self.assertEqual(client.objects["key"], b"abcdefghij")
+        self.assertTrue(stream.closed)
+
+    def test_empty_file_is_one_empty_part(self):
+        client = StubS3Client()
+        with MultipartUploadWriter(client, "bucket", "key", part_size=4):
+            pass
+        self.assertEqual(client.objects["key"], b"")
+
+    def test_exception_aborts_the_upload(self):
+        client = StubS3Client()
+        with self.assertRaises(RuntimeError):
+            with MultipartUploadWriter(client, "bucket", "key", part_size=4) as stream:
+                stream.write(b"abcdef")
+                raise RuntimeError("export failed")
+
+        self.assertEqual(client.aborted, ["key"])
+        self.assertEqual(client.objects, {})
+        with self.assertRaises(ValueError):
+            stream.write(b"more")
+
+    def test_failed_completion_aborts_the_upload(self):
+        client = StubS3Client(fail_complete=True)
+        with self.assertRaises(ConnectionError):
+            with MultipartUploadWriter(client, "bucket", "key", part_size=4) as stream:
+                stream.write(b"abcdef")
+        self.assertEqual(client.aborted, ["key"])
+
+    def test_csv_round_trip(self):
+        client = StubS3Client()
+        at = timezone.make_aware(datetime(2025, 3, 1, 10, 30))
+        rows = [(index, f"Rider é{index}", at) for index in range(50)]
+        with MultipartUploadWriter(client, "bucket", "export.csv", part_size=64) as stream:
+            write_csv(stream, ["Id", "Name", "At"], iter(rows))
+
+        self.assertGreater(len(client.parts), 1)
+        text = client.objects["export.csv"].decode("utf-8-sig")
+        lines = list(csv.reader(io.StringIO(text, newline="")))
+        self.assertEqual(lines[0], ["Id", "Name", "At"])
+        self.assertEqual(lines[1:], [[str(index), name, str(timezone.make_naive(at))] for index, name, _ in rows])
+
+    def test_xlsx_round_trip(self):
+        client = StubS3Client()
+        rows = [(index, f"Rider {index}") for index in range(300)]
+        with MultipartUploadWriter(client, "bucket", "export.xlsx", part_size=1024) as stream:
+            write_xlsx(stream, ["Id", "Name"], iter(rows), title="Riders")
+
+        sheet = load_workbook(io.BytesIO(client.objects["export.xlsx"]), read_only=True)["Riders"]
+        self.assertEqual([tuple(row) for row in sheet.iter_rows(values_only=True)], [("Id", "Name")] + rows)
+
+
+class DisposableDomainIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "disposable.txt")
+        self.write("# disposable domains\ntrash-mail.com\nYopmail.fr\n", mtime=1_000_000)
+
+    def write(self, content, mtime):
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_subdomains_match_their_parent(self):
+        index = DisposableDomainIndex(self.path)
+        self.assertIn("trash-mail.com", index)
+        self.assertIn("sub.trash-mail.com", index)
+        self.assertIn("A.B.TRASH-MAIL.COM.", index)
+        self.assertIn("yopmail.fr", index)
+        self.assertNotIn("mail.com", index)
+        self.assertNotIn("not-trash-mail.com", index)
+        self.assertNotIn("# disposable domains", index)
+
+    def test_reloads_when_the_file_changes(self):
+        index = DisposableDomainIndex(self.path, reload_interval=60)
+        with mock.patch("coreservice.helpers.time.monotonic", return_value=1000.0):
+            self.assertNotIn("new-trash.com", index)
+            self.write("new-trash.com\n", mtime=2_000_000)
+            # Not looked at again before reload_interval
+            self.assertNotIn("new-trash.com", index)
+        with mock.patch("coreservice.helpers.time.monotonic", return_value=1061.0):
+            self.assertIn("new-trash.com", index)
+            self.assertNotIn("trash-mail.com", index)
+
+    def test_unchanged_file_is_not_read_again(self):
+        index = DisposableDomainIndex(self.path, reload_interval=0)
+        self.assertIn("trash-mail.com", index)
+        with mock.patch.object(index, "_load") as load:
+            self.assertIn("trash-mail.com", index)
+        load.assert_not_called()
+
+
+class RegistrationFormTests(TestCase):
+
+    def form(self, email):
+        return RegistrationForm(data={"last_name": "Mensah", "first_name": "Ama", "email": email,
+                                      "phone": "22890000000", "password": "secret-password"})
+
+    def test_disposable_addresses_are_rejected(self):
+        for email in ("rider@mailinator.com", "rider@sub.mailinator.com"):
+            with self.subTest(email=email):
+                form = self.form(email)
+                self.assertFalse(form.is_valid())
+                self.assertIn("email", form.errors)
+
+    def test_other_addresses_are_accepted(self):
+        form = self.form("rider@example.com")
+        form.is_valid()
+        self.assertNotIn("email", form.errors)
+
+
+class GeoIPDatabaseTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "geoip.bin")
+
+    def write(self, content, mtime):
+        with open(self.path, "wb") as database:
+            database.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_lookup(self):
+        write_geoip_database([
+            ("41.207.160.0", "41.207.191.255", "tg", "Lomé"),
+            ("2c0f:f0f8::", "2c0f:f0f8:ffff:ffff:ffff:ffff:ffff:ffff", "TG", ""),
+            ("41.207.170.0", "41.207.170.255", "BJ", "Overlap"),
+        ], self.path)
+        database = GeoIPDatabase(self.path, reload_interval=0)
+
+        self.assertEqual(database.locate("41.207.170.12"), ("TG", "Lomé"))
+        self.assertEqual(database.locate("::ffff:41.207.160.1"), ("TG", "Lomé"))
+        self.assertEqual(database.locate("2c0f:f0f8::1"), ("TG", ""))
+        self.assertIsNone(database.locate("8.8.8.8"))
+        self.assertIsNone(database.locate("not an ip"))
+
+    def test_bad_file_is_ignored(self):
+        database = GeoIPDatabase(self.path, reload_interval=0)
+        for content in (b"", b"SEFGEO01", b"NOTGEOIP" + bytes(8)):
+            self.write(content, 1000)
+            database._mtime = None
+            with self.assertLogs("coreservice.geoip_helper", "ERROR"):
+                self.assertFalse(database.available)
+            self.assertIsNone(database.locate("41.207.170.12"))
+
+        write_geoip_database([("41.207.160.0", "41.207.191.255", "TG", "Lomé")], self.path)
+        os.utime(self.path, (2000, 2000))
+        self.assertEqual(database.locate("41.207.170.12"), ("TG", "Lomé"))
+
+        # A truncated replacement keeps the previous file in service
+        with open(self.path, "rb") as database_file:
+            content = database_file.read()
+        self.write(content[:-10], 3000)
+        with self.assertLogs("coreservice.geoip_helper", "ERROR"):
+            self.assertTrue(database.available)
+        self.assertEqual(database.locate("41.207.170.12"), ("TG", "Lomé"))
+
+
+class PartitionHelperTests(TestCase):
+
+    def test_months(self):
+        self.assertEqual(month_start(date(2025, 3, 17)), date(2025, 3, 1))
+        self.assertEqual(add_months(date(2025, 11, 1), 2), date(2026, 1, 1))
+        self.assertEqual(add_months(date(2025, 1, 1), -1), date(2024, 12, 1))
+        self.assertEqual(partition_name("rides_tripevent", date(2025, 3, 1)), "rides_tripevent_p2025_03")
+
+    def test_maintenance_is_scheduled(self):
+        schedule = Schedule.objects.get(func="coreservice.partition_helper.maintain_partitions")
+        self.assertEqual(schedule.schedule_type, Schedule.DAILY)
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "partitions need PostgreSQL")
+class PostgresPartitionTests(TestCase):
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE "test_events" (id serial, at timestamptz NOT NULL) PARTITION BY RANGE (at)')
+            cursor.execute('CREATE TABLE "test_events_default" PARTITION OF "test_events" DEFAULT')
+
+    def test_ensure_partition_moves_default_rows(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO test_events (at) VALUES ('2025-03-10T12:00:00Z'), ('2025-04-10T12:00:00Z')")
+
+            self.assertTrue(ensure_partition(cursor, "test_events", "at", date(2025, 3, 1)))
+            self.assertFalse(ensure_partition(cursor, "test_events", "at", date(2025, 3, 1)))
+
+            cursor.execute("SELECT count(*) FROM test_events_p2025_03")
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("SELECT count(*) FROM test_events_default")
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("SELECT count(*) FROM test_events")
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_maintain_creates_ahead_and_archives_expired(self):
+        current = month_start(timezone.now())
+        expired = add_months(current, -3)
+        with connection.cursor() as cursor:
+            ensure_partition(cursor, "test_events", "at", expired)
+
+        tables = {"test_events": {"column": "at", "retention_months": 2}}
+        with mock.patch("coreservice.partition_helper.env_variable.PARTITIONED_TABLES", tables):
+            report = maintain_partitions(months_ahead=1)
+
+        self.assertEqual(report["created"], [partition_name("test_events", current),
+                                             partition_name("test_events", add_months(current, 1))])
+        self.assertEqual(report["archived"], [partition_name("test_events", expired)])
+        with connection.cursor() as cursor:
+            self.assertEqual(list_partitions(cursor, "test_events"), report["created"])
+            cursor.execute("SELECT to_regclass(%s)", [f"archive.{partition_name('test_events', expired)}"])
+            self.assertIsNotNone(cursor.fetchone()[0])
+
+    def test_archived_rows_do_not_block_deletes(self):
+        car_class = CarClass.objects.create(name="Eco", base_price=10, per_km_rate=2, per_hour_rate=30)
+        customer = Customer.objects.create(email="rider@example.com", phone="1")
+        booking = Booking.objects.create(reference="B1", customer=customer, booking_type="TRANSFER",
+                                         car_class=car_class, pickup_date=date(2025, 1, 1), pickup_time=day_time(10, 0),
+                                         pickup_address="Here", status="COMPLETED")
+        expired = add_months(month_start(timezone.now()), -8)
+        TripEvent.objects.create(booking=booking, kind="COMPLETED",
+                                 at=timezone.make_aware(datetime.combine(expired, day_time(12, 0))))
+        with connection.cursor() as cursor:
+            # Foreign keys are deferred: check them as they go rather than at a commit that never comes in tests
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            ensure_partition(cursor, "rides_tripevent", "at", expired)
+
+        self.assertIn(partition_name("rides_tripevent", expired), maintain_partitions()["archived"])
+
+        with connection.cursor() as cursor:
+            booking.delete()
+            cursor.execute(f'SELECT count(*) FROM archive."{partition_name("rides_tripevent", expired)}"')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+def suggestion(main, secondary="France"):
+    return {"placeId": main, "types": [], "mainText": main, "secondaryText": secondary}
+
+
+class PlacesAutocompleteCacheTests(SimpleTestCase):
+
+    def test_exact_and_prefix_hits(self):
+        places = PlacesAutocompleteCache(ttl=60, max_entries=10, page_size=5)
+        places.set("Par", "fr", [suggestion("Paris"), suggestion("Parme", "Italie")])
+
+        self.assertEqual(len(places.get(" PAR ", "fr")), 2)
+        self.assertEqual([item["mainText"] for item in places.get("pari", "fr")], ["Paris"])
+        self.assertIsNone(places.get("pari", "en"))
+        self.assertIsNone(places.get("lyon", "fr"))
+        self.assertEqual((places.hits, places.prefix_hits, places.misses), (1, 1, 2))
+
+    def test_full_pages_do_not_answer_longer_queries(self):
+        places = PlacesAutocompleteCache(ttl=60, max_entries=10, page_size=5)
+        places.set("par", "fr", [suggestion(f"Paris {district}") for district in range(1, 6)])
+
+        self.assertIsNone(places.get("paris 1", "fr"))
+        places.set("paris", "fr", [suggestion("Paris 1"), suggestion("Paris 10")])
+        self.assertEqual(len(places.get("paris 1", "fr")), 2)
+
+    def test_expired_and_evicted_entries_leave_the_trie(self):
+        places = PlacesAutocompleteCache(ttl=60, max_entries=2, page_size=5)
+        with mock.patch("coreservice.places_helper.time.monotonic", return_value=1000):
+            places.set("par", "fr", [suggestion("Paris")])
+            places.set("lyo", "fr", [suggestion("Lyon")])
+            places.get("par", "fr")  # most recently used, "lyo" goes first
+            places.set("mar", "fr", [suggestion("Marseille")])
+            self.assertEqual(places.evictions, 1)
+            self.assertIsNone(places.get("lyo", "fr"))
+            self.assertIsNotNone(places.get("par", "fr"))
+
+        with mock.patch("coreservice.places_helper.time.monotonic", return_value=1061):
+            self.assertIsNone(places.get("par", "fr"))
+            self.assertIsNone(places.get("mar", "fr"))
+        self.assertEqual(places.stats()["entries"], 0)
+        self.assertEqual(places._tries, {"fr": {}})
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def run_flight(self, call, followers=2):
+        """ Runs ``call(fn)`` in a leader and ``followers`` threads while the leader is blocked in ``fn`` """
+
+        started, release, outcomes = threading.Event(), threading.Event(), []
+        calls = []
+
+        def fn():
+            calls.append(threading.current_thread().name)
+            started.set()
+            release.wait(5)
+            if self.error:
+                raise self.error
+            return ["result"]
+
+        def worker():
+            try:
+                outcomes.append(("result", call(fn)))
+            except Exception as error:
+                outcomes.append(("error", error))
+
+        leader = threading.Thread(target=worker)
+        leader.start()
+        started.wait(5)
+        threads = [threading.Thread(target=worker) for _ in range(followers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)  # let the followers start waiting
+        released_at = time.monotonic()
+        release.set()
+        for thread in [leader] + threads:
+            thread.join(10)
+        return calls, outcomes, time.monotonic() - released_at
+
+    def test_followers_get_the_leader_result(self):
+        self.error = None
+        flight = SingleFlight()
+        calls, outcomes, _ = self.run_flight(lambda fn: flight.do("key", fn, timeout=5))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outcomes, [("result", ["result"])] * 3)
+        self.assertEqual((flight.leaders, flight.coalesced), (1, 2))
+
+    def test_errors_reach_every_waiter(self):
+        self.error = ValueError("upstream down")
+        flight = SingleFlight()
+        calls, outcomes, _ = self.run_flight(lambda fn: flight.do("key", fn, timeout=5))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([kind for kind, _ in outcomes], ["error"] * 3)
+        self.assertTrue(all(error is self.error for _, error in outcomes))
+
+    def test_shared_flight(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.error = None
+        calls, outcomes, _ = self.run_flight(
+            lambda fn: shared_single_flight("key", fn, lock_timeout=10, wait_timeout=8, poll_interval=0.01))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outcomes, [("result", ["result"])] * 3)
+
+        # A failed leader releases the waiters at once instead of after wait_timeout
+        self.error = ValueError("upstream down")
+        calls, outcomes, elapsed = self.run_flight(
+            lambda fn: shared_single_flight("key", fn, lock_timeout=10, wait_timeout=8, poll_interval=0.01))
+        self.assertEqual(len(calls), 1)
+        self.assertLess(elapsed, 2)
+        errors = sorted(type(error).__name__ for _, error in outcomes)
+        self.assertEqual(errors, ["SharedFlightFailed", "SharedFlightFailed", "ValueError"])
+        self.assertTrue(all("upstream down" in str(error) for _, error in outcomes))
+
+
+class GooglePlaceDetailsProviderTests(SimpleTestCase):
+
+    @mock.patch("coreservice.places_helper.outbound.get")
+    def test_place_id_is_escaped(self, get):
+        get.return_value = mock.Mock(status_code=404)
+        with self.assertRaises(PlaceNotFound):
+            GooglePlaceDetailsProvider().get_details("../places/x?key=1")
+        self.assertEqual(get.call_args.args[0], "https://places.googleapis.com/v1/places/..%2Fplaces%2Fx%3Fkey%3D1")
+
+
+CARD = {"brand": "visa", "last4": "4242", "exp_month": 12, "exp_year": 2030}
+
+
+class StripeCustomerTests(TestCase):
+
+    def setUp(self):
+        self.user = Customer.objects.create(email="rider@example.com", phone="1", first_name="Ama",
+                                            last_name="Mensah")
+
+    @mock.patch("coreservice.helpers.stripe.Customer.create", return_value={"id": "cus_new"})
+    @mock.patch("coreservice.helpers.stripe.Customer.search", return_value=SimpleNamespace(data=[]))
+    def test_customer_is_created_once(self, search, create):
+        manager = StripeManager()
+
+        self.assertEqual(manager.resolve_stripe_customer(self.user), "cus_new")
+        self.assertEqual(create.call_args.kwargs["idempotency_key"], f"customer-create-{self.user.pk}")
+        self.assertEqual(create.call_args.kwargs["metadata"], {"customer_id": self.user.pk})
+
+        # Later calls, even with a freshly loaded user, reuse the stored id
+        user = Customer.objects.get(pk=self.user.pk)
+        self.assertEqual(user.stripe_customer_id, "cus_new")
+        self.assertEqual(manager.resolve_stripe_customer(user), "cus_new")
+        search.assert_called_once()
+        create.assert_called_once()
+
+    @mock.patch("coreservice.helpers.stripe.Customer.create")
+    @mock.patch("coreservice.helpers.stripe.Customer.search",
+                return_value=SimpleNamespace(data=[{"id": "cus_existing"}]))
+    def test_existing_customer_is_reused(self, search, create):
+        self.assertEqual(StripeManager().resolve_stripe_customer(self.user), "cus_existing")
+        create.assert_not_called()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.stripe_customer_id, "cus_existing")
+
+
+@mock.patch("coreservice.helpers.stripe.PaymentMethod.detach")
+@mock.patch("coreservice.helpers.stripe.PaymentMethod.attach", return_value={"card": CARD})
+class StripeCardTests(TestCase):
+
+    def setUp(self):
+        self.user = Customer.objects.create(email="rider@example.com", phone="1", stripe_customer_id="cus_1")
+
+    def test_client_has_a_timeout(self, attach, detach):
+        with mock.patch("coreservice.helpers.stripe.default_http_client", None):
+            configure_stripe()
+            self.assertIsInstance(stripe.default_http_client, stripe.RequestsClient)
+            self.assertEqual(stripe.default_http_client._timeout, 8)
+        self.assertEqual(stripe.max_network_retries, 2)
+
+    async def test_card_is_attached_and_saved(self, attach, detach):
+        card = await StripeManager().aadd_payment_method(self.user, "pm_1")
+
+        self.assertEqual((card.payment_method_id, card.last4), ("pm_1", "4242"))
+        attach.assert_called_once_with("pm_1", customer="cus_1")
+        detach.assert_not_called()
+
+    async def test_failed_save_detaches_the_card(self, attach, detach):
+        with mock.patch.object(StripeManager, "save_payment_method", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                await StripeManager().aadd_payment_method(self.user, "pm_1")
+        detach.assert_called_once_with("pm_1")
+
+    @mock.patch("coreservice.helpers.stripe.Customer.modify", side_effect=stripe.error.APIConnectionError("timeout"))
+    def test_failure_after_the_save_rolls_back_both_sides(self, modify, attach, detach):
+        with self.assertRaises(stripe.error.APIConnectionError):
+            StripeManager().add_payment_method(self.user, "pm_1", make_default=True)
+
+        self.assertFalse(PaymentMethod.objects.filter(payment_method_id="pm_1").exists())
+        detach.assert_called_once_with("pm_1")
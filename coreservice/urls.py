@@ -16,6 +16,20 @@ urlpatterns = [
     path('places/', include([
 
         path('search', PlacesDropDownView.as_view(), name='search_place'),
+        path('details', PlaceDetailsView.as_view(), name='place_details'),
+
+    ])),
+
+    path('quotes/', include([
+
+        path('estimate', FareQuoteView.as_view(), name='fare_quote'),
+
+    ])),
+
+    path('monitoring/', include([
+
+        path('outbound', OutboundMetricsView.as_view(), name='outbound_metrics'),
+        path('trip-events', TripEventSearchView.as_view(), name='trip_event_search'),
 
     ])),
 
@@ -3,17 +3,21 @@ from decimal import Decimal
 import json
 import requests as makeRequests
 import stripe
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.models import Permission
 from django.contrib.humanize.templatetags.humanize import intcomma
+from django.core.exceptions import BadRequest
 from django.core.paginator import Paginator
 from django.db.models import Sum, Q, F
 from django.http import HttpResponse, JsonResponse
-from django.shortcuts import redirect, render, get_object_or_404
+from django.shortcuts import redirect, render, get_object_or_404, resolve_url
 from django.urls import reverse
 from django.utils import timezone, translation
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
 from django.utils.html import format_html
 from django.utils.text import Truncator
@@ -25,6 +29,12 @@ from django.utils.translation import gettext_lazy as _
 from accounts.models import Customer, PaymentMethod
 from coreservice.forms import LoginForm, RegistrationForm, CustomerProfileForm, EmailMarketingForm
 from coreservice.helpers import StripeManager
+from coreservice.http_helper import outbound
+from coreservice.places_helper import get_place_suggestions, places_cache, places_flight, place_resolver, \
+    PlaceNotFound, SharedFlightFailed
+from rides.bookings_helper import upcoming_bookings_page
+from rides.events_helper import parse_meta_value, query_trip_events
+from rides.pricing_helper import get_quote_engine, BOOKING_HOURLY, BOOKING_TRANSFER, parse_pickup_at
 from sefservices import settings as env_variable
 
 
@@ -66,34 +76,78 @@ class PlacesDropDownView(View):
     #login_url = 'core:login_screen'
 
     def get(self, request, *args, **kwargs):
-        query = request.GET.get("search_input")
-        endpoint = "https://places.googleapis.com/v1/places:autocomplete"
-        params = {
-            "input": query,
-            "languageCode": f"{request.LANGUAGE_CODE}",
-        }
-        headers = {
-            "Content-Type": "application/json",
-            "X-Goog-Api-Key": f"{env_variable.GOOGLE_MAP_API_KEY}",
-            "X-Goog-FieldMask": "suggestions.placePrediction.placeId,suggestions.placePrediction.types,suggestions.placePrediction.structuredFormat.mainText.text,suggestions.placePrediction.structuredFormat.secondaryText.text"
-        }
-        result = makeRequests.post(endpoint, json=params, headers=headers).json()['suggestions']
-        data = []
-
-        for i in range(len(result)):
+        query = request.GET.get("search_input", "")
 
-            print(result[i]['placePrediction']["types"])
-            data.append({
-                "placeId": result[i]['placePrediction']['placeId'],
-                "types": result[i]['placePrediction']["types"],
-                "mainText": result[i]['placePrediction']['structuredFormat']['mainText']['text'],
-                "secondaryText": result[i]['placePrediction']['structuredFormat']['secondaryText']['text'],
+        try:
+            data = get_place_suggestions(query, request.LANGUAGE_CODE)
+        except (makeRequests.RequestException, TimeoutError, ValueError, SharedFlightFailed):
+            data = []
 
-            })
         #return JsonResponse(data, safe=False)
         return render(request, 'homepage/partials/partial_places_list.html', {"places": data})
 
 
+class PlaceDetailsView(LoginRequiredMixin, View):
+    # Cache misses are billed Places details lookups
+    login_url = 'core:login_screen'
+
+    def get(self, request, *args, **kwargs):
+        place_id = request.GET.get("place_id")
+        if not place_id:
+            return JsonResponse({"status": "error"}, status=400)
+
+        try:
+            place = place_resolver.resolve(place_id)
+        except PlaceNotFound:
+            return JsonResponse({"status": "error", "message": _("Place not found")}, status=404)
+        except (makeRequests.RequestException, ValueError):
+            return JsonResponse({"status": "error"}, status=502)
+
+        return JsonResponse({
+            "status": "success",
+            "placeId": place.place_id,
+            "name": place.name,
+            "address": place.address,
+            "lat": place.lat,
+            "lng": place.lng,
+            "types": place.types,
+            "is_airport": place.is_airport,
+        })
+
+
+class FareQuoteView(View):
+
+    def get(self, request, *args, **kwargs):
+        booking_type = request.GET.get("booking_type", BOOKING_TRANSFER).upper()
+        if booking_type not in (BOOKING_TRANSFER, BOOKING_HOURLY):
+            return JsonResponse({"status": "error", "message": _("Unknown booking type")}, status=400)
+
+        pickup_at = parse_pickup_at(request.GET.get("pickup_date"), request.GET.get("pickup_time"))
+        try:
+            quotes = get_quote_engine(at=pickup_at).quote(
+                booking_type,
+                distance_km=request.GET.get("distance_km") or 0,
+                duration_hours=request.GET.get("duration_hours") or 0,
+                pickup_at=pickup_at,
+                is_airport=request.GET.get("is_airport") in ("1", "true", "on"),
+            )
+        except (ArithmeticError, ValueError):
+            return JsonResponse({"status": "error", "message": _("Invalid quote parameters")}, status=400)
+
+        return JsonResponse({
+            "status": "success",
+            "quotes": [
+                {
+                    "car_class": quote.car_class_id,
+                    "name": quote.car_class_name,
+                    "price": f"{quote.price}",
+                    "currency": quote.currency,
+                }
+                for quote in quotes
+            ],
+        })
+
+
 class LoginView(TemplateView):
     template_name = 'accounts/login.html'
 
@@ -110,24 +164,18 @@ class LoginView(TemplateView):
 
                 next_page = request.POST.get('next_page', None)
 
-                if Customer.objects.filter(email=email).exists():
-
-                    customer = get_object_or_404(Customer, email=email)
+                customer = authenticate(request, email=email, password=password)
 
-                    if authenticate(email=email, password=password):
+                if customer is not None:
 
-                        backend = 'accounts.AuthBackend.UserAuthBackend'
-                        login(request, user=customer, backend=backend)
-                        request.session['last_backend'] = backend
-
-                        if next_page:
-                            return redirect(next_page)
-                        else:
-                            return redirect('core:home_screen')
+                    backend = 'accounts.AuthBackend.UserAuthBackend'
+                    login(request, user=customer, backend=backend)
+                    request.session['last_backend'] = backend
 
+                    if next_page:
+                        return redirect(next_page)
                     else:
-                        messages.error(request, 'Email ou password incorrect')
-                        return redirect('core:login_screen')
+                        return redirect('core:home_screen')
 
                 else:
                     messages.error(request, 'Email ou password incorrect')
@@ -204,9 +252,22 @@ class UpcomingBookingView(LoginRequiredMixin, TemplateView):
     login_url = 'core:login_screen'
     template_name = 'pages/bookings.html'
 
+    def get_template_names(self):
+        # HTMX "load more" only needs the next cards
+        if self.request.headers.get('HX-Request'):
+            return ['pages/partials/partial_bookings_list.html']
+        return [self.template_name]
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
+        try:
+            page = upcoming_bookings_page(self.request.user, self.request.GET.get('cursor'))
+        except ValueError:
+            raise BadRequest(_("Invalid cursor"))
+        context['bookings'] = page.bookings
+        context['next_cursor'] = page.next_cursor
+
         return context
 
 
@@ -297,31 +358,47 @@ class PaymentMethodListView(LoginRequiredMixin, TemplateView):
         return context
 
 
-class CardAuthView(LoginRequiredMixin, View):
+def get_authenticated_customer(request):
+    return request.user if request.user.is_authenticated else None
+
+
+class CardAuthView(View):
     login_url = 'core:login_screen'
 
-    def get(self, request, *args, **kwargs):
+    async def get(self, request, *args, **kwargs):
+        user = await sync_to_async(get_authenticated_customer)(request)
+        if user is None:
+            return redirect_to_login(request.get_full_path(), resolve_url(self.login_url))
+
         payment_manager = StripeManager()
-        user = get_object_or_404(Customer, email=self.request.user.email)
-        payment_manager.create_stripe_customer(user=user)
-        setup_intent = payment_manager.create_card_intent(user=user)
+        try:
+            setup_intent = await payment_manager.acreate_card_intent(user=user)
+        except stripe.error.APIConnectionError:
+            return JsonResponse({"status": "error", "message": _("Payment provider timeout, please retry.")},
+                                status=504)
 
         return JsonResponse({"status": "success", "client_secret": f"{setup_intent.client_secret}"})
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class SavingPaymentMethodView(LoginRequiredMixin, View):
+class SavingPaymentMethodView(View):
     login_url = 'core:login_screen'
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
+        user = await sync_to_async(get_authenticated_customer)(request)
+        if user is None:
+            return redirect_to_login(request.get_full_path(), resolve_url(self.login_url))
 
         payment_method_id = request.POST.get('payment_method_id')
         status = request.POST.get('status')
 
         if status == "succeeded":
             payment_manager = StripeManager()
-            user = get_object_or_404(Customer, email=self.request.user.email)
-            payment_manager.add_payment_method(user=user, payment_method_id=payment_method_id)
+            try:
+                await payment_manager.aadd_payment_method(user=user, payment_method_id=payment_method_id)
+            except stripe.error.APIConnectionError:
+                return JsonResponse({"status": "error", "message": _("Payment provider timeout, please retry.")},
+                                    status=504)
             return JsonResponse({"status": "success", "message": _("Card added successfully.")})
         else:
             return JsonResponse({"status": "error"})
@@ -350,21 +427,57 @@ class PaymentAction(LoginRequiredMixin, DetailView):
         return None
 
 
+class OutboundMetricsView(LoginRequiredMixin, UserPassesTestMixin, View):
+    login_url = 'core:login_screen'
 
+    def test_func(self):
+        return self.request.user.is_staff
 
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({
+            "hosts": outbound.stats(),
+            "places_cache": places_cache.stats(),
+            "places_single_flight": {
+                "leaders": places_flight.leaders,
+                "coalesced": places_flight.coalesced,
+            },
+        })
 
 
+def query_datetime(request, name):
+    """ Aware datetime from an ISO 8601 query parameter, None when absent """
 
+    if not request.GET.get(name):
+        return None
+    value = parse_datetime(request.GET[name])
+    if value is None:
+        raise ValueError(f"{name} must be an ISO 8601 datetime")
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
 
 
+class TripEventSearchView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """ Staff lookup of trip events by metadata, e.g. ?meta.reason=no_show&kind=CANCELLED&since=2025-01-01T00:00 """
 
+    login_url = 'core:login_screen'
 
+    def test_func(self):
+        return self.request.user.is_staff
 
-
-
-
-
-
-
-
-
+    def get(self, request, *args, **kwargs):
+        meta = {
+            name[len('meta.'):]: parse_meta_value(value)
+            for name, value in request.GET.items() if name.startswith('meta.')
+        }
+        try:
+            events = query_trip_events(
+                meta=meta,
+                kind=request.GET.get('kind'),
+                booking=int(request.GET['booking']) if request.GET.get('booking') else None,
+                since=query_datetime(request, 'since'),
+                until=query_datetime(request, 'until'),
+                limit=int(request.GET['limit']) if request.GET.get('limit') else None,
+            )
+        except ValueError as error:
+            return JsonResponse({"status": "error", "message": str(error)}, status=400)
+
+        return JsonResponse({"status": "success", "count": len(events), "events": events})
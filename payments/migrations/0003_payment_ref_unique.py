@@ -0,0 +1,19 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:06
+
+from django.db import migrations, models
+import payments.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_stripeevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='payment_ref',
+            field=models.CharField(default=payments.models.generate_payment_ref, max_length=255, null=True, unique=True),
+        ),
+    ]
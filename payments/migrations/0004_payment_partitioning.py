@@ -0,0 +1,35 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+from coreservice.partition_helper import partition_table
+import payments.models
+
+
+def partition_payments(apps, schema_editor):
+    partition_table(schema_editor, "payments_payment", "created_at")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0003_payment_ref_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='payment_ref',
+            field=models.CharField(default=payments.models.generate_payment_ref, max_length=255, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['created_at'], name='payment_created_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(fields=('payment_ref', 'created_at'), name='payment_ref_created_uniq'),
+        ),
+        # PostgreSQL only, kept last: the copy leaves deferred foreign key checks pending
+        migrations.RunPython(partition_payments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+SCHEDULE_NAME = 'Stripe webhook events'
+
+
+def schedule_stripe_events(apps, schema_editor):
+    # Retries failed events even when no new webhook comes in to enqueue the processor
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        name=SCHEDULE_NAME,
+        defaults={'func': 'payments.task.process_stripe_events', 'schedule_type': 'I', 'minutes': 5, 'repeats': -1},
+    )
+
+
+def unschedule_stripe_events(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(name=SCHEDULE_NAME).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_payment_partitioning'),
+        ('django_q', '0018_task_success_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeevent',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(schedule_stripe_events, unschedule_stripe_events),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+
+SCHEDULE_NAME = 'Stripe payment methods'
+
+
+def schedule_reconciliation(apps, schema_editor):
+    # Every run handles what fits in STRIPE_RECONCILE_MAX_SECONDS and resumes from the saved cursor,
+    # runs between two complete passes return at once
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        name=SCHEDULE_NAME,
+        defaults={'func': 'payments.task.reconcile_payment_methods', 'schedule_type': 'I', 'minutes': 5,
+                  'repeats': -1},
+    )
+
+
+def unschedule_reconciliation(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(name=SCHEDULE_NAME).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_stripeevent_next_attempt_at'),
+        ('django_q', '0018_task_success_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(schedule_reconciliation, unschedule_reconciliation),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.23 on 2026-10-18 15:20
+
+from django.db import migrations
+
+from coreservice.partition_helper import is_partitioned, is_supported
+
+# A partitioned table only accepts unique indexes including created_at: there, every ref is also
+# inserted by trigger into a plain table keyed by the ref, so a duplicate fails like a unique index
+LOOKUP_SQL = [
+    "CREATE TABLE IF NOT EXISTS payments_paymentref (ref varchar(255) PRIMARY KEY)",
+    "INSERT INTO payments_paymentref (ref) SELECT DISTINCT payment_ref FROM payments_payment "
+    "WHERE payment_ref IS NOT NULL ON CONFLICT DO NOTHING",
+    """
+    CREATE OR REPLACE FUNCTION payments_payment_ref_unique() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO payments_paymentref (ref) VALUES (NEW.payment_ref);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "CREATE TRIGGER payment_ref_insert AFTER INSERT ON payments_payment FOR EACH ROW "
+    "WHEN (NEW.payment_ref IS NOT NULL) EXECUTE FUNCTION payments_payment_ref_unique()",
+    # save() rewrites every column, only an actual change of ref is checked
+    "CREATE TRIGGER payment_ref_update AFTER UPDATE OF payment_ref ON payments_payment FOR EACH ROW "
+    "WHEN (NEW.payment_ref IS NOT NULL AND NEW.payment_ref IS DISTINCT FROM OLD.payment_ref) "
+    "EXECUTE FUNCTION payments_payment_ref_unique()",
+]
+
+
+def enforce_unique_ref(apps, schema_editor):
+    if is_supported(schema_editor.connection):
+        with schema_editor.connection.cursor() as cursor:
+            if is_partitioned(cursor, "payments_payment"):
+                for statement in LOOKUP_SQL:
+                    cursor.execute(statement)
+                return
+    schema_editor.execute("CREATE UNIQUE INDEX IF NOT EXISTS payment_ref_uniq ON payments_payment (payment_ref)")
+
+
+def drop_unique_ref(apps, schema_editor):
+    if is_supported(schema_editor.connection):
+        schema_editor.execute("DROP TRIGGER IF EXISTS payment_ref_insert ON payments_payment")
+        schema_editor.execute("DROP TRIGGER IF EXISTS payment_ref_update ON payments_payment")
+        schema_editor.execute("DROP FUNCTION IF EXISTS payments_payment_ref_unique()")
+        schema_editor.execute("DROP TABLE IF EXISTS payments_paymentref")
+    schema_editor.execute("DROP INDEX IF EXISTS payment_ref_uniq")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_schedule_reconcile_payment_methods'),
+    ]
+
+    operations = [
+        migrations.RunPython(enforce_unique_ref, drop_unique_ref),
+    ]
@@ -1,15 +1,31 @@
 from django.db import models
-from django.db.models.signals import post_save
-from django.dispatch import receiver
 
 from accounts.models import PartnerCompany
 from rides.models import Booking
 from django.utils.translation import gettext_lazy as _
 import secrets
+import time
+
+# Crockford base32: sorts like the numbers it encodes and avoids ambiguous letters (I, L, O, U)
+REF_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def generate_payment_ref():
+    """ 48-bit millisecond timestamp + 32 random bits, as 16 time-ordered base32 characters """
+
+    value = (int(time.time() * 1000) << 32) | secrets.randbits(32)
+    chars = []
+    for _ in range(16):
+        value, index = divmod(value, 32)
+        chars.append(REF_ALPHABET[index])
+    return "".join(reversed(chars))
 
 
 class Payment(models.Model):
-    payment_ref = models.CharField(max_length=255, null=True)
+    # Generated before the INSERT (bulk_create included). The table is partitioned by month on created_at in
+    # PostgreSQL, so the constraint is on (payment_ref, created_at); the ref alone is kept unique by migration
+    # 0007 (unique index, or the payments_paymentref lookup table once partitioned)
+    payment_ref = models.CharField(max_length=255, null=True, default=generate_payment_ref)
     trx_ref = models.CharField(max_length=255, null=True)
     price_id = models.TextField(null=True)
     product_id = models.TextField(null=True)
@@ -35,6 +51,12 @@ class Payment(models.Model):
         return self.payment_ref
 
     class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["payment_ref", "created_at"], name="payment_ref_created_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["created_at"], name="payment_created_idx"),
+        ]
         default_permissions = ()
         permissions = [
             ("can_view_payment", _("Can view payment")),
@@ -43,17 +65,6 @@ class Payment(models.Model):
         ]
 
 
-@receiver(post_save, sender=Payment)
-def generate_paymentRef(sender, instance, created, **kwargs):
-    if created:
-        while True:
-            code = secrets.token_hex(8)
-            if not Payment.objects.filter(payment_ref=code).exists():
-                instance.payment_ref = str.upper(code)
-                instance.save()
-                break
-
-
 class Payout(models.Model):
     partner = models.ForeignKey(PartnerCompany, on_delete=models.PROTECT)
     period_start = models.DateField()
@@ -61,3 +72,34 @@ class Payout(models.Model):
     currency = models.CharField(max_length=3)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     generated_at = models.DateTimeField(auto_now_add=True)
+
+
+class StripeEvent(models.Model):
+    """ Inbox of raw Stripe webhook events, written once by the endpoint and processed by django-q """
+
+    class Status(models.TextChoices):
+        PENDING = "PENDING", "Pending"
+        PROCESSED = "PROCESSED", "Processed"
+        FAILED = "FAILED", "Failed"
+
+    event_id = models.CharField(max_length=255, unique=True)  # Stripe resends the same id on retries
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=12, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)  # backoff after a failed attempt
+    error = models.TextField(blank=True, default="")
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"]),
+        ]
+        default_permissions = ()
+        permissions = [
+            ("can_view_stripe_event", _("Can view stripe event")),
+        ]
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id})"
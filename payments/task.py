@@ -0,0 +1,327 @@
+import logging
+import time
+from datetime import timedelta
+
+import stripe
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from accounts.models import Customer, PaymentMethod
+from coreservice.export_helper import export_queryset
+from coreservice.helpers import configure_stripe
+from coreservice.models import AppSetting
+from payments.models import Payment, Payout, StripeEvent
+from sefservices import settings as env_variable
+
+logger = logging.getLogger(__name__)
+
+CARD_FIELDS = ('brand', 'last4', 'exp_month', 'exp_year')
+RECONCILE_STATE = 'payments.reconcile_payment_methods'  # AppSetting keeping the cursor between runs
+
+
+def checkout_session_completed(data):
+    if data.get('payment_status') not in ('paid', 'no_payment_required'):
+        return
+    lookup = Q(payment_id=data['id'])
+    if data.get('client_reference_id'):
+        lookup |= Q(payment_ref=data['client_reference_id'])
+    Payment.objects.filter(lookup).exclude(status=1).update(
+        status=1, paid_at=timezone.now(), payment_intent=data.get('payment_intent'),
+    )
+
+
+def payment_intent_succeeded(data):
+    Payment.objects.filter(payment_intent=data['id']).exclude(status=1).update(status=1, paid_at=timezone.now())
+
+
+def payment_method_attached(data):
+    card = data.get('card')
+    user = Customer.objects.filter(stripe_customer_id=data.get('customer')).first()
+    if card is None or user is None:
+        return
+    PaymentMethod.objects.update_or_create(
+        user=user,
+        payment_method_id=data['id'],
+        defaults={
+            'brand': card['brand'],
+            'last4': card['last4'],
+            'exp_month': card['exp_month'],
+            'exp_year': card['exp_year'],
+        },
+    )
+
+
+def payment_method_updated(data):
+    card = data.get('card')
+    if card is None:
+        return
+    PaymentMethod.objects.filter(payment_method_id=data['id']).update(
+        brand=card['brand'], last4=card['last4'], exp_month=card['exp_month'], exp_year=card['exp_year'],
+    )
+
+
+def payment_method_detached(data):
+    PaymentMethod.objects.filter(payment_method_id=data['id']).delete()
+
+
+def customer_updated(data):
+    default_payment_method = (data.get('invoice_settings') or {}).get('default_payment_method')
+    methods = PaymentMethod.objects.filter(user__stripe_customer_id=data['id'])
+    if default_payment_method:
+        methods.exclude(payment_method_id=default_payment_method).filter(is_default=True).update(is_default=False)
+        methods.filter(payment_method_id=default_payment_method, is_default=False).update(is_default=True)
+
+
+STRIPE_EVENT_HANDLERS = {
+    'checkout.session.completed': checkout_session_completed,
+    'checkout.session.async_payment_succeeded': checkout_session_completed,
+    'payment_intent.succeeded': payment_intent_succeeded,
+    'payment_method.attached': payment_method_attached,
+    'payment_method.updated': payment_method_updated,
+    'payment_method.automatically_updated': payment_method_updated,
+    'payment_method.detached': payment_method_detached,
+    'customer.updated': customer_updated,
+}
+
+
+def process_stripe_events(batch_size=None):
+    """
+    Applies pending webhook events in batches, oldest first.
+
+    Each batch is locked with SKIP LOCKED so concurrent workers share the backlog
+    instead of processing the same events twice. A failing event is retried by
+    later runs with an exponential backoff (STRIPE_EVENT_RETRY_DELAY) until
+    STRIPE_EVENT_MAX_ATTEMPTS, then left as FAILED for inspection. Enqueued by the
+    webhook and by the 'Stripe webhook events' django-q schedule, which picks up retries.
+    """
+
+    batch_size = batch_size or env_variable.STRIPE_EVENTS_BATCH_SIZE
+    last_id, processed = 0, 0
+    due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+
+    while True:
+        with transaction.atomic():
+            events = list(
+                StripeEvent.objects.select_for_update(skip_locked=True)
+                .filter(due, status=StripeEvent.Status.PENDING, id__gt=last_id)
+                .order_by('id')[:batch_size]
+            )
+            if not events:
+                break
+
+            for event in events:
+                handler = STRIPE_EVENT_HANDLERS.get(event.type)
+                event.attempts += 1
+                try:
+                    if handler is not None:
+                        with transaction.atomic():
+                            handler(event.payload['data']['object'])
+                except Exception as error:
+                    event.error = f"{type(error).__name__}: {error}"
+                    if event.attempts >= env_variable.STRIPE_EVENT_MAX_ATTEMPTS:
+                        event.status = StripeEvent.Status.FAILED
+                    else:
+                        delay = env_variable.STRIPE_EVENT_RETRY_DELAY * 2 ** (event.attempts - 1)
+                        event.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+                else:
+                    event.status = StripeEvent.Status.PROCESSED
+                    event.processed_at = timezone.now()
+                    event.next_attempt_at = None
+                    event.error = ""
+
+            StripeEvent.objects.bulk_update(events, ['status', 'attempts', 'next_attempt_at', 'error', 'processed_at'])
+
+        last_id = events[-1].id
+        processed += len(events)
+
+    return processed
+
+
+def list_stripe_cards(stripe_customer_id):
+    """ Returns {payment_method_id: card} for a customer, following Stripe pagination """
+
+    cards = {}
+    try:
+        for pm in stripe.PaymentMethod.list(customer=stripe_customer_id, type='card', limit=100).auto_paging_iter():
+            cards[pm['id']] = pm['card']
+    except stripe.error.InvalidRequestError as error:
+        if getattr(error, 'code', None) != 'resource_missing':
+            raise
+        # Customer deleted on Stripe: none of its cards are usable anymore
+    return cards
+
+
+def reconcile_payment_methods(chunk_size=None, max_seconds=None, restart=False):
+    """
+    Aligns accounts.PaymentMethod with the cards attached on Stripe.
+
+    Customers are walked by primary key (keyset pagination) in chunks, so memory stays
+    bounded whatever the number of customers; each chunk's differences are applied with
+    bulk create/update/delete in one transaction. Customers whose Stripe listing fails are
+    left untouched and counted as errors. Cards saved locally after a chunk's listings
+    started are neither deleted nor created twice by it.
+
+    A run stops after STRIPE_RECONCILE_MAX_SECONDS (0 for no limit) and saves its cursor,
+    so the next one resumes there instead of starting over. Once a pass is complete, new
+    passes wait STRIPE_RECONCILE_INTERVAL_HOURS unless ``restart`` is set. Meant to run from
+    `manage.py reconcilepaymentmethods` or as the 'Stripe payment methods' django-q schedule.
+    """
+
+    chunk_size = chunk_size or env_variable.STRIPE_RECONCILE_CHUNK_SIZE
+    max_seconds = env_variable.STRIPE_RECONCILE_MAX_SECONDS if max_seconds is None else max_seconds
+    configure_stripe()
+    report = {'customers': 0, 'created': 0, 'updated': 0, 'deleted': 0, 'errors': 0, 'complete': False}
+    started = time.monotonic()
+
+    state, _ = AppSetting.objects.get_or_create(name=RECONCILE_STATE)
+    last_id = 0 if restart else state.get_setting('last_id', 0)
+    finished_at = parse_datetime(state.get_setting('finished_at') or '')
+    next_pass_at = finished_at and finished_at + timedelta(hours=env_variable.STRIPE_RECONCILE_INTERVAL_HOURS)
+    if not restart and last_id == 0 and next_pass_at and next_pass_at > timezone.now():
+        report.update(seconds=0.0, customers_per_second=0.0, complete=True)
+        return report
+
+    def out_of_time():
+        # Every run reconciles at least one customer, so the cursor always moves
+        return report['customers'] and max_seconds and time.monotonic() - started >= max_seconds
+
+    while True:
+        if out_of_time():
+            break
+
+        customers = list(
+            Customer.objects.filter(id__gt=last_id, stripe_customer_id__isnull=False)
+            .exclude(stripe_customer_id='')
+            .order_by('id')
+            .values_list('id', 'stripe_customer_id')[:chunk_size]
+        )
+        if not customers:
+            state.settings.update(last_id=0, finished_at=timezone.now().isoformat())
+            state.save(update_fields=['settings'])
+            report['complete'] = True
+            break
+
+        # Cards saved locally from now on (card flow, webhook) may be missing from the listings below
+        listed_at = timezone.now()
+        remote = {}
+        for user_id, stripe_customer_id in customers:
+            # One Stripe call per customer: check the budget between calls, not only between chunks
+            if out_of_time():
+                break
+            last_id = user_id
+            report['customers'] += 1
+            try:
+                remote[user_id] = list_stripe_cards(stripe_customer_id)
+            except stripe.error.StripeError as error:
+                report['errors'] += 1
+                logger.warning("Payment methods of %s not reconciled: %s", stripe_customer_id, error)
+
+        to_create, to_update, to_delete = [], [], []
+        seen = set()
+        for payment_method in PaymentMethod.objects.filter(user_id__in=remote.keys()):
+            card = remote[payment_method.user_id].get(payment_method.payment_method_id)
+            key = (payment_method.user_id, payment_method.payment_method_id)
+            if key in seen or (card is None and payment_method.created_at < listed_at):
+                to_delete.append(payment_method.pk)
+                continue
+            seen.add(key)
+            if card is None:
+                continue
+            if any(getattr(payment_method, field) != card[field] for field in CARD_FIELDS):
+                for field in CARD_FIELDS:
+                    setattr(payment_method, field, card[field])
+                to_update.append(payment_method)
+
+        for user_id, cards in remote.items():
+            for payment_method_id, card in cards.items():
+                if (user_id, payment_method_id) not in seen:
+                    to_create.append(PaymentMethod(
+                        user_id=user_id,
+                        payment_method_id=payment_method_id,
+                        **{field: card[field] for field in CARD_FIELDS},
+                    ))
+
+        with transaction.atomic():
+            if to_create:
+                # Saved by the webhook since the rows were read: no duplicate
+                created = set(PaymentMethod.objects.filter(
+                    user_id__in={payment_method.user_id for payment_method in to_create},
+                    payment_method_id__in={payment_method.payment_method_id for payment_method in to_create},
+                ).values_list('user_id', 'payment_method_id'))
+                to_create = [payment_method for payment_method in to_create
+                             if (payment_method.user_id, payment_method.payment_method_id) not in created]
+            PaymentMethod.objects.bulk_create(to_create, batch_size=500)
+            PaymentMethod.objects.bulk_update(to_update, CARD_FIELDS, batch_size=500)
+            PaymentMethod.objects.filter(pk__in=to_delete).delete()
+            state.settings['last_id'] = last_id
+            state.save(update_fields=['settings'])
+
+        report['created'] += len(to_create)
+        report['updated'] += len(to_update)
+        report['deleted'] += len(to_delete)
+
+    report['seconds'] = round(time.monotonic() - started, 2)
+    report['customers_per_second'] = round(report['customers'] / report['seconds'], 2) if report['seconds'] else 0.0
+    logger.info("Payment methods reconciled: %s", report)
+    return report
+
+
+PAYMENT_EXPORT_COLUMNS = (
+    ('Reference', 'payment_ref'),
+    ('Booking', 'booking__reference'),
+    ('Category', 'category'),
+    ('Channel', 'channel'),
+    ('Amount', 'amount'),
+    ('Gateway fee', 'gateway_fee'),
+    ('Status', 'status'),
+    ('Paid', 'paid_at'),
+    ('Created', 'created_at'),
+)
+
+PAYOUT_EXPORT_COLUMNS = (
+    ('Partner', 'partner__name'),
+    ('Period start', 'period_start'),
+    ('Period end', 'period_end'),
+    ('Currency', 'currency'),
+    ('Amount', 'amount'),
+    ('Generated', 'generated_at'),
+)
+
+
+def export_payments(since=None, until=None, file_format='xlsx'):
+    """
+    Exports the payments created in [since, until) to the media storage.
+
+    The range is on created_at, the partition key, so only the matching months are read.
+    Meant to run from `manage.py exportdata payments` or as a django-q task of 'payments.task.export_payments'.
+    """
+
+    payments = Payment.objects.order_by('created_at', 'id')
+    if since is not None:
+        payments = payments.filter(created_at__gte=since)
+    if until is not None:
+        payments = payments.filter(created_at__lt=until)
+
+    report = export_queryset('Payments/payments', PAYMENT_EXPORT_COLUMNS, payments, file_format, title='Payments')
+    logger.info("Payments exported: %s", report)
+    return report
+
+
+def export_payouts(since=None, until=None, file_format='xlsx'):
+    """
+    Exports the payouts whose period starts in [since, until) to the media storage.
+
+    Meant to run from `manage.py exportdata payouts` or as a django-q task of 'payments.task.export_payouts'.
+    """
+
+    payouts = Payout.objects.order_by('period_start', 'id')
+    if since is not None:
+        payouts = payouts.filter(period_start__gte=since)
+    if until is not None:
+        payouts = payouts.filter(period_start__lt=until)
+
+    report = export_queryset('Payouts/payouts', PAYOUT_EXPORT_COLUMNS, payouts, file_format, title='Payouts')
+    logger.info("Payouts exported: %s", report)
+    return report
@@ -1,3 +1,204 @@
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.db import IntegrityError, transaction
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from django_q.models import Schedule
+
+from accounts.models import Customer, PaymentMethod
+from payments.models import REF_ALPHABET, Payment, StripeEvent, generate_payment_ref
+from payments.task import STRIPE_EVENT_HANDLERS, process_stripe_events, reconcile_payment_methods
+
+
+def stripe_event(event_id, event_type):
+    return StripeEvent.objects.create(event_id=event_id, type=event_type,
+                                      payload={'id': event_id, 'type': event_type, 'data': {'object': {}}})
+
+
+class ProcessStripeEventsTests(TestCase):
+
+    def test_processes_pending_events_once(self):
+        handler = mock.Mock()
+        event = stripe_event('evt_1', 'test.ok')
+        stripe_event('evt_2', 'test.unhandled')
+
+        with mock.patch.dict(STRIPE_EVENT_HANDLERS, {'test.ok': handler}):
+            self.assertEqual(process_stripe_events(), 2)
+            self.assertEqual(process_stripe_events(), 0)
+
+        handler.assert_called_once_with({})
+        event.refresh_from_db()
+        self.assertEqual(event.status, StripeEvent.Status.PROCESSED)
+        self.assertEqual(event.attempts, 1)
+
+    @mock.patch('payments.task.env_variable.STRIPE_EVENT_MAX_ATTEMPTS', 3)
+    def test_failed_event_is_retried_with_backoff(self):
+        handler = mock.Mock(side_effect=RuntimeError('boom'))
+        event = stripe_event('evt_1', 'test.fail')
+
+        with mock.patch.dict(STRIPE_EVENT_HANDLERS, {'test.fail': handler}):
+            process_stripe_events()
+            event.refresh_from_db()
+            self.assertEqual(event.status, StripeEvent.Status.PENDING)
+            self.assertEqual(event.error, 'RuntimeError: boom')
+            first_delay = event.next_attempt_at - timezone.now()
+            self.assertGreater(first_delay, timedelta(0))
+
+            # Not due yet
+            self.assertEqual(process_stripe_events(), 0)
+
+            for attempt in (2, 3):
+                StripeEvent.objects.filter(pk=event.pk).update(next_attempt_at=timezone.now())
+                self.assertEqual(process_stripe_events(), 1)
+                event.refresh_from_db()
+                self.assertEqual(event.attempts, attempt)
+
+            self.assertEqual(event.status, StripeEvent.Status.FAILED)
+            self.assertEqual(handler.call_count, 3)
+
+    def test_retries_are_scheduled(self):
+        schedule = Schedule.objects.get(func='payments.task.process_stripe_events')
+        self.assertEqual(schedule.schedule_type, Schedule.MINUTES)
+        self.assertEqual(schedule.repeats, -1)
+
+
+class ReconcilePaymentMethodsTests(TestCase):
+
+    def setUp(self):
+        self.customers = [
+            Customer.objects.create(email=f"rider{index}@example.com", phone="1", stripe_customer_id=f"cus_{index}")
+            for index in range(3)
+        ]
+        Customer.objects.create(email="nostripe@example.com", phone="1")
+        self.stale = PaymentMethod.objects.create(user=self.customers[0], payment_method_id="pm_gone", brand="visa",
+                                                  last4="1111", exp_month=1, exp_year=2030)
+        self.changed = PaymentMethod.objects.create(user=self.customers[2], payment_method_id="pm_2", brand="visa",
+                                                    last4="2222", exp_month=1, exp_year=2030)
+        self.cards = {
+            "cus_0": {},
+            "cus_1": {"pm_1": {"brand": "mastercard", "last4": "4444", "exp_month": 2, "exp_year": 2031}},
+            "cus_2": {"pm_2": {"brand": "visa", "last4": "2222", "exp_month": 12, "exp_year": 2032}},
+        }
+        patcher = mock.patch("payments.task.list_stripe_cards", side_effect=lambda customer_id: self.cards[customer_id])
+        self.list_cards = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_full_pass(self):
+        report = reconcile_payment_methods(max_seconds=0)
+
+        self.assertTrue(report["complete"])
+        self.assertEqual((report["customers"], report["created"], report["updated"], report["deleted"]), (3, 1, 1, 1))
+        self.assertFalse(PaymentMethod.objects.filter(pk=self.stale.pk).exists())
+        self.assertEqual(PaymentMethod.objects.get(payment_method_id="pm_1").user, self.customers[1])
+        self.changed.refresh_from_db()
+        self.assertEqual((self.changed.exp_month, self.changed.exp_year), (12, 2032))
+
+    def test_runs_resume_from_saved_cursor(self):
+        # Budget spent after every customer: one Stripe call per run
+        for expected in ("cus_0", "cus_1", "cus_2"):
+            report = reconcile_payment_methods(chunk_size=2, max_seconds=1e-9)
+            self.assertFalse(report["complete"])
+            self.assertEqual(self.list_cards.call_args.args, (expected,))
+        self.assertTrue(reconcile_payment_methods(max_seconds=1e-9)["complete"])
+        self.assertEqual(self.list_cards.call_count, 3)
+
+        # Complete pass: nothing until the interval has elapsed, unless restarted
+        self.assertEqual(reconcile_payment_methods()["customers"], 0)
+        self.assertEqual(reconcile_payment_methods(restart=True, max_seconds=0)["customers"], 3)
+        self.assertEqual(PaymentMethod.objects.count(), 2)
+
+
+    def test_cards_saved_during_the_listing_are_kept(self):
+        def list_cards(customer_id):
+            if customer_id == "cus_0":
+                # Added through the card flow (not in the listing yet) and through the webhook (listed)
+                PaymentMethod.objects.create(user=self.customers[0], payment_method_id="pm_new", brand="visa",
+                                             last4="3333", exp_month=1, exp_year=2030)
+                PaymentMethod.objects.create(user=self.customers[1], payment_method_id="pm_1", brand="mastercard",
+                                             last4="4444", exp_month=2, exp_year=2031)
+            return self.cards[customer_id]
+
+        self.list_cards.side_effect = list_cards
+        report = reconcile_payment_methods(max_seconds=0)
+
+        self.assertEqual((report["created"], report["deleted"]), (0, 1))
+        self.assertTrue(PaymentMethod.objects.filter(payment_method_id="pm_new").exists())
+        self.assertEqual(PaymentMethod.objects.filter(payment_method_id="pm_1").count(), 1)
+        self.assertFalse(PaymentMethod.objects.filter(pk=self.stale.pk).exists())
+
+class PaymentRefTests(TestCase):
+
+    def test_refs_are_unique(self):
+        payment = Payment.objects.create(payment_ref="REF1", category="booking")
+        payment.amount = 10
+        payment.save()
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Payment.objects.create(payment_ref="REF1", category="booking")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Payment.objects.create(payment_ref="REF2", category="booking")
+            Payment.objects.filter(pk=payment.pk).update(payment_ref="REF2")
+
+    def test_refs_are_generated_on_save(self):
+        payment = Payment(category="booking")
+        payment.save()
+        payment.refresh_from_db()
+
+        self.assertEqual(len(payment.payment_ref), 16)
+        self.assertTrue(set(payment.payment_ref) <= set(REF_ALPHABET))
+        self.assertFalse(set("ILOU") & set(payment.payment_ref))
+
+    def test_refs_sort_by_creation_time(self):
+        with mock.patch("payments.models.time.time", side_effect=[1_700_000_000.001, 1_700_000_000.002, 1_800_000_000]):
+            refs = [generate_payment_ref() for _ in range(3)]
+        self.assertEqual(sorted(refs), refs)
+
+    def test_bulk_created_payments_get_distinct_refs(self):
+        Payment.objects.bulk_create([Payment(category="booking") for _ in range(500)])
+
+        refs = list(Payment.objects.values_list("payment_ref", flat=True))
+        self.assertEqual(len(refs), 500)
+        self.assertNotIn(None, refs)
+        self.assertEqual(len(set(refs)), 500)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Payment.objects.bulk_create([Payment(category="booking"), Payment(category="booking", payment_ref=refs[0])])
+
+
+@mock.patch('payments.views.env_variable.STRIPE_ENDPOINT_SECRET', 'whsec_test')
+class StripeWebhookTests(TestCase):
+
+    def post(self, event, secret='whsec_test'):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(reverse('payments:stripe_webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    @mock.patch('payments.views.async_task')
+    def test_events_are_stored_once_and_applied(self, async_task):
+        payment = Payment.objects.create(category='booking', payment_id='cs_1')
+        event = {'id': 'evt_1', 'type': 'checkout.session.completed',
+                 'data': {'object': {'id': 'cs_1', 'payment_status': 'paid', 'payment_intent': 'pi_1',
+                                     'client_reference_id': payment.payment_ref}}}
+
+        self.assertEqual(self.post(event).status_code, 200)
+        self.assertEqual(self.post(event).status_code, 200)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+        async_task.assert_called_once_with('payments.task.process_stripe_events')
+
+        self.assertEqual(process_stripe_events(), 1)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.payment_intent), (1, 'pi_1'))
 
-# Create your tests here.
+    @mock.patch('payments.views.async_task')
+    def test_bad_signatures_are_rejected(self, async_task):
+        self.assertEqual(self.post({'id': 'evt_1', 'type': 'test'}, secret='whsec_other').status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+        async_task.assert_not_called()
@@ -0,0 +1,10 @@
+from django.urls import path
+
+from payments.views import StripeWebhookView
+
+app_name = 'payments'
+urlpatterns = [
+
+    path('stripe/webhook', StripeWebhookView.as_view(), name='stripe_webhook'),
+
+]
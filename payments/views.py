@@ -1,3 +1,39 @@
-from django.shortcuts import render
+import json
 
-# Create your views here.
+import stripe
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django_q.tasks import async_task
+
+from payments.models import StripeEvent
+from sefservices import settings as env_variable
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class StripeWebhookView(View):
+
+    def post(self, request, *args, **kwargs):
+        payload = request.body
+        signature = request.META.get('HTTP_STRIPE_SIGNATURE', '')
+
+        try:
+            stripe.Webhook.construct_event(payload, signature, env_variable.STRIPE_ENDPOINT_SECRET)
+        except (ValueError, stripe.error.SignatureVerificationError):
+            return HttpResponse(status=400)
+
+        event = json.loads(payload)
+
+        try:
+            with transaction.atomic():
+                StripeEvent.objects.create(event_id=event['id'], type=event['type'], payload=event)
+        except IntegrityError:
+            # Already received, Stripe is retrying: acknowledge without processing twice
+            return HttpResponse(status=200)
+
+        # Acknowledge right away, the event is applied by the django-q cluster
+        async_task('payments.task.process_stripe_events')
+
+        return HttpResponse(status=200)
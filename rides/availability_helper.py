@@ -0,0 +1,182 @@
+import bisect
+import threading
+import time
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from rides.models import Assignment
+from sefservices import settings as env_variable
+
+DRIVER = "driver"
+VEHICLE = "vehicle"
+
+
+class AssignmentConflict(Exception):
+    """ The driver or the vehicle is already busy during the booking """
+
+
+class AvailabilityIndex:
+    """
+    Busy intervals of drivers and vehicles, taken from their assignments.
+
+    Each driver and vehicle keeps its intervals sorted by start; they never overlap (the
+    database excludes it), so "is X free between T1 and T2" is a single bisect. A global
+    list sorted by start, together with the longest interval seen, answers "who is busy
+    in this window" by bisecting to the only intervals able to reach the window.
+    Only assignments between yesterday and AVAILABILITY_HORIZON_DAYS are loaded, queries
+    outside that range are answered by the database.
+    """
+
+    def __init__(self):
+        self._timelines = {}  # (kind, id) -> ([starts], [(start, end, booking_id)])
+        self._intervals = []  # sorted (start, end, booking_id, driver_id, vehicle_id)
+        self._bookings = {}  # booking_id -> (start, end, booking_id, driver_id, vehicle_id)
+        self._max_length = timedelta(0)
+        self._lock = threading.RLock()
+        self.covers = (None, None)
+        self.built_at = None
+
+    def __len__(self):
+        return len(self._bookings)
+
+    @staticmethod
+    def _assignments(queryset):
+        return queryset.filter(starts_at__isnull=False, ends_at__isnull=False).values_list(
+            "starts_at", "ends_at", "booking_id", "driver_id", "vehicle_id",
+        )
+
+    def rebuild(self):
+        now = timezone.now()
+        start, end = now - timedelta(days=1), now + timedelta(days=env_variable.AVAILABILITY_HORIZON_DAYS)
+        rows = self._assignments(Assignment.objects.filter(starts_at__lt=end, ends_at__gt=start))
+        with self._lock:
+            self._timelines, self._intervals, self._bookings = {}, [], {}
+            self._max_length = timedelta(0)
+            for row in sorted(rows):
+                self._add(row)
+            self.covers = (start, end)
+            self.built_at = time.monotonic()
+
+    def _add(self, row):
+        start, end, booking_id, driver_id, vehicle_id = row
+        self._bookings[booking_id] = row
+        bisect.insort(self._intervals, row)
+        self._max_length = max(self._max_length, end - start)
+        for key in ((DRIVER, driver_id), (VEHICLE, vehicle_id)):
+            starts, entries = self._timelines.setdefault(key, ([], []))
+            position = bisect.bisect_left(starts, start)
+            starts.insert(position, start)
+            entries.insert(position, (start, end, booking_id))
+
+    def remove(self, booking_id):
+        with self._lock:
+            row = self._bookings.pop(booking_id, None)
+            if row is None:
+                return
+            start, end, _, driver_id, vehicle_id = row
+            del self._intervals[bisect.bisect_left(self._intervals, row)]
+            for key in ((DRIVER, driver_id), (VEHICLE, vehicle_id)):
+                starts, entries = self._timelines[key]
+                position = entries.index((start, end, booking_id), bisect.bisect_left(starts, start))
+                del starts[position], entries[position]
+                if not starts:
+                    del self._timelines[key]
+
+    def refresh(self, booking_ids):
+        """ Re-reads the assignments of some bookings """
+
+        booking_ids = set(booking_ids)
+        if self.built_at is None or not booking_ids:
+            return
+        rows = list(self._assignments(Assignment.objects.filter(booking_id__in=booking_ids)))
+        with self._lock:
+            for booking_id in booking_ids:
+                self.remove(booking_id)
+            for row in rows:
+                self._add(row)
+
+    def _covered(self, start, end):
+        low, high = self.covers
+        return low is not None and low <= start and end <= high
+
+    def conflicts(self, kind, resource_id, start, end, ignore_booking=None):
+        """ Bookings keeping the driver (or vehicle) busy somewhere in [start, end) """
+
+        if not self._covered(start, end):
+            return list(
+                Assignment.objects.filter(**{f"{kind}_id": resource_id}, starts_at__lt=end, ends_at__gt=start)
+                .exclude(booking_id=ignore_booking).values_list("booking_id", flat=True)
+            )
+        with self._lock:
+            starts, entries = self._timelines.get((kind, resource_id), ((), ()))
+            # Intervals do not overlap, so only the one starting just before ``start`` can straddle it
+            position = max(bisect.bisect_right(starts, start) - 1, 0)
+            found = []
+            for entry_start, entry_end, booking_id in entries[position:]:
+                if entry_start >= end:
+                    break
+                if entry_end > start and booking_id != ignore_booking:
+                    found.append(booking_id)
+            return found
+
+    def is_free(self, kind, resource_id, start, end, ignore_booking=None):
+        return not self.conflicts(kind, resource_id, start, end, ignore_booking)
+
+    def busy(self, kind, start, end):
+        """ Ids of the drivers (or vehicles) busy somewhere in [start, end) """
+
+        column = 3 if kind == DRIVER else 4
+        if not self._covered(start, end):
+            return set(
+                Assignment.objects.filter(starts_at__lt=end, ends_at__gt=start).values_list(f"{kind}_id", flat=True)
+            )
+        with self._lock:
+            low = bisect.bisect_left(self._intervals, (start - self._max_length,))
+            high = bisect.bisect_left(self._intervals, (end,))
+            return {row[column] for row in self._intervals[low:high] if row[1] > start}
+
+    def free(self, kind, resource_ids, start, end):
+        """ The given drivers (or vehicles) that are free during the whole of [start, end) """
+
+        busy = self.busy(kind, start, end)
+        return [resource_id for resource_id in resource_ids if resource_id not in busy]
+
+
+availability_index = AvailabilityIndex()
+
+
+def get_availability_index():
+    """ Per-process index, rebuilt from the database every AVAILABILITY_INDEX_TTL seconds """
+
+    built_at = availability_index.built_at
+    if built_at is None or time.monotonic() - built_at > env_variable.AVAILABILITY_INDEX_TTL:
+        availability_index.rebuild()
+    return availability_index
+
+
+def assign_booking(booking, vehicle, driver=None):
+    """
+    Assigns a vehicle and its driver to a booking, raising AssignmentConflict when either is busy.
+
+    The index answers the common case without a query; concurrent assignments that slip
+    through are still rejected by the exclusion constraints of the database.
+    """
+
+    driver_id = driver.pk if driver is not None else vehicle.driver_id
+    start, end = booking.busy_interval
+    if start is not None:
+        index = get_availability_index()
+        for kind, resource_id in ((DRIVER, driver_id), (VEHICLE, vehicle.pk)):
+            if not index.is_free(kind, resource_id, start, end, ignore_booking=booking.pk):
+                raise AssignmentConflict(f"The {kind} is already assigned between {start} and {end}")
+
+    try:
+        with transaction.atomic():
+            assignment, _ = Assignment.objects.update_or_create(
+                booking=booking, defaults={"driver_id": driver_id, "vehicle": vehicle, "accepted_at": None},
+            )
+    except IntegrityError as error:
+        raise AssignmentConflict(str(error)) from error
+    return assignment
@@ -0,0 +1,57 @@
+import base64
+from collections import namedtuple
+from datetime import datetime
+
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+
+from rides.models import Booking, BookingStop
+from sefservices import settings as env_variable
+
+BookingPage = namedtuple("BookingPage", ["bookings", "next_cursor"])
+
+
+def encode_cursor(booking):
+    value = f"{booking.pickup_at.isoformat()}|{booking.pk}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """ (pickup_at, id) of the last booking of the previous page, raises ValueError when malformed """
+
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        pickup_at, booking_id = value.split("|")
+        return datetime.fromisoformat(pickup_at), int(booking_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as error:
+        raise ValueError(f"Invalid cursor {cursor!r}") from error
+
+
+def booking_cards():
+    """ Bookings with everything a booking card shows, in one query plus one for the stops """
+
+    return Booking.objects.select_related(
+        "car_class", "assignment", "assignment__driver", "assignment__vehicle",
+    ).prefetch_related(
+        Prefetch("stops", queryset=BookingStop.objects.order_by("order")),
+    )
+
+
+def upcoming_bookings_page(customer, cursor=None, size=None):
+    """
+    A page of the customer's bookings picked up from now on, soonest first.
+
+    Pages are walked with a (pickup_at, id) cursor instead of an offset, so each page is
+    a range scan of the (customer, pickup_at) index however many bookings came before.
+    """
+
+    size = size or env_variable.BOOKINGS_PAGE_SIZE
+    bookings = booking_cards().filter(customer=customer, pickup_at__gte=timezone.now())
+    if cursor:
+        pickup_at, booking_id = decode_cursor(cursor)
+        bookings = bookings.filter(Q(pickup_at__gt=pickup_at) | Q(pickup_at=pickup_at, id__gt=booking_id))
+
+    # One extra row tells whether another page follows
+    bookings = list(bookings.order_by("pickup_at", "id")[:size + 1])
+    next_cursor = encode_cursor(bookings[size - 1]) if len(bookings) > size else None
+    return BookingPage(bookings[:size], next_cursor)
@@ -0,0 +1,336 @@
+import heapq
+import math
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from accounts.models import Driver
+from rides.availability_helper import DRIVER, VEHICLE
+from rides.models import Booking, CarClass, Vehicle
+from sefservices import settings as env_variable
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+VehicleCandidate = namedtuple("VehicleCandidate", [
+    "vehicle_id", "driver_id", "car_class_id", "person_capacity", "luggage_capacity", "rating", "lat", "lng",
+])
+PlannedAssignment = namedtuple("PlannedAssignment", [
+    "booking_id", "driver_id", "vehicle_id", "starts_at", "ends_at", "deadhead_km", "cost",
+])
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def dispatchable_vehicles():
+    """ Active vehicles with a known position and an active, KYC-verified driver """
+
+    return Vehicle.objects.filter(
+        is_active=True,
+        last_lat__isnull=False,
+        last_lng__isnull=False,
+        driver__status=Driver.Status.ACTIVE,
+        driver__kyc_verified=True,
+        driver__is_blocked=False,
+    )
+
+
+class VehicleGridIndex:
+    """
+    In-memory grid of dispatchable vehicles keyed by their last known position.
+
+    Vehicles are bucketed in ``cell_degrees`` square cells; a k-nearest query scans
+    rings of cells around the pickup point and stops as soon as no unvisited cell can
+    hold a closer vehicle, so only a handful of cells are read whatever the fleet size.
+    """
+
+    def __init__(self, cell_degrees=None):
+        self.cell_degrees = cell_degrees or env_variable.DISPATCH_GRID_CELL_DEGREES
+        self._vehicles = {}  # vehicle_id -> VehicleCandidate
+        self._cells = {}  # (row, column) -> set of vehicle ids
+        self._lock = threading.RLock()
+        self.built_at = None
+
+    def __len__(self):
+        return len(self._vehicles)
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lng / self.cell_degrees))
+
+    @staticmethod
+    def _candidates(queryset):
+        rows = queryset.values_list(
+            "id", "driver_id", "car_class_id", "person_capacity", "luggage_capacity", "driver__rating",
+            "last_lat", "last_lng",
+        )
+        for row in rows:
+            yield VehicleCandidate(*row[:5], float(row[5]), row[6], row[7])
+
+    def rebuild(self, queryset=None):
+        vehicles, cells = {}, {}
+        for candidate in self._candidates(queryset if queryset is not None else dispatchable_vehicles()):
+            vehicles[candidate.vehicle_id] = candidate
+            cells.setdefault(self._cell(candidate.lat, candidate.lng), set()).add(candidate.vehicle_id)
+
+        with self._lock:
+            self._vehicles, self._cells = vehicles, cells
+            self.built_at = time.monotonic()
+
+    def refresh(self, vehicle_ids):
+        """ Re-reads some vehicles, dropping those no longer dispatchable """
+
+        vehicle_ids = set(vehicle_ids)
+        if self.built_at is None or not vehicle_ids:
+            return
+        found = list(self._candidates(dispatchable_vehicles().filter(pk__in=vehicle_ids)))
+        with self._lock:
+            for vehicle_id in vehicle_ids:
+                self.remove(vehicle_id)
+            for candidate in found:
+                self.upsert(candidate)
+
+    def upsert(self, candidate):
+        with self._lock:
+            self.remove(candidate.vehicle_id)
+            self._vehicles[candidate.vehicle_id] = candidate
+            self._cells.setdefault(self._cell(candidate.lat, candidate.lng), set()).add(candidate.vehicle_id)
+
+    def remove(self, vehicle_id):
+        with self._lock:
+            candidate = self._vehicles.pop(vehicle_id, None)
+            if candidate is None:
+                return
+            cell = self._cell(candidate.lat, candidate.lng)
+            members = self._cells.get(cell)
+            if members is not None:
+                members.discard(vehicle_id)
+                if not members:
+                    del self._cells[cell]
+
+    def update_position(self, vehicle_id, lat, lng):
+        """ Moves a known vehicle, returns False when it is not dispatchable (not indexed) """
+
+        with self._lock:
+            candidate = self._vehicles.get(vehicle_id)
+            if candidate is None:
+                return False
+            self.upsert(candidate._replace(lat=lat, lng=lng))
+            return True
+
+    def nearest(self, lat, lng, k=5, car_class=None, min_persons=0, min_luggage=0, max_distance_km=None,
+                exclude=()):
+        """ Returns up to ``k`` (distance_km, VehicleCandidate) pairs, closest first """
+
+        max_distance_km = max_distance_km or env_variable.DISPATCH_MAX_DISTANCE_KM
+        # Narrowest side of a cell, so ring distances are never overestimated
+        cell_km = self.cell_degrees * KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat), 89.0))), 0.01)
+        max_ring = int(max_distance_km / cell_km) + 1
+        center_row, center_column = self._cell(lat, lng)
+        best = []  # max-heap of (-distance, vehicle_id, candidate)
+
+        with self._lock:
+            for ring in range(max_ring + 1):
+                if len(best) >= k and (ring - 1) * cell_km > -best[0][0]:
+                    break
+                for row in range(center_row - ring, center_row + ring + 1):
+                    for column in range(center_column - ring, center_column + ring + 1):
+                        # Only the border of the ring, inner cells were scanned already
+                        if ring and center_row - ring < row < center_row + ring \
+                                and center_column - ring < column < center_column + ring:
+                            continue
+                        for vehicle_id in self._cells.get((row, column), ()):
+                            candidate = self._vehicles[vehicle_id]
+                            if vehicle_id in exclude \
+                                    or (car_class is not None and candidate.car_class_id != car_class) \
+                                    or candidate.person_capacity < min_persons \
+                                    or candidate.luggage_capacity < min_luggage:
+                                continue
+                            distance = haversine_km(lat, lng, candidate.lat, candidate.lng)
+                            if distance > max_distance_km:
+                                continue
+                            if len(best) < k:
+                                heapq.heappush(best, (-distance, vehicle_id, candidate))
+                            elif distance < -best[0][0]:
+                                heapq.heapreplace(best, (-distance, vehicle_id, candidate))
+
+        return [(-distance, candidate) for distance, _, candidate in sorted(best, reverse=True)]
+
+
+vehicle_index = VehicleGridIndex()
+
+
+def get_vehicle_index():
+    """ Per-process index, rebuilt from the database every DISPATCH_INDEX_TTL seconds """
+
+    built_at = vehicle_index.built_at
+    if built_at is None or time.monotonic() - built_at > env_variable.DISPATCH_INDEX_TTL:
+        vehicle_index.rebuild()
+    return vehicle_index
+
+
+def record_vehicle_position(vehicle_id, lat, lng, at=None):
+    """ Stores a position ping and moves the vehicle in this worker's index, unless a newer one is known """
+
+    at = at or timezone.now()
+    updated = Vehicle.objects.filter(
+        Q(last_position_at__isnull=True) | Q(last_position_at__lt=at), pk=vehicle_id,
+    ).update(last_lat=lat, last_lng=lng, last_position_at=at)
+    if updated:
+        vehicle_index.update_position(vehicle_id, lat, lng)
+
+
+# Cost of a pair that must never be matched; finite so the solver's potentials stay well defined
+INFEASIBLE = 1e9
+
+
+def hungarian(costs):
+    """
+    Minimum-cost assignment of rows to columns (Kuhn-Munkres with potentials, O(n^2 m)).
+
+    ``costs`` is a list of rows of equal length, with at most as many rows as columns.
+    Returns, for every row, the index of its column.
+    """
+
+    rows = len(costs)
+    if not rows:
+        return []
+    columns = len(costs[0])
+    u, v = [0.0] * (rows + 1), [0.0] * (columns + 1)
+    match, way = [0] * (columns + 1), [0] * (columns + 1)  # match[column] = row (1-based, 0 = free)
+
+    for row in range(1, rows + 1):
+        match[0] = row
+        current_column = 0
+        min_values, used = [math.inf] * (columns + 1), [False] * (columns + 1)
+        while True:
+            used[current_column] = True
+            current_row, delta, next_column = match[current_column], math.inf, 0
+            row_costs = costs[current_row - 1]
+            for column in range(1, columns + 1):
+                if used[column]:
+                    continue
+                reduced = row_costs[column - 1] - u[current_row] - v[column]
+                if reduced < min_values[column]:
+                    min_values[column], way[column] = reduced, current_column
+                if min_values[column] < delta:
+                    delta, next_column = min_values[column], column
+            for column in range(columns + 1):
+                if used[column]:
+                    u[match[column]] += delta
+                    v[column] -= delta
+                else:
+                    min_values[column] -= delta
+            current_column = next_column
+            if match[current_column] == 0:
+                break
+        while current_column:
+            previous = way[current_column]
+            match[current_column] = match[previous]
+            current_column = previous
+
+    assignment = [0] * rows
+    for column in range(1, columns + 1):
+        if match[column]:
+            assignment[match[column] - 1] = column - 1
+    return assignment
+
+
+def dispatch_window(start=None, window_minutes=None):
+    start = start or timezone.now()
+    return start, start + timedelta(minutes=window_minutes or env_variable.DISPATCH_WINDOW_MINUTES)
+
+
+def unassigned_bookings(start, end, lock=False):
+    """ (id, car_class_id, pickup_lat, pickup_lng, pickup_at, expected_end_at) of open bookings picked up in [start, end) """
+
+    bookings = Booking.objects.filter(
+        assignment__isnull=True, pickup_at__gte=start, pickup_at__lt=end,
+    ).exclude(status__in=Booking.CLOSED_STATUSES).order_by("pickup_at")
+    if lock:
+        # Another dispatcher run skips these bookings instead of assigning them twice
+        bookings = bookings.select_for_update(skip_locked=True, of=("self",))
+    return list(bookings.values_list("id", "car_class_id", "pickup_lat", "pickup_lng", "pickup_at", "expected_end_at"))
+
+
+def class_fits():
+    """ {booked class: [(vehicle class, penalty)]}, a booking may be served by its class or any pricier one """
+
+    prices = dict(CarClass.objects.values_list("id", "base_price"))
+    upgrade_penalty = env_variable.DISPATCH_UPGRADE_PENALTY_KM
+    return {
+        booked: [
+            (offered, 0.0 if offered == booked else upgrade_penalty)
+            for offered, offered_price in prices.items()
+            if offered == booked or offered_price > booked_price
+        ]
+        for booked, booked_price in prices.items()
+    }
+
+
+def plan_assignments(bookings, index, fits, availability):
+    """
+    Matches bookings to drivers at the lowest total cost, returns PlannedAssignment rows.
+
+    A pair costs the deadhead kilometres from the vehicle's last position to the pickup,
+    plus a class upgrade penalty and a rating penalty, both expressed in kilometres. Only
+    the DISPATCH_CANDIDATES_PER_BOOKING nearest vehicles of each fitting class are priced,
+    which keeps the matrix sparse in practice; drivers and vehicles already busy during the
+    booking are skipped, and a driver with several vehicles is one column priced with their
+    best vehicle. Bookings without coordinates or candidates stay unassigned.
+    """
+
+    k = env_variable.DISPATCH_CANDIDATES_PER_BOOKING
+    rating_weight = env_variable.DISPATCH_RATING_WEIGHT_KM
+    rows, options = [], []  # options[row] = {driver_id: (cost, deadhead_km, vehicle_id)}
+
+    for booking in bookings:
+        _, car_class_id, lat, lng, starts_at, ends_at = booking
+        if lat is None or lng is None:
+            continue
+        busy_vehicles = availability.busy(VEHICLE, starts_at, ends_at)
+        busy_drivers = availability.busy(DRIVER, starts_at, ends_at)
+        best = {}
+        for vehicle_class, penalty in fits.get(car_class_id, ()):
+            for distance, candidate in index.nearest(lat, lng, k=k, car_class=vehicle_class, exclude=busy_vehicles):
+                if candidate.driver_id in busy_drivers:
+                    continue
+                cost = distance + penalty + rating_weight * (5 - candidate.rating)
+                if candidate.driver_id not in best or cost < best[candidate.driver_id][0]:
+                    best[candidate.driver_id] = (cost, distance, candidate.vehicle_id)
+        if best:
+            rows.append(booking)
+            options.append(best)
+
+    drivers = sorted({driver_id for best in options for driver_id in best})
+    if not drivers:
+        return []
+    column_of = {driver_id: column for column, driver_id in enumerate(drivers)}
+    costs = [[INFEASIBLE] * len(drivers) for _ in options]
+    for row, best in enumerate(options):
+        for driver_id, (cost, _, _) in best.items():
+            costs[row][column_of[driver_id]] = cost
+
+    # The solver wants at most as many rows as columns
+    if len(options) > len(drivers):
+        pairs = [(row, column) for column, row in enumerate(hungarian([list(line) for line in zip(*costs)]))]
+    else:
+        pairs = list(enumerate(hungarian(costs)))
+
+    plan = []
+    for row, column in pairs:
+        if costs[row][column] >= INFEASIBLE:
+            continue
+        cost, distance, vehicle_id = options[row][drivers[column]]
+        booking_id, _, _, _, starts_at, ends_at = rows[row]
+        plan.append(PlannedAssignment(
+            booking_id, drivers[column], vehicle_id, starts_at, ends_at, round(distance, 2), round(cost, 2),
+        ))
+    return plan
@@ -0,0 +1,315 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.db import InterfaceError, OperationalError, close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from rides.dispatch_helper import vehicle_index
+from rides.models import Assignment, TripEvent, Vehicle
+from sefservices import settings as env_variable
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(Exception):
+    """ The worker holds too many unwritten events, the sender has to retry later """
+
+
+class MetaQueryError(ValueError):
+    """ A metadata filter uses a key outside TRIP_EVENT_META_KEYS, a non-scalar value or too wide a time range """
+
+
+def parse_trip_event(data):
+    """ Builds an unsaved TripEvent from one decoded NDJSON line, raises ValueError when invalid """
+
+    if not isinstance(data, dict):
+        raise ValueError("an event must be a JSON object")
+    key, booking_id, kind = data.get("key"), data.get("booking"), data.get("kind")
+    meta = data.get("meta", {})
+    if not isinstance(key, str) or not 0 < len(key) <= 64:
+        raise ValueError("key must be a string of 1 to 64 characters")
+    if not isinstance(booking_id, int) or isinstance(booking_id, bool):
+        raise ValueError("booking must be an integer")
+    if not isinstance(kind, str) or not 0 < len(kind) <= 40:
+        raise ValueError("kind must be a string of 1 to 40 characters")
+    if not isinstance(meta, dict):
+        raise ValueError("meta must be an object")
+
+    # Required: on partitioned tables the key is only unique together with "at", so a resent
+    # event must carry the same time as the first copy, never the time it is received
+    if data.get("at") is None:
+        raise ValueError("at is required")
+    at = parse_datetime(str(data["at"]))
+    if at is None:
+        raise ValueError("at must be an ISO 8601 datetime")
+    if timezone.is_naive(at):
+        at = timezone.make_aware(at)
+    now = timezone.now()
+    if not now - timedelta(hours=env_variable.TRIP_EVENTS_MAX_AGE_HOURS) <= at \
+            <= now + timedelta(seconds=env_variable.TRIP_EVENTS_MAX_SKEW_SECONDS):
+        raise ValueError("at is too far from the current time")
+
+    kind = kind.upper()
+    if kind == TripEvent.POSITION:
+        try:
+            lat, lng = float(meta["lat"]), float(meta["lng"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("a POSITION event needs numeric meta.lat and meta.lng")
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise ValueError("position out of range")
+
+    return TripEvent(booking_id=booking_id, kind=kind, at=at, meta=meta, event_key=key)
+
+
+class TripEventBuffer:
+    """
+    Per-worker buffer of incoming trip events, written with bulk_create.
+
+    A batch is flushed as soon as it reaches ``flush_size`` events or ``flush_interval``
+    seconds after its first event (a background thread covers idle periods), so the
+    database sees a few large inserts instead of one per ping, the vehicle positions of
+    the batch being applied with a single bulk update. Events are keyed by their
+    idempotency key: a resent event collapses in the buffer and is ignored by the unique
+    index once written. Past ``max_size`` pending events ``add`` raises BufferFull,
+    pushing back on the senders while the database catches up. A failed write is retried
+    with the next flush; after ``max_attempts`` failures the rows that can never be inserted
+    are singled out and dropped. Events acknowledged but still buffered are lost if the
+    worker dies, senders must not rely on them being durable before their next ping.
+    """
+
+    def __init__(self, flush_size=None, flush_interval=None, max_size=None, max_attempts=None):
+        self.flush_size = flush_size or env_variable.TRIP_EVENTS_FLUSH_SIZE
+        self.flush_interval = flush_interval or env_variable.TRIP_EVENTS_FLUSH_INTERVAL
+        self.max_size = max_size or env_variable.TRIP_EVENTS_BUFFER_MAX
+        self.max_attempts = max_attempts or env_variable.TRIP_EVENTS_MAX_ATTEMPTS
+        self._pending = {}  # event_key -> TripEvent
+        self._attempts = {}  # event_key -> failed writes
+        self._first_at = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.stats = {"received": 0, "written": 0, "flushes": 0, "rejected_full": 0, "errors": 0, "dropped": 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, events):
+        with self._lock:
+            if len(self._pending) + len(events) > self.max_size:
+                self.stats["rejected_full"] += len(events)
+                raise BufferFull(f"{len(self._pending)} events waiting to be written")
+            for event in events:
+                self._pending[event.event_key] = event
+            self.stats["received"] += len(events)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            due = len(self._pending) >= self.flush_size
+        self._ensure_flusher()
+        if due:
+            self.flush()
+
+    def _due(self):
+        return self._first_at is not None and time.monotonic() - self._first_at >= self.flush_interval
+
+    def _take(self):
+        with self._lock:
+            events, self._pending, self._first_at = list(self._pending.values()), {}, None
+        return events
+
+    def _put_back(self, events):
+        with self._lock:
+            room = self.max_size - len(self._pending)
+            for event in events[:max(room, 0)]:
+                self._pending.setdefault(event.event_key, event)
+            if self._pending and self._first_at is None:
+                self._first_at = time.monotonic()
+        if len(events) > room:
+            for event in events[max(room, 0):]:
+                self._attempts.pop(event.event_key, None)
+            logger.error("Dropped %s trip events, the buffer is full", len(events) - max(room, 0))
+
+    def flush(self):
+        """ Writes every pending event, returns how many were sent to the database """
+
+        # A single flush at a time: other requests keep buffering meanwhile
+        with self._flush_lock:
+            events = self._take()
+            if not events:
+                return 0
+            try:
+                TripEvent.objects.bulk_create(events, batch_size=1000, ignore_conflicts=True)
+            except Exception:
+                logger.exception("Could not write %s trip events, keeping them for the next flush", len(events))
+                self.stats["errors"] += 1
+                events = self._retry(events)
+                if not events:
+                    return 0
+            for event in events:
+                self._attempts.pop(event.event_key, None)
+            try:
+                record_positions(events)
+            except Exception:
+                # The next pings move the vehicles anyway, the events themselves are stored
+                logger.exception("Could not update the vehicle positions of %s trip events", len(events))
+                self.stats["errors"] += 1
+            self.stats["written"] += len(events)
+            self.stats["flushes"] += 1
+            return len(events)
+
+    def _retry(self, events):
+        """
+        Handles a failed write, returns the events written after all.
+
+        Events are put back for the next flush, until some have failed ``max_attempts``
+        times: the batch is then written in halves, recursively, to single out the rows that
+        can never be inserted (e.g. their booking was deleted meanwhile), which are dropped.
+        """
+
+        attempts = 0
+        for event in events:
+            self._attempts[event.event_key] = self._attempts.get(event.event_key, 0) + 1
+            attempts = max(attempts, self._attempts[event.event_key])
+        if attempts < self.max_attempts:
+            self._put_back(events)
+            return []
+
+        written, failed = self._write_apart(events)
+        self._put_back(failed)
+        return written
+
+    def _write_apart(self, events):
+        """ Bisects a batch, returns (written, failed) and drops the single events rejected """
+
+        try:
+            with transaction.atomic():
+                TripEvent.objects.bulk_create(events, ignore_conflicts=True)
+            return events, []
+        except (OperationalError, InterfaceError):
+            # The database is unavailable, not the rows
+            return [], events
+        except Exception as error:
+            if len(events) == 1:
+                event = events[0]
+                logger.error("Dropped trip event %s of booking %s after %s attempts: %s",
+                             event.event_key, event.booking_id, self._attempts.pop(event.event_key, 0), error)
+                self.stats["dropped"] += 1
+                return [], []
+        middle = len(events) // 2
+        written, failed = self._write_apart(events[:middle])
+        more_written, more_failed = self._write_apart(events[middle:])
+        return written + more_written, failed + more_failed
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trip-events-flusher", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while not self._wakeup.wait(self.flush_interval / 2):
+            if self._due():
+                close_old_connections()
+                self.flush()
+
+
+trip_event_buffer = TripEventBuffer()
+
+
+def record_positions(events):
+    """
+    Moves the vehicles assigned to the bookings of POSITION events to their latest ping.
+
+    One bulk update for the whole batch; the vehicle rows are locked first so a newer position
+    written meanwhile by another worker is never overwritten by an older one.
+    """
+
+    latest = {}
+    for event in events:
+        if event.kind == TripEvent.POSITION and (event.booking_id not in latest or event.at > latest[event.booking_id].at):
+            latest[event.booking_id] = event
+    if not latest:
+        return 0
+
+    positions = {}
+    for booking_id, vehicle_id in Assignment.objects.filter(booking_id__in=latest).values_list("booking_id", "vehicle_id"):
+        event = latest[booking_id]
+        if vehicle_id not in positions or event.at > positions[vehicle_id].at:
+            positions[vehicle_id] = event
+    if not positions:
+        return 0
+
+    with transaction.atomic():
+        vehicles = []
+        for vehicle in Vehicle.objects.select_for_update().filter(pk__in=positions).only("id", "last_position_at"):
+            event = positions[vehicle.pk]
+            if vehicle.last_position_at is None or vehicle.last_position_at < event.at:
+                vehicle.last_lat, vehicle.last_lng = float(event.meta["lat"]), float(event.meta["lng"])
+                vehicle.last_position_at = event.at
+                vehicles.append(vehicle)
+        Vehicle.objects.bulk_update(vehicles, ["last_lat", "last_lng", "last_position_at"])
+
+    for vehicle in vehicles:
+        vehicle_index.update_position(vehicle.pk, vehicle.last_lat, vehicle.last_lng)
+    return len(vehicles)
+
+
+def parse_meta_value(raw):
+    """ Query string value to a JSON scalar: numbers and booleans are decoded, anything else stays a string """
+
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        return raw
+    return value if isinstance(value, (str, int, float, bool)) else raw
+
+
+def query_trip_events(meta=None, kind=None, booking=None, since=None, until=None, limit=None):
+    """
+    Trip events whose metadata matches every ``meta`` key/value, most recent first.
+
+    Only whitelisted keys are accepted and the query is always bounded in time (the last
+    TRIP_EVENT_QUERY_DAYS by default, at most TRIP_EVENT_QUERY_MAX_DAYS), so it only reads
+    a few partitions. On PostgreSQL hot keys use their expression index and the other keys
+    one containment lookup backed by the jsonb_path_ops GIN index; SQLite has no
+    containment lookup and compares each key instead.
+    """
+
+    meta = meta or {}
+    unknown = sorted(set(meta) - set(env_variable.TRIP_EVENT_META_KEYS))
+    if unknown:
+        raise MetaQueryError(f"Unknown metadata keys: {', '.join(unknown)}")
+    if any(not isinstance(value, (str, int, float, bool)) for value in meta.values()):
+        raise MetaQueryError("Metadata values must be strings, numbers or booleans")
+
+    until = until or timezone.now()
+    since = since or until - timedelta(days=env_variable.TRIP_EVENT_QUERY_DAYS)
+    if since >= until:
+        raise MetaQueryError("since must be before until")
+    if until - since > timedelta(days=env_variable.TRIP_EVENT_QUERY_MAX_DAYS):
+        raise MetaQueryError(f"The time range cannot exceed {env_variable.TRIP_EVENT_QUERY_MAX_DAYS} days")
+    events = TripEvent.objects.filter(at__gte=since, at__lt=until)
+    if kind:
+        events = events.filter(kind=kind.upper())
+    if booking:
+        events = events.filter(booking_id=booking)
+
+    compared = {key: value for key, value in meta.items() if key in env_variable.TRIP_EVENT_META_INDEXED_KEYS}
+    contained = {key: value for key, value in meta.items() if key not in compared}
+    if connection.vendor != "postgresql":
+        compared, contained = meta, {}
+    for key, value in compared.items():
+        events = events.filter(**{f"meta__{key}": value})
+    if contained:
+        events = events.filter(meta__contains=contained)
+
+    limit = min(limit or env_variable.TRIP_EVENT_QUERY_LIMIT, env_variable.TRIP_EVENT_QUERY_LIMIT)
+    return list(events.order_by("-at").values("id", "booking_id", "kind", "at", "meta")[:limit])
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-18 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0003_vehicle_person_capacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='farerule',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='farerule',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
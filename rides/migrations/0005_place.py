@@ -0,0 +1,32 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0004_farerule_schedule_window'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Place',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('place_id', models.CharField(max_length=255, unique=True)),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('address', models.CharField(blank=True, default='', max_length=255)),
+                ('lat', models.FloatField()),
+                ('lng', models.FloatField()),
+                ('types', models.JSONField(default=list)),
+                ('provider', models.CharField(default='google', max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'permissions': [('can_view_place', 'Can view place'), ('can_update_place', 'Can update place'), ('can_delete_place', 'Can delete place')],
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0005_place'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vehicle',
+            name='last_lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vehicle',
+            name='last_lng',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vehicle',
+            name='last_position_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
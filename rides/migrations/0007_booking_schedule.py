@@ -0,0 +1,129 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:12
+
+from datetime import datetime, timedelta
+
+from django.db import NotSupportedError, ProgrammingError, migrations, models
+from django.utils import timezone
+
+CLOSED_STATUSES = ("CANCELLED", "COMPLETED")
+# Frozen copy of the schedule settings when this migration was written; `manage.py backfillpickupat`
+# re-syncs the bookings with the current rides.models.booking_schedule() if they change
+TRIP_AVERAGE_SPEED_KMH = 40
+TRIP_DEFAULT_MINUTES = 60
+TRIP_TURNAROUND_MINUTES = 15
+EXCLUSION_CONSTRAINTS = {
+    "assignment_driver_no_overlap": "driver_id",
+    "assignment_vehicle_no_overlap": "vehicle_id",
+}
+
+
+def booking_schedule(pickup_date, pickup_time, booking_type, duration_hours=0, distance_km=None):
+    pickup_at = timezone.make_aware(datetime.combine(pickup_date, pickup_time))
+    if booking_type == "HOURLY":
+        minutes = max(duration_hours or 0, 1) * 60
+    elif distance_km:
+        minutes = float(distance_km) / TRIP_AVERAGE_SPEED_KMH * 60
+    else:
+        minutes = TRIP_DEFAULT_MINUTES
+    return pickup_at, pickup_at + timedelta(minutes=minutes + TRIP_TURNAROUND_MINUTES)
+
+
+def backfill_schedule(apps, schema_editor):
+    Booking = apps.get_model("rides", "Booking")
+    Assignment = apps.get_model("rides", "Assignment")
+    last_id = 0
+    while True:
+        bookings = list(Booking.objects.filter(id__gt=last_id).order_by("id")[:1000])
+        if not bookings:
+            break
+        last_id = bookings[-1].id
+        for booking in bookings:
+            booking.pickup_at, booking.expected_end_at = booking_schedule(
+                booking.pickup_date, booking.pickup_time, booking.booking_type, booking.duration_hours,
+                booking.distance_km,
+            )
+        Booking.objects.bulk_update(bookings, ["pickup_at", "expected_end_at"])
+
+        by_id = {booking.id: booking for booking in bookings if booking.status not in CLOSED_STATUSES}
+        assignments = list(Assignment.objects.filter(booking_id__in=by_id))
+        for assignment in assignments:
+            booking = by_id[assignment.booking_id]
+            assignment.starts_at, assignment.ends_at = booking.pickup_at, booking.expected_end_at
+        Assignment.objects.bulk_update(assignments, ["starts_at", "ends_at"])
+
+
+def add_exclusion_constraints(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # Creating btree_gist takes a superuser, or on PostgreSQL 13+ (where it is a trusted extension) the
+    # CREATE privilege on the database. When the application role has neither, have an administrator
+    # run `CREATE EXTENSION btree_gist;` in the database before migrating.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'btree_gist'")
+        installed = cursor.fetchone() is not None
+    if not installed:
+        try:
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+        except (NotSupportedError, ProgrammingError) as error:
+            raise type(error)(
+                f"{error}\nThe assignment overlap constraints need the btree_gist extension (PostgreSQL contrib): "
+                "run `CREATE EXTENSION btree_gist;` as a superuser in this database, then migrate again."
+            ) from error
+    for name, column in EXCLUSION_CONSTRAINTS.items():
+        schema_editor.execute(
+            f"ALTER TABLE rides_assignment ADD CONSTRAINT {name} EXCLUDE USING gist "
+            f"({column} WITH =, tstzrange(starts_at, ends_at, '[)') WITH &&) "
+            f"WHERE (starts_at IS NOT NULL AND ends_at IS NOT NULL)"
+        )
+
+
+def drop_exclusion_constraints(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name in EXCLUSION_CONSTRAINTS:
+        schema_editor.execute(f"ALTER TABLE rides_assignment DROP CONSTRAINT IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0006_vehicle_last_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='expected_end_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='pickup_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='assignment',
+            index=models.Index(fields=['driver', 'starts_at'], name='assignment_driver_starts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='assignment',
+            index=models.Index(fields=['vehicle', 'starts_at'], name='assignment_vehicle_starts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['pickup_at', 'expected_end_at'], name='booking_schedule_idx'),
+        ),
+        migrations.RunPython(backfill_schedule, migrations.RunPython.noop),
+        # Existing overlapping assignments make this fail: they have to be fixed by hand first
+        migrations.RunPython(add_exclusion_constraints, drop_exclusion_constraints),
+    ]
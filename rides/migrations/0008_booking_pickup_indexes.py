@@ -0,0 +1,25 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0007_booking_schedule'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['customer', 'pickup_at'], name='booking_customer_pickup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['status', 'pickup_at'], name='booking_status_pickup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['car_class', 'pickup_at'], name='booking_class_pickup_idx'),
+        ),
+    ]
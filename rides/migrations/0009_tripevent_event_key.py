@@ -0,0 +1,24 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0008_booking_pickup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tripevent',
+            name='event_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='tripevent',
+            name='at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0009_tripevent_event_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='route_compacted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='route_polyline',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='route_times',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+from coreservice.partition_helper import partition_table
+
+
+def partition_trip_events(apps, schema_editor):
+    partition_table(schema_editor, "rides_tripevent", "at")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0010_booking_route'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tripevent',
+            name='event_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tripevent',
+            index=models.Index(fields=['booking', 'kind', 'at'], name='tripevent_booking_kind_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tripevent',
+            index=models.Index(fields=['created_at'], name='tripevent_created_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='tripevent',
+            constraint=models.UniqueConstraint(fields=('event_key', 'at'), name='tripevent_event_key_at_uniq'),
+        ),
+        # PostgreSQL only, kept last: the copy leaves deferred foreign key checks pending
+        migrations.RunPython(partition_trip_events, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:22
+
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+def add_meta_gin_index(apps, schema_editor):
+    # Serves containment (@>) lookups on any key; jsonb_path_ops is smaller and faster than the default opclass
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS tripevent_meta_gin_idx ON rides_tripevent USING gin (meta jsonb_path_ops)"
+        )
+
+
+def drop_meta_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS tripevent_meta_gin_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0011_tripevent_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tripevent',
+            index=models.Index(django.db.models.fields.json.KeyTransform('reason', 'meta'), name='tripevent_meta_reason_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tripevent',
+            index=models.Index(django.db.models.fields.json.KeyTransform('source', 'meta'), name='tripevent_meta_source_idx'),
+        ),
+        migrations.RunPython(add_meta_gin_index, drop_meta_gin_index),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.23 on 2026-10-18 15:02
+
+from django.db import migrations
+
+from coreservice.partition_helper import is_partitioned, is_supported
+
+
+def add_event_key_index(apps, schema_editor):
+    # A partitioned table only accepts unique indexes including "at" (tripevent_event_key_at_uniq)
+    if is_supported(schema_editor.connection):
+        with schema_editor.connection.cursor() as cursor:
+            if is_partitioned(cursor, "rides_tripevent"):
+                return
+    # Duplicates may have been written since 0011 dropped the index, keep the first copy
+    schema_editor.execute(
+        "DELETE FROM rides_tripevent WHERE event_key IS NOT NULL AND id NOT IN "
+        "(SELECT min(id) FROM rides_tripevent WHERE event_key IS NOT NULL GROUP BY event_key)"
+    )
+    schema_editor.execute("CREATE UNIQUE INDEX IF NOT EXISTS tripevent_event_key_uniq ON rides_tripevent (event_key)")
+
+
+def drop_event_key_index(apps, schema_editor):
+    schema_editor.execute("DROP INDEX IF EXISTS tripevent_event_key_uniq")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0012_tripevent_meta_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_event_key_index, drop_event_key_index),
+    ]
@@ -1,6 +1,8 @@
+from datetime import datetime, timedelta
 from decimal import Decimal
 
 from django.db import models
+from django.db.models.fields.json import KeyTransform
 from django.utils import timezone
 
 from accounts.models import PartnerCompany, Driver
@@ -49,6 +51,10 @@ class Vehicle(models.Model):
     person_capacity = models.PositiveSmallIntegerField(default=2)
     luggage_capacity = models.PositiveSmallIntegerField(default=2)
     is_active = models.BooleanField(default=True)
+    # Last known position, reported by the driver app
+    last_lat = models.FloatField(null=True, blank=True)
+    last_lng = models.FloatField(null=True, blank=True)
+    last_position_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self): return f"{self.make} {self.model} ({self.plate_number})"
@@ -100,6 +106,9 @@ class FareRule(models.Model):
     waiting_charge_per_minute = models.DecimalField(max_digits=7, decimal_places=2, default=Decimal("0.75"))
     # Should waiting fees count towards driver commission?
     commission_applies_to_waiting = models.BooleanField(default=True)
+    # Optional scheduling window (e.g. seasonal or event pricing)
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -116,12 +125,53 @@ class FareRule(models.Model):
         return f"{self.name} ({'active' if self.active else 'inactive'})"
 
     @classmethod
-    def get_active(cls):
-        now = timezone.now()
+    def get_active(cls, at=None):
+        # Uncached lookup, quotes should go through rides.pricing_helper.get_active_fare_rule()
+        at = at or timezone.now()
         qs = cls.objects.filter(active=True)
-        qs = qs.filter(models.Q(starts_at__isnull=True) | models.Q(starts_at__lte=now))
-        qs = qs.filter(models.Q(ends_at__isnull=True) | models.Q(ends_at__gte=now))
-        return qs.first() or cls.objects.create(name="Auto-Default")
+        qs = qs.filter(models.Q(starts_at__isnull=True) | models.Q(starts_at__lte=at))
+        qs = qs.filter(models.Q(ends_at__isnull=True) | models.Q(ends_at__gte=at))
+        return qs.first()
+
+
+class Place(models.Model):
+    place_id = models.CharField(max_length=255, unique=True)  # provider identifier (Google placeId)
+    name = models.CharField(max_length=255, blank=True, default="")
+    address = models.CharField(max_length=255, blank=True, default="")
+    lat = models.FloatField()
+    lng = models.FloatField()
+    types = models.JSONField(default=list)
+    provider = models.CharField(max_length=32, default="google")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        default_permissions = ()
+        permissions = [
+            ("can_view_place", _("Can view place")),
+            ("can_update_place", _("Can update place")),
+            ("can_delete_place", _("Can delete place")),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.place_id})"
+
+    @property
+    def is_airport(self):
+        return "airport" in self.types or "international_airport" in self.types
+
+
+def booking_schedule(pickup_date, pickup_time, booking_type, duration_hours=0, distance_km=None):
+    """ (pickup_at, expected_end_at) of a booking, the end including the turnaround before the next job """
+
+    pickup_at = timezone.make_aware(datetime.combine(pickup_date, pickup_time))
+    if booking_type == "HOURLY":
+        minutes = max(duration_hours or 0, 1) * 60
+    elif distance_km:
+        minutes = float(distance_km) / env_variable.TRIP_AVERAGE_SPEED_KMH * 60
+    else:
+        minutes = env_variable.TRIP_DEFAULT_MINUTES
+    return pickup_at, pickup_at + timedelta(minutes=minutes + env_variable.TRIP_TURNAROUND_MINUTES)
 
 
 class Booking(models.Model):
@@ -133,6 +183,8 @@ class Booking(models.Model):
     pickup_date = models.DateField()
     pickup_time = models.TimeField()
     duration_hours = models.PositiveSmallIntegerField(default=0)  # hourly bookings
+    pickup_at = models.DateTimeField(null=True, blank=True)  # kept in sync by save()
+    expected_end_at = models.DateTimeField(null=True, blank=True)
     # where
     pickup_address = models.CharField(max_length=255)
     pickup_lat = models.FloatField(null=True, blank=True)
@@ -146,11 +198,21 @@ class Booking(models.Model):
     currency = models.CharField(max_length=8, default="EUR")
     notes = models.TextField(blank=True, default="")
     status = models.CharField(max_length=100)
+    # compacted GPS trace, see rides.route_helper
+    route_polyline = models.TextField(blank=True, default="")  # Google encoded polyline of the simplified path
+    route_times = models.JSONField(default=list, blank=True)  # epoch seconds of the first point, then deltas
+    route_compacted_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["pickup_at", "expected_end_at"], name="booking_schedule_idx"),
+            models.Index(fields=["customer", "pickup_at"], name="booking_customer_pickup_idx"),
+            models.Index(fields=["status", "pickup_at"], name="booking_status_pickup_idx"),
+            models.Index(fields=["car_class", "pickup_at"], name="booking_class_pickup_idx"),
+        ]
         default_permissions = ()
         permissions = [
             ("can_add_booking", _("Can add booking")),
@@ -162,6 +224,28 @@ class Booking(models.Model):
     def __str__(self):
         return f"{self.reference} - {self.booking_type} - {self.status}"
 
+    SCHEDULE_SOURCE_FIELDS = {"pickup_date", "pickup_time", "booking_type", "duration_hours", "distance_km"}
+    CLOSED_STATUSES = ("CANCELLED", "COMPLETED")  # never dispatched, and no longer keep a driver busy
+
+    @property
+    def busy_interval(self):
+        if self.status in self.CLOSED_STATUSES:
+            return None, None
+        return self.pickup_at, self.expected_end_at
+
+    def sync_schedule(self):
+        if self.pickup_date and self.pickup_time:
+            self.pickup_at, self.expected_end_at = booking_schedule(
+                self.pickup_date, self.pickup_time, self.booking_type, self.duration_hours, self.distance_km,
+            )
+
+    def save(self, *args, **kwargs):
+        self.sync_schedule()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and self.SCHEDULE_SOURCE_FIELDS.intersection(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"pickup_at", "expected_end_at"}
+        super().save(*args, **kwargs)
+
 
 class BookingStop(models.Model):
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name="stops")
@@ -177,10 +261,22 @@ class Assignment(models.Model):
     driver = models.ForeignKey(Driver, on_delete=models.PROTECT)
     vehicle = models.ForeignKey(Vehicle, on_delete=models.PROTECT)
     accepted_at = models.DateTimeField(null=True, blank=True)
+    # Copy of the booking's busy_interval, so PostgreSQL can exclude overlaps per driver and vehicle
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        if self.booking_id:
+            self.starts_at, self.ends_at = self.booking.busy_interval
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["driver", "starts_at"], name="assignment_driver_starts_idx"),
+            models.Index(fields=["vehicle", "starts_at"], name="assignment_vehicle_starts_idx"),
+        ]
         default_permissions = ()
         permissions = [
             ("can_add_assignment", _("Can add assignment")),
@@ -191,8 +287,26 @@ class Assignment(models.Model):
 
 
 class TripEvent(models.Model):
+    POSITION = "POSITION"  # GPS ping, meta = {"lat": ..., "lng": ...}
+
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name="events")
-    at = models.DateTimeField(auto_now_add=True)
-    kind = models.CharField(max_length=40)  # ARRIVED, STARTED, COMPLETED, CANCELLED, ...
+    at = models.DateTimeField(default=timezone.now)  # when it happened on the device
+    kind = models.CharField(max_length=40)  # ARRIVED, STARTED, COMPLETED, CANCELLED, POSITION, ...
     meta = models.JSONField(default=dict)
-    created_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    event_key = models.CharField(max_length=64, null=True, blank=True)  # idempotency key from the sender
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Partitioned by month on "at" in PostgreSQL (coreservice.partition_helper): unique constraints
+        # have to include it, a resent event carries the same key and time so it still collides.
+        # Unpartitioned tables also get a unique index on event_key alone (migration 0013)
+        constraints = [
+            models.UniqueConstraint(fields=["event_key", "at"], name="tripevent_event_key_at_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["booking", "kind", "at"], name="tripevent_booking_kind_at_idx"),
+            models.Index(fields=["created_at"], name="tripevent_created_idx"),
+            # hot keys of TRIP_EVENT_META_INDEXED_KEYS, the rest of meta has a GIN index on PostgreSQL
+            models.Index(KeyTransform("reason", "meta"), name="tripevent_meta_reason_idx"),
+            models.Index(KeyTransform("source", "meta"), name="tripevent_meta_source_idx"),
+        ]
\ No newline at end of file
@@ -0,0 +1,260 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.utils import timezone
+
+from rides.models import CarClass, FareRule
+from sefservices import settings as env_variable
+
+BOOKING_TRANSFER = "TRANSFER"
+BOOKING_HOURLY = "HOURLY"
+
+CENT = Decimal("0.01")
+ZERO = Decimal("0")
+ONE = Decimal("1")
+
+FareQuote = namedtuple("FareQuote", ["car_class_id", "car_class_name", "price", "currency"])
+
+# Immutable snapshot of a FareRule, compiled once when the cache is (re)loaded
+CompiledFareRule = namedtuple("CompiledFareRule", [
+    "id", "name", "weekend_days", "night_start_hour", "night_end_hour", "waiting_free_minutes",
+    "waiting_charge_per_minute", "commission_applies_to_waiting", "starts_at", "ends_at", "multipliers",
+])
+
+
+def to_decimal(value):
+    if value is None or value == "":
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def local_weekday_hour(pickup_at):
+    if pickup_at is None:
+        pickup_at = timezone.now()
+    if timezone.is_aware(pickup_at):
+        pickup_at = timezone.localtime(pickup_at)
+    return pickup_at.weekday(), pickup_at.hour
+
+
+def parse_weekend_days(weekend_days):
+    days = set()
+    for day in str(weekend_days or "").split(","):
+        day = day.strip()
+        if day.isdigit():
+            days.add(int(day))
+    return frozenset(days)
+
+
+def build_multiplier_table(fare_rule, weekend_days):
+    """ Returns the fare multiplier of every (weekday, hour) slot, indexed by weekday * 24 + hour """
+
+    start, end = fare_rule.night_start_hour % 24, fare_rule.night_end_hour % 24
+
+    table = []
+    for weekday in range(7):
+        for hour in range(24):
+            multiplier = ONE
+            if fare_rule.night_enabled:
+                # Night window can cross midnight (e.g. 22h -> 6h)
+                is_night = start <= hour < end if start <= end else (hour >= start or hour < end)
+                if is_night:
+                    multiplier *= fare_rule.night_multiplier
+            if fare_rule.weekend_enabled and weekday in weekend_days:
+                multiplier *= fare_rule.weekend_multiplier
+            table.append(multiplier)
+
+    return tuple(table)
+
+
+def compile_fare_rule(fare_rule):
+    weekend_days = parse_weekend_days(fare_rule.weekend_days)
+    return CompiledFareRule(
+        id=fare_rule.pk,
+        name=fare_rule.name,
+        weekend_days=weekend_days,
+        night_start_hour=fare_rule.night_start_hour % 24,
+        night_end_hour=fare_rule.night_end_hour % 24,
+        waiting_free_minutes=fare_rule.waiting_free_minutes,
+        waiting_charge_per_minute=Decimal(fare_rule.waiting_charge_per_minute),
+        commission_applies_to_waiting=fare_rule.commission_applies_to_waiting,
+        starts_at=fare_rule.starts_at,
+        ends_at=fare_rule.ends_at,
+        multipliers=build_multiplier_table(fare_rule, weekend_days),
+    )
+
+
+# Per-process cache of the pricing data. FareRule/CarClass signals (rides.receivers) clear it
+# in the saving process, the TTL bounds how long other workers keep serving a stale snapshot.
+_cache_lock = threading.Lock()
+_cache = {}
+
+
+def _cached(key, loader):
+    entry = _cache.get(key)
+    now = time.monotonic()
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = loader()
+        _cache[key] = (now + env_variable.PRICING_CACHE_TTL, value)
+        return value
+
+
+def invalidate_pricing_cache(*keys):
+    with _cache_lock:
+        if keys:
+            for key in keys:
+                _cache.pop(key, None)
+        else:
+            _cache.clear()
+
+
+def _load_fare_rules():
+    rules = FareRule.objects.filter(active=True).order_by("-created_at")
+    compiled = tuple(compile_fare_rule(rule) for rule in rules)
+    # Never write from a read path: fall back to an unsaved rule carrying the model defaults
+    default = compile_fare_rule(FareRule(name="Auto-Default"))
+    return compiled, default
+
+
+def _load_car_class_rows():
+    return tuple(CarClass.objects.order_by("base_price", "id").values_list(
+        "id", "name", "base_price", "per_km_rate", "per_hour_rate", "min_hours", "airport_fee",
+    ))
+
+
+def get_active_fare_rule(at=None):
+    """ Cached equivalent of FareRule.get_active(), returns a CompiledFareRule """
+
+    at = at or timezone.now()
+    rules, default = _cached("fare_rules", _load_fare_rules)
+    for rule in rules:
+        if (rule.starts_at is None or rule.starts_at <= at) and (rule.ends_at is None or rule.ends_at >= at):
+            return rule
+    return default
+
+
+def get_quote_engine(currency="EUR", at=None):
+    """ Engine pinned to the rule in force at ``at``, or following each ride's pickup time when omitted """
+
+    return FareQuoteEngine(rows=_cached("car_classes", _load_car_class_rows),
+                           fare_rule=get_active_fare_rule(at) if at is not None else None, currency=currency)
+
+
+class FareQuoteEngine:
+    """
+    Quotes every car class for a ride in a single pass.
+
+    Class rates are loaded once into parallel columns and the night/weekend
+    multipliers are precomputed for the 168 (weekday, hour) slots, so a quote
+    is only a few Decimal operations per car class with no database access.
+    """
+
+    def __init__(self, car_classes=None, fare_rule=None, currency="EUR", rows=None):
+        if rows is None:
+            if car_classes is None:
+                car_classes = CarClass.objects.all()
+            rows = car_classes.order_by("base_price", "id").values_list(
+                "id", "name", "base_price", "per_km_rate", "per_hour_rate", "min_hours", "airport_fee",
+            )
+        # Without an explicit rule, every ride is priced with the rule in force at its pickup time
+        self.follows_pickup = fare_rule is None
+        if fare_rule is None:
+            fare_rule = get_active_fare_rule()
+        elif isinstance(fare_rule, FareRule):
+            fare_rule = compile_fare_rule(fare_rule)
+
+        self.currency = currency
+        self.fare_rule = fare_rule
+        self.car_class_ids = tuple(row[0] for row in rows)
+        self.car_class_names = tuple(row[1] for row in rows)
+        self.transfer_rates = tuple((row[2], row[3], row[6]) for row in rows)
+        self.hourly_rates = tuple((row[2], row[4], Decimal(max(row[5], 1)), row[6]) for row in rows)
+
+    def rule_at(self, pickup_at=None):
+        if self.follows_pickup and pickup_at is not None:
+            return get_active_fare_rule(at=pickup_at)
+        return self.fare_rule
+
+    def multiplier_at(self, pickup_at=None, fare_rule=None):
+        weekday, hour = local_weekday_hour(pickup_at)
+        return (fare_rule or self.rule_at(pickup_at)).multipliers[weekday * 24 + hour]
+
+    def waiting_fee(self, waiting_minutes=0, fare_rule=None):
+        fare_rule = fare_rule or self.fare_rule
+        billable = int(waiting_minutes or 0) - fare_rule.waiting_free_minutes
+        if billable <= 0:
+            return ZERO
+        return fare_rule.waiting_charge_per_minute * billable
+
+    def quote_prices(self, booking_type, distance_km=0, duration_hours=0, pickup_at=None, is_airport=False,
+                     waiting_minutes=0):
+        """ Returns one price per car class, in the same order as ``car_class_ids`` """
+
+        fare_rule = self.rule_at(pickup_at)
+        multiplier = self.multiplier_at(pickup_at, fare_rule)
+        waiting = self.waiting_fee(waiting_minutes, fare_rule)
+
+        if booking_type == BOOKING_HOURLY:
+            hours = to_decimal(duration_hours)
+            return tuple(
+                ((base + per_hour * (hours if hours > min_hours else min_hours)
+                  + (airport_fee if is_airport else ZERO)) * multiplier + waiting).quantize(CENT, ROUND_HALF_UP)
+                for base, per_hour, min_hours, airport_fee in self.hourly_rates
+            )
+
+        distance = to_decimal(distance_km)
+        return tuple(
+            ((base + per_km * distance + (airport_fee if is_airport else ZERO)) * multiplier
+             + waiting).quantize(CENT, ROUND_HALF_UP)
+            for base, per_km, airport_fee in self.transfer_rates
+        )
+
+    def quote(self, booking_type, distance_km=0, duration_hours=0, pickup_at=None, is_airport=False,
+              waiting_minutes=0):
+        prices = self.quote_prices(booking_type, distance_km, duration_hours, pickup_at, is_airport, waiting_minutes)
+        return [
+            FareQuote(car_class_id, name, price, self.currency)
+            for car_class_id, name, price in zip(self.car_class_ids, self.car_class_names, prices)
+        ]
+
+    def quote_many(self, rides):
+        """
+        Bulk quoting for re-pricing jobs.
+
+        ``rides`` is an iterable of dicts accepting the keyword arguments of
+        ``quote_prices``. Yields one tuple of prices per ride, lazily, so
+        thousands of rides can be streamed without building them all in memory.
+        Unless the engine was given a rule, each ride uses the rule in force at its ``pickup_at``.
+        """
+
+        for ride in rides:
+            yield self.quote_prices(
+                ride.get("booking_type", BOOKING_TRANSFER),
+                distance_km=ride.get("distance_km", 0),
+                duration_hours=ride.get("duration_hours", 0),
+                pickup_at=ride.get("pickup_at"),
+                is_airport=ride.get("is_airport", False),
+                waiting_minutes=ride.get("waiting_minutes", 0),
+            )
+
+
+def parse_pickup_at(pickup_date, pickup_time):
+    if not pickup_date:
+        return None
+    value = f"{pickup_date} {pickup_time or '00:00'}"
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H"):
+        try:
+            return timezone.make_aware(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return None
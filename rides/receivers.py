@@ -0,0 +1,58 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from accounts.models import Driver
+from rides.availability_helper import availability_index
+from rides.dispatch_helper import vehicle_index
+from rides.models import Assignment, Booking, FareRule, CarClass, Vehicle
+from rides.pricing_helper import invalidate_pricing_cache
+
+
+@receiver([post_save, post_delete], sender=FareRule)
+def fare_rule_changed(sender, instance, **kwargs):
+    # Invalidated before the commit, another worker could cache the old rows again
+    transaction.on_commit(partial(invalidate_pricing_cache, "fare_rules"))
+
+
+@receiver([post_save, post_delete], sender=CarClass)
+def car_class_changed(sender, instance, **kwargs):
+    transaction.on_commit(partial(invalidate_pricing_cache, "car_classes"))
+
+
+@receiver(post_save, sender=Vehicle)
+def vehicle_saved(sender, instance, **kwargs):
+    vehicle_index.refresh([instance.pk])
+
+
+@receiver(post_delete, sender=Vehicle)
+def vehicle_deleted(sender, instance, **kwargs):
+    vehicle_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Driver)
+def driver_saved(sender, instance, **kwargs):
+    # Status, KYC or rating changes affect every vehicle of the driver
+    vehicle_index.refresh(instance.vehicles.values_list("pk", flat=True))
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    # Rescheduled, extended or closed: the assignment follows the booking's busy interval
+    starts_at, ends_at = instance.busy_interval
+    if Assignment.objects.filter(booking=instance).update(starts_at=starts_at, ends_at=ends_at):
+        availability_index.refresh([instance.pk])
+
+
+@receiver(post_save, sender=Assignment)
+def assignment_saved(sender, instance, **kwargs):
+    availability_index.refresh([instance.booking_id])
+
+
+@receiver(post_delete, sender=Assignment)
+def assignment_deleted(sender, instance, **kwargs):
+    availability_index.remove(instance.booking_id)
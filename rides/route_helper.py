@@ -0,0 +1,98 @@
+import math
+
+from rides.dispatch_helper import EARTH_RADIUS_KM
+
+
+def project(points):
+    """ (lat, lng) to metres on a plane tangent to the first point, accurate enough at city scale """
+
+    if not points:
+        return []
+    lat0 = math.radians(points[0][0])
+    scale = EARTH_RADIUS_KM * 1000 * math.pi / 180
+    cos_lat0 = math.cos(lat0)
+    return [(lng * scale * cos_lat0, lat * scale) for lat, lng in points]
+
+
+def segment_distance(point, start, end):
+    (x, y), (x1, y1), (x2, y2) = point, start, end
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    if not length:
+        return math.hypot(x - x1, y - y1)
+    t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+    return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+def simplify(points, tolerance_m):
+    """
+    Indexes of the points kept by Douglas-Peucker for ``tolerance_m`` metres.
+
+    Iterative (an explicit stack of ranges) so long traces cannot hit the recursion limit.
+    """
+
+    if len(points) < 3:
+        return list(range(len(points)))
+    planar = project(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, index = 0.0, None
+        for position in range(first + 1, last):
+            distance = segment_distance(planar[position], planar[first], planar[last])
+            if distance > farthest:
+                farthest, index = distance, position
+        if index is not None and farthest > tolerance_m:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [index for index, kept in enumerate(keep) if kept]
+
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def encode_polyline(points, precision=5):
+    """ Google encoded polyline of (lat, lng) points: delta-encoded, about 4 bytes per point """
+
+    factor = 10 ** precision
+    encoded, previous_lat, previous_lng = [], 0, 0
+    for lat, lng in points:
+        lat, lng = int(round(lat * factor)), int(round(lng * factor))
+        encoded.append(_encode_value(lat - previous_lat))
+        encoded.append(_encode_value(lng - previous_lng))
+        previous_lat, previous_lng = lat, lng
+    return "".join(encoded)
+
+
+def decode_polyline(encoded, precision=5):
+    factor = 10 ** precision
+    points, values, value, shift = [], [], 0, 0
+    for character in encoded:
+        chunk = ord(character) - 63
+        value |= (chunk & 0x1F) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    lat, lng = 0, 0
+    for delta_lat, delta_lng in zip(values[::2], values[1::2]):
+        lat, lng = lat + delta_lat, lng + delta_lng
+        points.append((lat / factor, lng / factor))
+    return points
+
+
+def encode_times(times):
+    """ Epoch seconds of the first point then the gap to each following one """
+
+    seconds = [int(at.timestamp()) for at in times]
+    return [seconds[0]] + [current - previous for previous, current in zip(seconds, seconds[1:])] if seconds else []
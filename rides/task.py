@@ -0,0 +1,212 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from coreservice.export_helper import export_queryset
+from rides.availability_helper import get_availability_index
+from rides.dispatch_helper import (
+    class_fits, dispatch_window, get_vehicle_index, plan_assignments, unassigned_bookings,
+)
+from rides.models import Assignment, Booking, TripEvent, booking_schedule
+from rides.route_helper import encode_polyline, encode_times, simplify
+from sefservices import settings as env_variable
+
+logger = logging.getLogger(__name__)
+
+
+def dispatch_upcoming_bookings(window_minutes=None, dry_run=False):
+    """
+    Assigns every open booking picked up in the next DISPATCH_WINDOW_MINUTES in one batch.
+
+    The whole window is solved as a min-cost matching instead of nearest-first, so a
+    driver is not spent on a booking another driver could reach almost as cheaply.
+    Assignments are written with one bulk insert; bookings assigned concurrently (by hand
+    or by another run) and overlaps rejected by the exclusion constraints are skipped, and
+    only the assignments actually written are counted. Meant to run from
+    `manage.py dispatchbookings` or as a django-q schedule of
+    'rides.task.dispatch_upcoming_bookings'.
+    """
+
+    started = time.monotonic()
+    start, end = dispatch_window(window_minutes=window_minutes)
+
+    with transaction.atomic():
+        bookings = unassigned_bookings(start, end, lock=not dry_run)
+        availability = get_availability_index()
+        plan = plan_assignments(bookings, get_vehicle_index(), class_fits(), availability)
+        if not dry_run:
+            Assignment.objects.bulk_create(
+                [Assignment(booking_id=item.booking_id, driver_id=item.driver_id, vehicle_id=item.vehicle_id,
+                            starts_at=item.starts_at, ends_at=item.ends_at)
+                 for item in plan],
+                batch_size=500,
+                ignore_conflicts=True,
+            )
+            # ignore_conflicts returns the planned rows whether or not they were inserted
+            planned = {(item.booking_id, item.driver_id, item.vehicle_id) for item in plan}
+            assigned = sum(
+                1 for row in Assignment.objects.filter(booking_id__in=[item.booking_id for item in plan])
+                .values_list('booking_id', 'driver_id', 'vehicle_id')
+                if row in planned
+            )
+        else:
+            assigned = len(plan)
+    if not dry_run:
+        # bulk_create sends no signal
+        availability.refresh([item.booking_id for item in plan])
+
+    report = {
+        'bookings': len(bookings),
+        'assigned': assigned,
+        'deadhead_km': round(sum(item.deadhead_km for item in plan), 2),
+        'seconds': round(time.monotonic() - started, 2),
+    }
+    logger.info("Dispatched upcoming bookings%s: %s", " (dry run)" if dry_run else "", report)
+    return report
+
+
+def backfill_booking_schedule(batch_size=None, only_missing=True):
+    """
+    Recomputes pickup_at / expected_end_at (and the assignment intervals) from the booking fields.
+
+    Needed for rows written without Booking.save() (queryset.update(), raw SQL, imports)
+    or for all rows after a TIME_ZONE change. Bookings are walked by primary key in
+    batches, each written with bulk_update in its own transaction.
+    """
+
+    batch_size = batch_size or env_variable.BOOKING_BACKFILL_BATCH_SIZE
+    bookings = Booking.objects.order_by('id').only(
+        'id', 'status', 'pickup_date', 'pickup_time', 'booking_type', 'duration_hours', 'distance_km',
+        'pickup_at', 'expected_end_at',
+    )
+    if only_missing:
+        bookings = bookings.filter(pickup_at__isnull=True)
+    report = {'bookings': 0, 'updated': 0, 'assignments': 0}
+    started = time.monotonic()
+    last_id = 0
+
+    while True:
+        batch = list(bookings.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        changed = []
+        for booking in batch:
+            schedule = booking_schedule(
+                booking.pickup_date, booking.pickup_time, booking.booking_type, booking.duration_hours,
+                booking.distance_km,
+            )
+            if schedule != (booking.pickup_at, booking.expected_end_at):
+                booking.pickup_at, booking.expected_end_at = schedule
+                changed.append(booking)
+
+        by_id = {booking.id: booking for booking in changed}
+        with transaction.atomic():
+            Booking.objects.bulk_update(changed, ['pickup_at', 'expected_end_at'])
+            assignments = list(Assignment.objects.filter(booking_id__in=by_id).only('id', 'booking_id'))
+            for assignment in assignments:
+                assignment.starts_at, assignment.ends_at = by_id[assignment.booking_id].busy_interval
+            Assignment.objects.bulk_update(assignments, ['starts_at', 'ends_at'])
+
+        report['bookings'] += len(batch)
+        report['updated'] += len(changed)
+        report['assignments'] += len(assignments)
+
+    report['seconds'] = round(time.monotonic() - started, 2)
+    logger.info("Booking schedules backfilled: %s", report)
+    return report
+
+
+def compact_trip_routes(batch_size=None, tolerance_m=None):
+    """
+    Replaces the POSITION pings of closed bookings by a simplified route stored on the booking.
+
+    Each trace is simplified with Douglas-Peucker (ROUTE_SIMPLIFY_TOLERANCE_M) and kept as
+    an encoded polyline plus the timestamps of the kept points, then the raw pings are
+    deleted in the same transaction. Bookings closed less than ROUTE_COMPACTION_DELAY_MINUTES
+    ago are left for a later run, so late pings are still included. Meant to run from
+    `manage.py compactroutes` or as a django-q schedule of 'rides.task.compact_trip_routes'.
+    """
+
+    batch_size = batch_size or env_variable.ROUTE_COMPACTION_BATCH_SIZE
+    tolerance_m = tolerance_m or env_variable.ROUTE_SIMPLIFY_TOLERANCE_M
+    cutoff = timezone.now() - timedelta(minutes=env_variable.ROUTE_COMPACTION_DELAY_MINUTES)
+    report = {'bookings': 0, 'pings': 0, 'points': 0}
+    started = time.monotonic()
+    last_id = 0
+
+    while True:
+        with transaction.atomic():
+            bookings = list(
+                Booking.objects.select_for_update(skip_locked=True)
+                .filter(id__gt=last_id, status__in=Booking.CLOSED_STATUSES, route_compacted_at__isnull=True,
+                        updated_at__lte=cutoff)
+                .order_by('id').only('id')[:batch_size]
+            )
+            if not bookings:
+                break
+            last_id = bookings[-1].id
+
+            pings = TripEvent.objects.filter(booking__in=bookings, kind=TripEvent.POSITION)
+            traces = {}
+            for booking_id, at, meta in pings.order_by('booking_id', 'at', 'id').values_list('booking_id', 'at', 'meta'):
+                traces.setdefault(booking_id, []).append((at, (float(meta['lat']), float(meta['lng']))))
+
+            now = timezone.now()
+            for booking in bookings:
+                trace = traces.get(booking.id, [])
+                kept = [trace[index] for index in simplify([point for _, point in trace], tolerance_m)]
+                booking.route_polyline = encode_polyline([point for _, point in kept])
+                booking.route_times = encode_times([at for at, _ in kept])
+                booking.route_compacted_at = now
+                report['points'] += len(kept)
+
+            Booking.objects.bulk_update(bookings, ['route_polyline', 'route_times', 'route_compacted_at'])
+            deleted, _ = pings.delete()
+
+        report['bookings'] += len(bookings)
+        report['pings'] += deleted
+
+    report['seconds'] = round(time.monotonic() - started, 2)
+    logger.info("Trip routes compacted: %s", report)
+    return report
+
+
+BOOKING_EXPORT_COLUMNS = (
+    ('Reference', 'reference'),
+    ('Pickup', 'pickup_at'),
+    ('Type', 'booking_type'),
+    ('Class', 'car_class__name'),
+    ('Customer', 'customer__email'),
+    ('Pickup address', 'pickup_address'),
+    ('Dropoff address', 'dropoff_address'),
+    ('Distance (km)', 'distance_km'),
+    ('Estimated price', 'estimated_price'),
+    ('Currency', 'currency'),
+    ('Status', 'status'),
+    ('Created', 'created_at'),
+)
+
+
+def export_bookings(since=None, until=None, file_format='xlsx'):
+    """
+    Exports the bookings picked up in [since, until) to the media storage.
+
+    Rows are read as tuples through a chunked iterator and streamed to the file, which is
+    uploaded while it is written, so the worker's memory does not grow with the range.
+    Meant to run from `manage.py exportdata bookings` or as a django-q task of 'rides.task.export_bookings'.
+    """
+
+    bookings = Booking.objects.order_by('pickup_at', 'id')
+    if since is not None:
+        bookings = bookings.filter(pickup_at__gte=since)
+    if until is not None:
+        bookings = bookings.filter(pickup_at__lt=until)
+
+    report = export_queryset('Bookings/bookings', BOOKING_EXPORT_COLUMNS, bookings, file_format, title='Bookings')
+    logger.info("Bookings exported: %s", report)
+    return report
@@ -1,3 +1,630 @@
-from django.test import TestCase
+import itertools
+import json
+import random
+import unittest
+from datetime import date, time, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import Customer, Driver, PartnerCompany
+from coreservice.partition_helper import is_partitioned, is_supported
+from rides.availability_helper import (
+    DRIVER, VEHICLE, AssignmentConflict, AvailabilityIndex, assign_booking, availability_index,
+)
+from rides.bookings_helper import decode_cursor, encode_cursor, upcoming_bookings_page
+from rides.dispatch_helper import (
+    INFEASIBLE, PlannedAssignment, VehicleCandidate, VehicleGridIndex, haversine_km, hungarian,
+)
+from rides.events_helper import MetaQueryError, TripEventBuffer, parse_trip_event, query_trip_events, record_positions
+from rides.models import Assignment, Booking, BookingStop, CarClass, FareRule, TripEvent, Vehicle, booking_schedule
+from rides.pricing_helper import (
+    BOOKING_HOURLY, BOOKING_TRANSFER, FareQuoteEngine, get_active_fare_rule, get_quote_engine, invalidate_pricing_cache,
+)
+from rides.route_helper import decode_polyline, encode_polyline, encode_times, simplify
+from rides.task import backfill_booking_schedule, dispatch_upcoming_bookings
+from rides.tracking_helper import LocalBroker, PostgresBroker, TrackingHub, event_message, position_message
+
+
+class FareQuoteEngineTests(TestCase):
+
+    def setUp(self):
+        invalidate_pricing_cache()
+        self.addCleanup(invalidate_pricing_cache)
+        self.eco = CarClass.objects.create(name="Eco", base_price=Decimal("10"), per_km_rate=Decimal("2"),
+                                           per_hour_rate=Decimal("30"), min_hours=2, airport_fee=Decimal("5"))
+        self.van = CarClass.objects.create(name="Van", base_price=Decimal("20"), per_km_rate=Decimal("3"),
+                                           per_hour_rate=Decimal("40"), min_hours=3)
+        self.flat = FareRule.objects.create(name="Flat", night_enabled=False, weekend_enabled=False,
+                                            waiting_free_minutes=5, waiting_charge_per_minute=Decimal("1"))
+        # Every day counts as weekend from next week on, so the seasonal rule doubles every price
+        self.season_start = timezone.now() + timedelta(days=7)
+        self.season = FareRule.objects.create(name="Season", night_enabled=False, weekend_days="0,1,2,3,4,5,6",
+                                              weekend_multiplier=Decimal("2"), starts_at=self.season_start)
+
+    def test_transfer_and_hourly_prices(self):
+        engine = FareQuoteEngine(fare_rule=self.flat)
+        now = timezone.now()
+
+        self.assertEqual(engine.quote_prices(BOOKING_TRANSFER, distance_km="12.5", pickup_at=now),
+                         (Decimal("35.00"), Decimal("57.50")))
+        self.assertEqual(engine.quote_prices(BOOKING_TRANSFER, distance_km=10, pickup_at=now, is_airport=True,
+                                             waiting_minutes=8),
+                         (Decimal("38.00"), Decimal("53.00")))
+        # Hourly rides are billed at least min_hours
+        self.assertEqual(engine.quote_prices(BOOKING_HOURLY, duration_hours=1, pickup_at=now),
+                         (Decimal("70.00"), Decimal("140.00")))
+
+    def test_rule_in_force_at_pickup(self):
+        now = timezone.now()
+        later = self.season_start + timedelta(hours=1)
+
+        self.assertEqual(get_active_fare_rule(at=now).id, self.flat.id)
+        self.assertEqual(get_active_fare_rule(at=later).id, self.season.id)
+        self.assertEqual(get_quote_engine(at=later).quote(BOOKING_TRANSFER, distance_km=5, pickup_at=later)[0].price,
+                         Decimal("40.00"))
+
+        prices = list(get_quote_engine().quote_many([
+            {"distance_km": 5, "pickup_at": now},
+            {"distance_km": 5, "pickup_at": later},
+        ]))
+        self.assertEqual([ride[0] for ride in prices], [Decimal("20.00"), Decimal("40.00")])
+
+    def test_rule_changes_invalidate_cache(self):
+        later = self.season_start + timedelta(hours=1)
+        self.assertEqual(get_active_fare_rule(at=later).id, self.season.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.season.active = False
+            self.season.save()
+            # Until the commit other workers still read the old rows, so the cache is kept
+            self.assertEqual(get_active_fare_rule(at=later).id, self.season.id)
+        self.assertEqual(get_active_fare_rule(at=later).id, self.flat.id)
+
+    def test_car_class_changes_invalidate_cache_on_commit(self):
+        now = timezone.now()
+
+        def eco_price():
+            quotes = get_quote_engine(at=now).quote(BOOKING_TRANSFER, distance_km=5, pickup_at=now)
+            return next(quote.price for quote in quotes if quote.car_class_id == self.eco.id)
+
+        self.assertEqual(eco_price(), Decimal("20.00"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.eco.base_price = Decimal("12")
+            self.eco.save()
+            self.assertEqual(eco_price(), Decimal("20.00"))
+        self.assertEqual(eco_price(), Decimal("22.00"))
+
+
+class BookingScheduleTests(TestCase):
+
+    def test_expected_end(self):
+        pickup_at, end = booking_schedule(date(2025, 3, 1), time(10, 0), "TRANSFER", distance_km=Decimal("20"))
+        self.assertEqual(end - pickup_at, timedelta(minutes=30 + 15))
+        pickup_at, end = booking_schedule(date(2025, 3, 1), time(10, 0), "HOURLY", duration_hours=3)
+        self.assertEqual(end - pickup_at, timedelta(hours=3, minutes=15))
+        pickup_at, end = booking_schedule(date(2025, 3, 1), time(10, 0), "TRANSFER")
+        self.assertEqual(end - pickup_at, timedelta(minutes=60 + 15))
+
+
+class UpcomingBookingsPageTests(TestCase):
+
+    def setUp(self):
+        self.car_class = CarClass.objects.create(name="Eco", base_price=Decimal("10"), per_km_rate=Decimal("2"),
+                                                 per_hour_rate=Decimal("30"))
+        self.partner = PartnerCompany.objects.create(name="Partner", country="FR")
+        self.customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.tomorrow = date.today() + timedelta(days=1)
+
+    def book(self, index, pickup_time, customer=None):
+        return Booking.objects.create(reference=f"B{index}", customer=customer or self.customer,
+                                      booking_type="TRANSFER", car_class=self.car_class, pickup_date=self.tomorrow,
+                                      pickup_time=pickup_time, pickup_address="Here", status="CONFIRMED")
+
+    def test_cards_are_loaded_in_two_queries(self):
+        for index in range(4):
+            booking = self.book(index, time(8 + 3 * index, 0))
+            for order in range(2):
+                BookingStop.objects.create(booking=booking, order=order, label=f"Stop {order}")
+            driver = Driver.objects.create(email=f"driver{index}@example.com", phone="1", partner=self.partner)
+            vehicle = Vehicle.objects.create(name="Car", car_class=self.car_class, partner=self.partner,
+                                             driver=driver, make="Skoda", model="Octavia", year=2022,
+                                             plate_number=f"AB-12{index}-CD")
+            Assignment.objects.create(booking=booking, driver=driver, vehicle=vehicle)
+
+        with self.assertNumQueries(2):
+            page = upcoming_bookings_page(self.customer, size=10)
+            cards = [(booking.car_class.name, [stop.label for stop in booking.stops.all()],
+                      booking.assignment.driver.email, booking.assignment.vehicle.plate_number)
+                     for booking in page.bookings]
+
+        self.assertEqual(len(cards), 4)
+        self.assertEqual(cards[0], ("Eco", ["Stop 0", "Stop 1"], "driver0@example.com", "AB-120-CD"))
+        self.assertIsNone(page.next_cursor)
+
+    def test_pages_split_bookings_picked_up_at_the_same_time(self):
+        other = Customer.objects.create(email="other@example.com", phone="2")
+        self.book(0, time(12, 0), customer=other)
+        self.book(1, time(9, 0))
+        for index in range(2, 7):
+            self.book(index, time(10, 0))
+        Booking.objects.create(reference="Past", customer=self.customer, booking_type="TRANSFER",
+                               car_class=self.car_class, pickup_date=date.today() - timedelta(days=1),
+                               pickup_time=time(10, 0), pickup_address="Here", status="CONFIRMED")
+
+        seen, cursor = [], None
+        while True:
+            page = upcoming_bookings_page(self.customer, cursor=cursor, size=2)
+            self.assertLessEqual(len(page.bookings), 2)
+            seen += [booking.reference for booking in page.bookings]
+            if page.next_cursor is None:
+                break
+            self.assertEqual(decode_cursor(page.next_cursor),
+                             (page.bookings[-1].pickup_at, page.bookings[-1].pk))
+            cursor = page.next_cursor
+
+        expected = Booking.objects.filter(customer=self.customer, pickup_date=self.tomorrow).order_by("pickup_at", "id")
+        self.assertEqual(seen, [booking.reference for booking in expected])
+        self.assertEqual(len(seen), 6)
+
+    def test_malformed_cursors(self):
+        booking = self.book(0, time(10, 0))
+        self.assertEqual(decode_cursor(encode_cursor(booking)), (booking.pickup_at, booking.pk))
+        for cursor in ("", "!!!", "bm90LWEtY3Vyc29y", encode_cursor(booking)[:-3], "MjAyNXwxfDI"):
+            with self.subTest(cursor=cursor), self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class TripEventIngestTests(TestCase):
+
+    def setUp(self):
+        car_class = CarClass.objects.create(name="Eco", base_price=Decimal("10"), per_km_rate=Decimal("2"),
+                                            per_hour_rate=Decimal("30"))
+        partner = PartnerCompany.objects.create(name="Partner", country="FR")
+        driver = Driver.objects.create(email="driver@example.com", phone="1", partner=partner)
+        customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.vehicle = Vehicle.objects.create(name="Car", car_class=car_class, partner=partner, driver=driver,
+                                              make="Skoda", model="Octavia", year=2022, plate_number="AB-123-CD")
+        self.booking = Booking.objects.create(reference="B1", customer=customer, booking_type="TRANSFER",
+                                              car_class=car_class, pickup_date=date.today(), pickup_time=time(10, 0),
+                                              pickup_address="Here", status="CONFIRMED")
+        Assignment.objects.create(booking=self.booking, driver=driver, vehicle=self.vehicle)
+
+        self.buffer = TripEventBuffer(flush_size=100, flush_interval=60, max_size=100)
+        for patcher in (mock.patch("rides.views.trip_event_buffer", self.buffer),
+                        mock.patch.object(TripEventBuffer, "_ensure_flusher"),
+                        mock.patch("rides.views.env_variable.TRIP_EVENTS_TOKEN", "secret")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def position(self, key, at, lat, lng):
+        return {"key": key, "booking": self.booking.pk, "kind": "POSITION", "at": at.isoformat(),
+                "meta": {"lat": lat, "lng": lng}}
+
+    def post(self, *events):
+        return self.client.post(reverse("rides:trip_events"), "\n".join(json.dumps(event) for event in events),
+                                content_type="application/x-ndjson", HTTP_AUTHORIZATION="Bearer secret")
+
+    def test_resent_events_are_stored_once(self):
+        at = timezone.now().replace(microsecond=0)
+        events = [self.position("k1", at, 48.85, 2.35), self.position("k2", at + timedelta(seconds=5), 48.86, 2.36)]
+
+        self.assertEqual(self.post(*events).status_code, 202)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.post(*events).json()["accepted"], 2)
+        self.buffer.flush()
+
+        self.assertEqual(TripEvent.objects.filter(booking=self.booking).count(), 2)
+        self.vehicle.refresh_from_db()
+        self.assertEqual((self.vehicle.last_lat, self.vehicle.last_lng), (48.86, 2.36))
+
+    def test_rows_that_never_insert_are_dropped(self):
+        at = timezone.now()
+        good = [TripEvent(booking=self.booking, kind="ARRIVED", at=at, event_key=f"k{index}") for index in range(5)]
+        bad = TripEvent(booking_id=self.booking.pk + 1000, kind="ARRIVED", at=at, event_key="bad")
+        buffer = TripEventBuffer(flush_size=100, flush_interval=60, max_size=100, max_attempts=2)
+        bulk_create = TripEvent.objects.bulk_create
+
+        def insert(events, *args, **kwargs):
+            if any(event.event_key == "bad" for event in events):
+                raise IntegrityError("FOREIGN KEY constraint failed")
+            return bulk_create(events, *args, **kwargs)
+
+        with mock.patch.object(TripEvent.objects, "bulk_create", side_effect=insert):
+            buffer.add(good[:3] + [bad] + good[3:])
+            with self.assertLogs("rides.events_helper", "ERROR"):
+                self.assertEqual(buffer.flush(), 0)
+            self.assertEqual(len(buffer), 6)
+            with self.assertLogs("rides.events_helper", "ERROR") as logs:
+                self.assertEqual(buffer.flush(), 5)
+
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.stats["dropped"], 1)
+        self.assertIn("Dropped trip event bad", logs.output[-1])
+        self.assertEqual(TripEvent.objects.filter(event_key__startswith="k").count(), 5)
+
+    def test_unavailable_database_drops_nothing(self):
+        buffer = TripEventBuffer(flush_size=100, flush_interval=60, max_size=100, max_attempts=1)
+        buffer.add([TripEvent(booking=self.booking, kind="ARRIVED", at=timezone.now(), event_key="k1")])
+        with mock.patch.object(TripEvent.objects, "bulk_create", side_effect=OperationalError("server closed")):
+            with self.assertLogs("rides.events_helper", "ERROR"):
+                for _ in range(3):
+                    self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((len(buffer), buffer.stats["dropped"]), (1, 0))
+        self.assertEqual(buffer.flush(), 1)
+
+    def test_events_need_their_device_time(self):
+        event = self.position("k1", timezone.now(), 48.85, 2.35)
+        del event["at"]
+        with self.assertRaisesMessage(ValueError, "at is required"):
+            parse_trip_event(event)
+
+    def test_key_alone_is_unique_on_unpartitioned_tables(self):
+        if is_supported():
+            with connection.cursor() as cursor:
+                if is_partitioned(cursor, "rides_tripevent"):
+                    self.skipTest("partitioned: keys are unique together with at")
+        at = timezone.now()
+        TripEvent.objects.bulk_create([
+            TripEvent(booking=self.booking, kind="ARRIVED", at=at, event_key="k1"),
+            TripEvent(booking=self.booking, kind="ARRIVED", at=at + timedelta(seconds=1), event_key="k1"),
+        ], ignore_conflicts=True)
+        self.assertEqual(TripEvent.objects.filter(event_key="k1").count(), 1)
+
+    def test_positions_are_applied_in_one_update(self):
+        at = timezone.now()
+        Vehicle.objects.filter(pk=self.vehicle.pk).update(last_lat=1.0, last_lng=1.0, last_position_at=at)
+        older = [TripEvent(booking=self.booking, kind=TripEvent.POSITION, at=at - timedelta(minutes=1),
+                           meta={"lat": 2.0, "lng": 2.0})]
+        self.assertEqual(record_positions(older), 0)
+        self.vehicle.refresh_from_db()
+        self.assertEqual(self.vehicle.last_lat, 1.0)
+
+        newer = [TripEvent(booking=self.booking, kind=TripEvent.POSITION, at=at + timedelta(seconds=seconds),
+                           meta={"lat": float(seconds), "lng": float(seconds)}) for seconds in (10, 30, 20)]
+        with mock.patch("rides.events_helper.Vehicle.objects.bulk_update") as bulk_update:
+            self.assertEqual(record_positions(newer), 1)
+        bulk_update.assert_called_once()
+        self.assertEqual(bulk_update.call_args.args[0][0].last_lat, 30.0)
+
+
+class DispatchUpcomingBookingsTests(TestCase):
+
+    def setUp(self):
+        car_class = CarClass.objects.create(name="Eco", base_price=Decimal("10"), per_km_rate=Decimal("2"),
+                                            per_hour_rate=Decimal("30"))
+        partner = PartnerCompany.objects.create(name="Partner", country="FR")
+        customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.drivers, self.vehicles, self.bookings = [], [], []
+        for index in range(2):
+            driver = Driver.objects.create(email=f"driver{index}@example.com", phone="1", partner=partner)
+            self.drivers.append(driver)
+            self.vehicles.append(Vehicle.objects.create(
+                name="Car", car_class=car_class, partner=partner, driver=driver, make="Skoda", model="Octavia",
+                year=2022, plate_number=f"AB-12{index}-CD"))
+            self.bookings.append(Booking.objects.create(
+                reference=f"B{index}", customer=customer, booking_type="TRANSFER", car_class=car_class,
+                pickup_date=date.today(), pickup_time=time(10 + 4 * index, 0), pickup_address="Here",
+                status="CONFIRMED"))
+
+    def test_bookings_assigned_meanwhile_are_not_counted(self):
+        plan = [PlannedAssignment(booking.pk, self.drivers[0].pk, self.vehicles[0].pk, *booking.busy_interval, 1.0, 1.0)
+                for booking in self.bookings]
+        # Assigned by hand after the plan was made
+        Assignment.objects.create(booking=self.bookings[1], driver=self.drivers[1], vehicle=self.vehicles[1])
+
+        with mock.patch("rides.task.plan_assignments", return_value=plan):
+            report = dispatch_upcoming_bookings()
+
+        self.assertEqual(report["assigned"], 1)
+        self.assertEqual(Assignment.objects.get(booking=self.bookings[1]).driver, self.drivers[1])
+        self.assertEqual(Assignment.objects.get(booking=self.bookings[0]).driver, self.drivers[0])
+
+    def test_dry_run_reports_the_plan(self):
+        plan = [PlannedAssignment(self.bookings[0].pk, self.drivers[0].pk, self.vehicles[0].pk,
+                                  *self.bookings[0].busy_interval, 1.0, 1.0)]
+        with mock.patch("rides.task.plan_assignments", return_value=plan):
+            report = dispatch_upcoming_bookings(dry_run=True)
+
+        self.assertEqual(report["assigned"], 1)
+        self.assertFalse(Assignment.objects.exists())
+
+
+class TripEventQueryTests(TestCase):
+
+    def setUp(self):
+        car_class = CarClass.objects.create(name="Eco", base_price=Decimal("10"), per_km_rate=Decimal("2"),
+                                            per_hour_rate=Decimal("30"))
+        customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.bookings = [
+            Booking.objects.create(reference=f"B{index}", customer=customer, booking_type="TRANSFER",
+                                   car_class=car_class, pickup_date=date.today(), pickup_time=time(10, 0),
+                                   pickup_address="Here", status="CANCELLED")
+            for index in range(2)
+        ]
+        self.now = timezone.now()
+        rows = [
+            (0, "CANCELLED", 1, {"reason": "no_show", "source": "driver", "code": 7}),
+            (0, "CANCELLED", 2, {"reason": "no_show", "source": "rider", "code": 7}),
+            (1, "CANCELLED", 3, {"reason": "no_show", "source": "driver", "code": 8}),
+            (1, "ARRIVED", 4, {"source": "driver"}),
+            (1, "CANCELLED", 24 * 10, {"reason": "no_show", "source": "driver", "code": 7}),
+        ]
+        self.events = [
+            TripEvent.objects.create(booking=self.bookings[booking], kind=kind, meta=meta,
+                                     at=self.now - timedelta(hours=hours), event_key=f"k{index}")
+            for index, (booking, kind, hours, meta) in enumerate(rows)
+        ]
+
+    def ids(self, **kwargs):
+        return [event["id"] for event in query_trip_events(**kwargs)]
+
+    def test_filters(self):
+        self.assertEqual(self.ids(meta={"reason": "no_show"}), [event.pk for event in self.events[:3]])
+        self.assertEqual(self.ids(meta={"reason": "no_show", "source": "driver", "code": 7}), [self.events[0].pk])
+        self.assertEqual(self.ids(meta={"code": 8}), [self.events[2].pk])
+        self.assertEqual(self.ids(meta={"source": "driver"}, kind="arrived"), [self.events[3].pk])
+        self.assertEqual(self.ids(meta={"source": "driver"}, booking=self.bookings[0].pk), [self.events[0].pk])
+        self.assertEqual(self.ids(meta={"reason": "no_show"}, since=self.now - timedelta(days=11)),
+                         [event.pk for event in self.events if event.kind == "CANCELLED"])
+        self.assertEqual(self.ids(until=self.now - timedelta(hours=2, minutes=30)),
+                         [self.events[2].pk, self.events[3].pk])
+        self.assertEqual(self.ids(meta={"reason": "no_show"}, limit=2), [self.events[0].pk, self.events[1].pk])
+
+    def test_rejected_queries(self):
+        for kwargs in ({"meta": {"passenger": "x"}},
+                       {"meta": {"reason": ["no_show"]}},
+                       {"since": self.now - timedelta(days=400)},
+                       {"since": self.now - timedelta(days=40), "until": self.now - timedelta(days=1)},
+                       {"since": self.now, "until": self.now - timedelta(days=1)}):
+            with self.subTest(**kwargs), self.assertRaises(MetaQueryError):
+                query_trip_events(**kwargs)
+
+
+class AvailabilityIndexTests(SimpleTestCase):
+
+    def test_matches_brute_force(self):
+        rng = random.Random(7)
+        base = timezone.now()
+        index = AvailabilityIndex()
+        index.covers = (base - timedelta(days=1), base + timedelta(days=30))
+        rows, booking_id = [], 0
+        for driver_id in range(1, 21):
+            # A driver drives one vehicle and never has overlapping assignments
+            at = base + timedelta(minutes=rng.randint(0, 600))
+            for _ in range(rng.randint(0, 15)):
+                start = at + timedelta(minutes=rng.randint(0, 240))
+                end = start + timedelta(minutes=rng.randint(15, 480))
+                booking_id += 1
+                rows.append((start, end, booking_id, driver_id, 100 + driver_id))
+                at = end
+        for row in rows:
+            index._add(row)
+        for row in rng.sample(rows, len(rows) // 4):
+            index.remove(row[2])
+            rows.remove(row)
+        self.assertEqual(len(index), len(rows))
+
+        for _ in range(300):
+            start = base + timedelta(minutes=rng.randint(-60, 6000))
+            end = start + timedelta(minutes=rng.randint(1, 720))
+            overlapping = [row for row in rows if row[0] < end and row[1] > start]
+            self.assertEqual(index.busy(DRIVER, start, end), {row[3] for row in overlapping})
+            self.assertEqual(index.busy(VEHICLE, start, end), {row[4] for row in overlapping})
+            driver_id = rng.randint(1, 21)
+            self.assertEqual(sorted(index.conflicts(DRIVER, driver_id, start, end)),
+                             sorted(row[2] for row in overlapping if row[3] == driver_id))
+            self.assertEqual(index.free(DRIVER, range(1, 22), start, end),
+                             [driver for driver in range(1, 22) if driver not in {row[3] for row in overlapping}])
+
+
+class AssignBookingTests(TestCase):
+
+    def setUp(self):
+        availability_index.built_at = None
+        self.addCleanup(setattr, availability_index, "built_at", None)
+        self.car_class = CarClass.objects.create(name="Eco", base_price=Decimal("10"), per_km_rate=Decimal("2"),
+                                                 per_hour_rate=Decimal("30"))
+        partner = PartnerCompany.objects.create(name="Partner", country="FR")
+        self.customer = Customer.objects.create(email="rider@example.com", phone="1")
+        self.driver = Driver.objects.create(email="driver@example.com", phone="1", partner=partner)
+        self.other_driver = Driver.objects.create(email="other@example.com", phone="2", partner=partner)
+        self.vehicle = Vehicle.objects.create(name="Car", car_class=self.car_class, partner=partner,
+                                              driver=self.driver, make="Skoda", model="Octavia", year=2022,
+                                              plate_number="AB-123-CD")
+
+    def book(self, reference, pickup_date, pickup_time):
+        return Booking.objects.create(reference=reference, customer=self.customer, booking_type="HOURLY",
+                                      duration_hours=2, car_class=self.car_class, pickup_date=pickup_date,
+                                      pickup_time=pickup_time, pickup_address="Here", status="CONFIRMED")
+
+    def test_double_bookings_are_rejected(self):
+        tomorrow = date.today() + timedelta(days=1)
+        first = self.book("B1", tomorrow, time(10, 0))
+        overlapping = self.book("B2", tomorrow, time(11, 0))
+        later = self.book("B3", tomorrow, time(14, 0))
+
+        assign_booking(first, self.vehicle)
+        with self.assertRaises(AssignmentConflict):
+            assign_booking(overlapping, self.vehicle)
+        # The vehicle is busy whoever drives it
+        with self.assertRaises(AssignmentConflict):
+            assign_booking(overlapping, self.vehicle, driver=self.other_driver)
+        assign_booking(later, self.vehicle)
+        # Reassigning a booking does not conflict with itself
+        assign_booking(first, self.vehicle)
+
+        self.assertEqual(set(Assignment.objects.values_list("booking__reference", flat=True)), {"B1", "B3"})
+        self.assertEqual(availability_index.conflicts(DRIVER, self.driver.pk, *overlapping.busy_interval),
+                         [first.pk])
+
+    def test_bookings_beyond_the_horizon_are_checked_in_the_database(self):
+        far = date.today() + timedelta(days=90)
+        assign_booking(self.book("B1", far, time(10, 0)), self.vehicle)
+        with self.assertRaises(AssignmentConflict):
+            assign_booking(self.book("B2", far, time(11, 0)), self.vehicle)
+
+    def test_backfill_restores_missing_schedules(self):
+        booking = self.book("B1", date.today() + timedelta(days=1), time(10, 0))
+        assign_booking(booking, self.vehicle)
+        expected = booking_schedule(booking.pickup_date, booking.pickup_time, "HOURLY", duration_hours=2)
+        Booking.objects.update(pickup_at=None, expected_end_at=None)
+        Assignment.objects.update(starts_at=None, ends_at=None)
+
+        report = backfill_booking_schedule(batch_size=1)
+
+        self.assertEqual((report["updated"], report["assignments"]), (1, 1))
+        booking.refresh_from_db()
+        self.assertEqual((booking.pickup_at, booking.expected_end_at), expected)
+        self.assertEqual(Assignment.objects.values_list("starts_at", "ends_at").get(), expected)
+
+
+class TrackingHubTests(SimpleTestCase):
+
+    async def test_positions_are_coalesced_and_events_kept(self):
+        hub = TrackingHub()
+        hub._broker = LocalBroker(hub)
+        subscription = hub.subscribe(1, min_interval=0.01)
+        other = hub.subscribe(2, min_interval=0.01)
+        at = timezone.now()
+
+        hub.publish(1, position_message(1.0, 1.0, at))
+        hub.publish(1, event_message("ARRIVED", at))
+        hub.publish(1, position_message(2.0, 2.0, at))
+
+        messages = await subscription.next(1)
+        self.assertEqual([message["type"] for message in messages], ["event", "position"])
+        self.assertEqual(messages[1]["lat"], 2.0)
+        self.assertEqual(await other.next(0.01), [])
+
+        hub.unsubscribe(subscription)
+        hub.unsubscribe(other)
+        self.assertEqual(hub.subscribers(1), 0)
+
+
+    async def test_stream_gets_what_is_published_during_the_snapshot(self):
+        hub = TrackingHub()
+        hub._broker = LocalBroker(hub)
+
+        def snapshot(request, booking_id):
+            hub.publish(booking_id, event_message("COMPLETED", timezone.now()))
+            return []
+
+        with mock.patch("rides.views.tracking_hub", hub), mock.patch("rides.views.tracking_snapshot", snapshot):
+            response = await self.async_client.get(reverse("rides:trip_tracking", args=[3]))
+            chunks = [chunk async for chunk in response.streaming_content]
+
+        self.assertIn(b"event: event", chunks[-1])
+        self.assertIn(b"COMPLETED", chunks[-1])
+        self.assertEqual(hub.subscribers(3), 0)
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "LISTEN/NOTIFY needs PostgreSQL")
+class PostgresBrokerTests(TransactionTestCase):
+
+    @mock.patch("rides.tracking_helper.env_variable.TRACKING_HEARTBEAT", 0.1)
+    async def test_notifications_reach_the_listening_hub(self):
+        listening, publishing = TrackingHub(), TrackingHub()
+        listening._broker, publishing._broker = PostgresBroker(listening), PostgresBroker(publishing)
+        self.addCleanup(listening._broker.stop)
+        subscription = listening.subscribe(7, min_interval=0.01)
+
+        # The listener thread needs a moment to connect and LISTEN
+        for _ in range(50):
+            await sync_to_async(publishing.publish)(7, event_message("STARTED", None))
+            messages = await subscription.next(0.1)
+            if messages:
+                break
+        self.assertEqual(messages[0]["kind"], "STARTED")
+
+
+class VehicleGridIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(15)
+        self.index = VehicleGridIndex(cell_degrees=0.01)
+        self.candidates = [
+            VehicleCandidate(vehicle_id, vehicle_id, vehicle_id % 2, rng.randint(1, 4), 2, 5.0,
+                             48.85 + rng.uniform(-0.1, 0.1), 2.35 + rng.uniform(-0.1, 0.1))
+            for vehicle_id in range(1, 201)
+        ]
+        for candidate in self.candidates:
+            self.index.upsert(candidate)
+
+    def brute_force(self, lat, lng, k, keep=lambda candidate: True):
+        distances = sorted((haversine_km(lat, lng, candidate.lat, candidate.lng), candidate.vehicle_id)
+                           for candidate in self.candidates if keep(candidate))
+        return [vehicle_id for _, vehicle_id in distances[:k]]
+
+    def test_nearest_matches_brute_force(self):
+        for lat, lng in ((48.85, 2.35), (48.93, 2.27), (48.70, 2.35)):
+            found = self.index.nearest(lat, lng, k=5, max_distance_km=100)
+            self.assertEqual([candidate.vehicle_id for _, candidate in found], self.brute_force(lat, lng, 5))
+            self.assertEqual([distance for distance, _ in found], sorted(distance for distance, _ in found))
+
+        found = self.index.nearest(48.85, 2.35, k=3, car_class=1, min_persons=3, exclude={1}, max_distance_km=100)
+        self.assertEqual([candidate.vehicle_id for _, candidate in found], self.brute_force(
+            48.85, 2.35, 3, lambda candidate: candidate.car_class_id == 1 and candidate.person_capacity >= 3
+            and candidate.vehicle_id != 1))
+
+    def test_moves_and_removals(self):
+        self.assertTrue(self.index.update_position(7, 10.0, 10.0))
+        self.assertEqual(self.index.nearest(10.0, 10.001, k=1)[0][1].vehicle_id, 7)
+        self.assertFalse(self.index.update_position(999, 10.0, 10.0))
+
+        self.index.remove(7)
+        self.assertEqual(self.index.nearest(10.0, 10.001, k=1, max_distance_km=5), [])
+        self.assertEqual(len(self.index), 199)
+
+
+class HungarianTests(SimpleTestCase):
+
+    def assert_optimal(self, costs):
+        assignment = hungarian(costs)
+        self.assertEqual(len(set(assignment)), len(costs))
+        best = min(sum(costs[row][column] for row, column in enumerate(columns))
+                   for columns in itertools.permutations(range(len(costs[0])), len(costs)))
+        self.assertAlmostEqual(sum(costs[row][column] for row, column in enumerate(assignment)), best)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(16)
+        for rows, columns in ((1, 1), (3, 3), (4, 6), (6, 6), (5, 7)):
+            for _ in range(10):
+                self.assert_optimal([[rng.uniform(0, 100) for _ in range(columns)] for _ in range(rows)])
+
+    def test_avoids_infeasible_pairs(self):
+        costs = [[1, INFEASIBLE, 5], [INFEASIBLE, INFEASIBLE, 2]]
+        self.assertEqual(hungarian(costs), [0, 2])
+        self.assertEqual(hungarian([]), [])
+
+
+class RouteHelperTests(SimpleTestCase):
+
+    def test_polyline_round_trip(self):
+        # Example of the Google encoded polyline documentation
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        self.assertEqual(encode_polyline(points), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(decode_polyline(encode_polyline(points)), points)
+        self.assertEqual(decode_polyline(encode_polyline([(48.856614, 2.352222)], precision=6), precision=6),
+                         [(48.856614, 2.352222)])
+        self.assertEqual(encode_polyline([]), "")
+
+    def test_simplify_keeps_only_significant_points(self):
+        # Straight line east with a 50 m detour north in the middle (0.00045 degrees of latitude)
+        line = [(48.85, 2.35 + step * 0.0001) for step in range(21)]
+        self.assertEqual(simplify(line, 10), [0, 20])
+        line[10] = (48.85045, line[10][1])
+        self.assertEqual(simplify(line, 10), [0, 9, 10, 11, 20])
+        self.assertEqual(simplify(line, 100), [0, 20])
+        self.assertEqual(simplify(line[:2], 10), [0, 1])
+
+    def test_times_are_delta_encoded(self):
+        start = timezone.now().replace(microsecond=0)
+        times = [start, start + timedelta(seconds=5), start + timedelta(seconds=12)]
+        self.assertEqual(encode_times(times), [int(start.timestamp()), 5, 7])
+        self.assertEqual(encode_times([]), [])
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+from collections import deque
+
+from django.db import connection, connections
+from django.utils.module_loading import import_string
+
+from rides.models import TripEvent
+from sefservices import settings as env_variable
+
+logger = logging.getLogger(__name__)
+
+# Trip event kinds pushed to the customer, the last two end the stream
+TRACKED_KINDS = ("ARRIVED", "STARTED", "COMPLETED", "CANCELLED")
+FINAL_KINDS = ("COMPLETED", "CANCELLED")
+
+
+def position_message(lat, lng, at):
+    return {"type": "position", "lat": lat, "lng": lng, "at": at.isoformat() if at else None}
+
+
+def event_message(kind, at):
+    return {"type": "event", "kind": kind, "at": at.isoformat() if at else None}
+
+
+class Subscription:
+    """
+    One listener of a booking channel, living on the event loop that serves its stream.
+
+    Positions are coalesced (only the latest one is kept) and the listener is woken at
+    most once every ``min_interval`` seconds; trip events are never dropped.
+    """
+
+    def __init__(self, booking_id, min_interval):
+        self.booking_id = booking_id
+        self.min_interval = min_interval
+        self.loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._position = None
+        self._events = deque(maxlen=100)
+        self._sent_at = 0.0
+
+    def offer(self, message):
+        if message["type"] == "position":
+            self._position = message
+        else:
+            self._events.append(message)
+        self._ready.set()
+
+    async def next(self, timeout):
+        """ Messages to send, or an empty list when nothing happened for ``timeout`` seconds """
+
+        wait = self._sent_at + self.min_interval - self.loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        self._ready.clear()
+        messages = list(self._events)
+        self._events.clear()
+        if self._position is not None:
+            messages.append(self._position)
+            self._position = None
+        self._sent_at = self.loop.time()
+        return messages
+
+
+class TrackingHub:
+    """
+    In-process pub/sub of booking channels: one delivered update fans out to every
+    subscription of the booking, whichever thread or event loop it comes from.
+    """
+
+    def __init__(self):
+        self._channels = {}  # booking_id -> set of Subscription
+        self._lock = threading.Lock()
+        self._broker = None
+
+    @property
+    def broker(self):
+        if self._broker is None:
+            self._broker = import_string(env_variable.TRACKING_BROKER)(self)
+        return self._broker
+
+    def subscribe(self, booking_id, min_interval=None):
+        # The broker listens from the first subscriber of the process on
+        self.broker.listen()
+        subscription = Subscription(booking_id, min_interval or env_variable.TRACKING_MIN_INTERVAL)
+        with self._lock:
+            self._channels.setdefault(booking_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            channel = self._channels.get(subscription.booking_id)
+            if channel is not None:
+                channel.discard(subscription)
+                if not channel:
+                    del self._channels[subscription.booking_id]
+
+    def subscribers(self, booking_id):
+        with self._lock:
+            return len(self._channels.get(booking_id, ()))
+
+    def deliver(self, booking_id, message):
+        """ Hands a message to this worker's subscriptions of the booking """
+
+        with self._lock:
+            subscriptions = list(self._channels.get(booking_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+            except RuntimeError:
+                # Its event loop is gone
+                self.unsubscribe(subscription)
+
+    def publish(self, booking_id, message):
+        """ Sends a message to the subscribers of the booking on every worker reached by the broker """
+
+        self.broker.publish(booking_id, message)
+
+
+class LocalBroker:
+    """
+    Broker delivering straight to the hub of the current process.
+
+    Only enough when the tracking streams and the event feed are served by one single
+    process, e.g. runserver in development. A broker takes a ``(hub)`` constructor,
+    ``publish`` reaches every worker and ``listen`` makes the current one call
+    ``hub.deliver`` for what it receives.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def listen(self):
+        pass
+
+    def publish(self, booking_id, message):
+        self.hub.deliver(booking_id, message)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Fan-out between worker processes through PostgreSQL LISTEN/NOTIFY on TRACKING_CHANNEL.
+
+    ``publish`` sends a NOTIFY on the Django connection, so it reaches the listeners when the
+    surrounding transaction commits. Each process with subscribers runs a daemon thread
+    holding its own connection, which LISTENs and hands the notifications to the local hub,
+    reconnecting after a database error. Other backends deliver in-process only.
+    """
+
+    def __init__(self, hub):
+        super().__init__(hub)
+        self.channel = env_variable.TRACKING_CHANNEL
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def listen(self):
+        if self._thread is not None or connection.vendor != "postgresql":
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tracking-listener", daemon=True)
+                self._thread.start()
+
+    def publish(self, booking_id, message):
+        if connection.vendor != "postgresql":
+            return super().publish(booking_id, message)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.channel, json.dumps({"booking": booking_id, "message": message})])
+
+    def stop(self):
+        """ Ends the listener thread, within TRACKING_HEARTBEAT seconds """
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            listener = connections.create_connection("default")
+            try:
+                self._listen(listener)
+            except Exception:
+                logger.exception("Tracking listener lost its database connection, reconnecting")
+            finally:
+                listener.close()
+            self._stopped.wait(env_variable.TRACKING_LISTENER_RETRY)
+
+    def _listen(self, listener):
+        # Django opens connections in autocommit mode, so LISTEN takes effect at once
+        listener.ensure_connection()
+        raw = listener.connection
+        with listener.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        while not self._stopped.is_set():
+            if select.select([raw], [], [], env_variable.TRACKING_HEARTBEAT) == ([], [], []):
+                continue
+            raw.poll()
+            while raw.notifies:
+                notify = raw.notifies.pop(0)
+                try:
+                    payload = json.loads(notify.payload)
+                    self.hub.deliver(payload["booking"], payload["message"])
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Ignored a malformed tracking notification: %.200s", notify.payload)
+
+
+tracking_hub = TrackingHub()
+
+
+def publish_trip_events(events):
+    """ Publishes tracked kinds and, per booking, the latest position of a batch of TripEvents """
+
+    latest = {}
+    for event in sorted(events, key=lambda item: item.at):
+        if event.kind == TripEvent.POSITION:
+            latest[event.booking_id] = event
+        elif event.kind in TRACKED_KINDS:
+            tracking_hub.publish(event.booking_id, event_message(event.kind, event.at))
+    for booking_id, event in latest.items():
+        tracking_hub.publish(booking_id, position_message(float(event.meta["lat"]), float(event.meta["lng"]), event.at))
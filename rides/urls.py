@@ -0,0 +1,11 @@
+from django.urls import path
+
+from rides.views import TripEventIngestView, TripTrackingView
+
+app_name = 'rides'
+urlpatterns = [
+
+    path('events', TripEventIngestView.as_view(), name='trip_events'),
+    path('bookings/<int:booking_id>/track', TripTrackingView.as_view(), name='trip_tracking'),
+
+]
@@ -1,3 +1,150 @@
-from django.shortcuts import render
+import hmac
+import json
+import time
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rides.events_helper import BufferFull, parse_trip_event, trip_event_buffer
+from rides.models import Booking, TripEvent
+from rides.tracking_helper import (
+    FINAL_KINDS, TRACKED_KINDS, event_message, position_message, publish_trip_events, tracking_hub,
+)
+from sefservices import settings as env_variable
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class TripEventIngestView(View):
+    """
+    Driver app event feed: one JSON event per line (NDJSON), e.g.
+    {"key": "<unique id>", "booking": 42, "kind": "POSITION", "at": "2025-01-01T08:00:00Z", "meta": {"lat": 48.8, "lng": 2.3}}
+
+    Valid lines are buffered and written in bulk (202), invalid ones are reported by line
+    number. 503 with Retry-After means the worker is saturated: resend the same lines later.
+    """
+
+    def post(self, request, *args, **kwargs):
+        token = env_variable.TRIP_EVENTS_TOKEN
+        supplied = request.headers.get('Authorization', '')[len('Bearer '):]
+        if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+            return JsonResponse({'status': 'error'}, status=401)
+
+        lines = request.body.splitlines()
+        if len(lines) > env_variable.TRIP_EVENTS_MAX_LINES:
+            return JsonResponse({'status': 'error', 'message': f'At most {env_variable.TRIP_EVENTS_MAX_LINES} events'},
+                                status=413)
+
+        events, rejected = [], []
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                events.append((number, parse_trip_event(json.loads(line))))
+            except ValueError as error:
+                rejected.append({'line': number, 'error': str(error)})
+
+        known = set(Booking.objects.filter(pk__in={event.booking_id for _, event in events}).values_list('pk', flat=True))
+        for number, event in events:
+            if event.booking_id not in known:
+                rejected.append({'line': number, 'error': 'unknown booking'})
+        events = [event for _, event in events if event.booking_id in known]
+
+        if events:
+            try:
+                trip_event_buffer.add(events)
+            except BufferFull:
+                return JsonResponse({'status': 'error', 'message': 'Busy, retry later'}, status=503,
+                                    headers={'Retry-After': str(max(int(trip_event_buffer.flush_interval), 1))})
+            publish_trip_events(events)
+
+        return JsonResponse({
+            'status': 'success' if events or not rejected else 'error',
+            'accepted': len(events),
+            'rejected': sorted(rejected, key=lambda item: item['line']),
+        }, status=202 if events or not rejected else 400)
+
+
+def sse(message):
+    return f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+
+
+def tracking_snapshot(request, booking_id):
+    """ Current state of a booking of the signed-in customer: last known position and last tracked event """
+
+    if not request.user.is_authenticated:
+        raise Http404
+    booking = Booking.objects.select_related('assignment__vehicle').filter(
+        pk=booking_id, customer=request.user,
+    ).first()
+    if booking is None:
+        raise Http404
+
+    messages = []
+    event = booking.events.filter(kind__in=TRACKED_KINDS).order_by('-at').values_list('kind', 'at').first()
+    if event is not None:
+        messages.append(event_message(*event))
+    vehicle = booking.assignment.vehicle if hasattr(booking, 'assignment') else None
+    if vehicle is not None and vehicle.last_lat is not None:
+        messages.append(position_message(vehicle.last_lat, vehicle.last_lng, vehicle.last_position_at))
+    return messages
+
+
+class TripTrackingView(View):
+    """
+    Live position and trip events of a booking as Server-Sent Events, instead of polling.
+
+    Streams under ASGI (the uvicorn workers of supervisord.conf), updates from the event
+    feed of any worker reaching it through TRACKING_BROKER. Under WSGI only the current
+    state is sent and the EventSource reconnects every TRACKING_RETRY_MS, like polling.
+
+    Django 4.2 does not notice a client leaving during a streamed response: the stream of a
+    closed tab lives on until TRACKING_STREAM_MAX_SECONDS, kept short for that reason, after
+    which a browser still watching reconnects by itself.
+    """
+
+    async def get(self, request, booking_id, *args, **kwargs):
+        streaming = isinstance(request, ASGIRequest)
+        # Subscribed before reading the snapshot, so nothing published in between is missed
+        subscription = tracking_hub.subscribe(booking_id) if streaming else None
+        try:
+            snapshot = await sync_to_async(tracking_snapshot)(request, booking_id)
+        except Exception:
+            if subscription is not None:
+                tracking_hub.unsubscribe(subscription)
+            raise
+        head = [f"retry: {env_variable.TRACKING_RETRY_MS}\n\n"] + [sse(message) for message in snapshot]
+        finished = any(message.get('kind') in FINAL_KINDS for message in snapshot)
+
+        if finished or not streaming:
+            if subscription is not None:
+                tracking_hub.unsubscribe(subscription)
+            return self.event_stream(head)
+
+        async def stream():
+            try:
+                for chunk in head:
+                    yield chunk
+                deadline = time.monotonic() + env_variable.TRACKING_STREAM_MAX_SECONDS
+                while time.monotonic() < deadline:
+                    messages = await subscription.next(env_variable.TRACKING_HEARTBEAT)
+                    if not messages:
+                        yield ": keep-alive\n\n"
+                    for message in messages:
+                        yield sse(message)
+                        if message.get('kind') in FINAL_KINDS:
+                            return
+            finally:
+                tracking_hub.unsubscribe(subscription)
+
+        return self.event_stream(stream())
+
+    @staticmethod
+    def event_stream(content):
+        response = StreamingHttpResponse(content, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
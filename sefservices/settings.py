@@ -49,11 +49,90 @@ Q_CLUSTER = {
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 SESSION_COOKIE_AGE = 210 * 60  #
 
+# Dispatch Settings
+DISPATCH_GRID_CELL_DEGREES = 0.02  # ~2km cells of the vehicle index
+DISPATCH_MAX_DISTANCE_KM = 50  # vehicles further away from a pickup are never proposed
+DISPATCH_INDEX_TTL = 30  # seconds before a worker rebuilds its vehicle index from the database
+DISPATCH_WINDOW_MINUTES = 120  # pickups covered by one batch dispatch run
+DISPATCH_CANDIDATES_PER_BOOKING = 8  # nearest vehicles priced per booking and fitting class
+DISPATCH_UPGRADE_PENALTY_KM = 5  # cost of serving a booking with a pricier class, in deadhead km
+DISPATCH_RATING_WEIGHT_KM = 4  # deadhead km added per rating point below 5
+TRIP_AVERAGE_SPEED_KMH = 40  # used to estimate when a transfer ends
+TRIP_DEFAULT_MINUTES = 60  # expected length of a transfer without distance
+TRIP_TURNAROUND_MINUTES = 15  # buffer after a trip before the driver/vehicle is free again
+AVAILABILITY_INDEX_TTL = 60  # seconds before a worker rebuilds its availability index from the database
+AVAILABILITY_HORIZON_DAYS = 30  # assignments further ahead are checked against the database only
+TRIP_EVENTS_TOKEN = env_config('TRIP_EVENTS_TOKEN', default='')  # bearer token of the driver app event feed
+TRIP_EVENTS_MAX_LINES = 1000  # events accepted in one NDJSON request
+TRIP_EVENTS_FLUSH_SIZE = 500  # buffered events written in one bulk insert
+TRIP_EVENTS_FLUSH_INTERVAL = 1.0  # seconds an event may wait in a worker's buffer
+TRIP_EVENTS_BUFFER_MAX = 20000  # pending events per worker before answering 503
+TRIP_EVENTS_MAX_ATTEMPTS = 3  # failed writes of an event before its batch is bisected and bad rows dropped
+TRIP_EVENTS_MAX_AGE_HOURS = 72  # older events are rejected, they would land in an archived partition
+TRIP_EVENTS_MAX_SKEW_SECONDS = 300  # tolerated device clock advance
+ROUTE_SIMPLIFY_TOLERANCE_M = 10  # largest gap in metres between the raw trace and the stored route
+ROUTE_COMPACTION_DELAY_MINUTES = 30  # wait after a trip closes for late pings before compacting it
+ROUTE_COMPACTION_BATCH_SIZE = 100  # bookings compacted per transaction
+TRIP_EVENT_META_KEYS = ('reason', 'source', 'code', 'cancelled_by', 'driver_id', 'vehicle_id')  # queryable meta keys
+TRIP_EVENT_META_INDEXED_KEYS = ('reason', 'source')  # keys with their own index (see TripEvent.Meta.indexes)
+TRIP_EVENT_QUERY_DAYS = 7  # default time range of a metadata query, keeps it on recent partitions
+TRIP_EVENT_QUERY_MAX_DAYS = 31  # widest time range a metadata query may ask for
+TRIP_EVENT_QUERY_LIMIT = 500
+TRACKING_BROKER = env_config('TRACKING_BROKER', default='rides.tracking_helper.PostgresBroker')  # fan-out between workers
+TRACKING_CHANNEL = 'trip_tracking'  # PostgreSQL NOTIFY channel of the tracking broker
+TRACKING_LISTENER_RETRY = 5  # seconds before the tracking listener reconnects after a database error
+TRACKING_MIN_INTERVAL = 1.0  # seconds between two pushes to one live tracking subscriber
+TRACKING_HEARTBEAT = 15  # seconds of silence before a keep-alive comment
+TRACKING_STREAM_MAX_SECONDS = 120  # a stream is closed then, the browser reconnects; bounds abandoned streams
+TRACKING_RETRY_MS = 5000  # reconnect delay announced to EventSource clients
+BOOKINGS_PAGE_SIZE = 10  # bookings per "load more" page of the customer area
+BOOKING_BACKFILL_BATCH_SIZE = 1000  # bookings re-synced per transaction by `manage.py backfillpickupat`
+
+# Monthly range partitions (PostgreSQL), see coreservice.partition_helper
+PARTITIONED_TABLES = {
+    'rides_tripevent': {'column': 'at', 'retention_months': 6},
+    'payments_payment': {'column': 'created_at', 'retention_months': 24},
+}
+PARTITION_MONTHS_AHEAD = 3  # partitions created in advance by `manage.py managepartitions`
+PARTITION_ARCHIVE_SCHEMA = 'archive'  # expired partitions are detached and moved there
+
+# Exports (coreservice.export_helper), streamed straight to the media storage
+EXPORT_LOCATION = 'Exportations'  # storage prefix of generated files
+EXPORT_CHUNK_SIZE = 2000  # rows fetched per round trip by .iterator()
+EXPORT_PART_SIZE = 8 * 1024 * 1024  # bytes per multipart upload part (S3 requires at least 5 MiB)
+EXPORT_WIDTH_SAMPLE_ROWS = 200  # rows measured to size the XLSX columns
+EXPORT_MAX_COLUMN_WIDTH = 60  # characters
+
+# Outbound HTTP client (coreservice.http_helper) shared by third-party integrations
+OUTBOUND_HTTP = {
+    'timeout': (3.05, 10),  # (connect, read) seconds
+    'retries': 2,  # for idempotent calls only
+    'backoff': 0.2,  # seconds, doubled on every retry and jittered
+    'backoff_max': 2.0,
+    'pool_maxsize': 10,  # keep-alive connections per host
+    'breaker_threshold': 5,  # consecutive failures before the circuit opens
+    'breaker_cooldown': 30,  # seconds
+}
+
+# Offline GeoIP database, built with `python manage.py importgeoip <ranges.csv>`
+GEOIP_DATABASE_PATH = env_config('GEOIP_DATABASE_PATH', default=str(BASE_DIR / 'geoip' / 'geoip.bin'))
+
 # Captcha Settings
 CAPTCHA_SITE_KEY = env_config('CAPTCHA_SITE_KEY')
 CAPTCHA_SECRET_KEY = env_config('CAPTCHA_SECRET_KEY')
 
 GOOGLE_MAP_API_KEY = env_config('GOOGLE_MAP_API_KEY')
+PLACES_API_TIMEOUT = (3.05, 5)  # (connect, read) seconds
+PLACES_CACHE_TTL = env_config('PLACES_CACHE_TTL', default=6 * 60 * 60, cast=int)  # seconds
+PLACES_CACHE_MAX_ENTRIES = env_config('PLACES_CACHE_MAX_ENTRIES', default=20000, cast=int)
+PLACES_AUTOCOMPLETE_PAGE_SIZE = 5  # most suggestions the Places API returns for one input
+PLACE_DETAILS_PROVIDER = 'coreservice.places_helper.GooglePlaceDetailsProvider'
+PLACE_HOT_CACHE_SIZE = 1000  # most used places kept in memory by each worker
+# Coalesce identical lookups across gunicorn workers too (needs a cache backend shared by the workers)
+PLACES_SHARED_SINGLE_FLIGHT = env_config('PLACES_SHARED_SINGLE_FLIGHT', default=False, cast=bool)
+
+# Pricing Settings
+PRICING_CACHE_TTL = env_config('PRICING_CACHE_TTL', default=300, cast=int)  # seconds
 
 # MinIO Configuration
 AWS_ACCESS_KEY_ID = env_config('AWS_ACCESS_KEY_ID')
@@ -98,6 +177,14 @@ SMS_URL = env_config('SMS_URL')
 STRIPE_API_KEY = env_config('STRIPE_API_KEY')
 STRIPE_PUBLIC_KEY = env_config('STRIPE_PUBLIC_KEY')
 STRIPE_ENDPOINT_SECRET = env_config('STRIPE_ENDPOINT_SECRET')
+STRIPE_REQUEST_TIMEOUT = 8  # seconds, timeout of the Stripe client for every request
+STRIPE_MAX_NETWORK_RETRIES = 2  # retries of a failed Stripe request, POSTs made idempotent by the library
+STRIPE_EVENTS_BATCH_SIZE = 100  # webhook events handled per transaction by the django-q task
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+STRIPE_EVENT_RETRY_DELAY = 60  # seconds before retrying a failed event, doubled on every attempt
+STRIPE_RECONCILE_CHUNK_SIZE = 200  # customers reconciled per transaction
+STRIPE_RECONCILE_MAX_SECONDS = 40  # per scheduled run, under Q_CLUSTER['timeout']; the next run resumes
+STRIPE_RECONCILE_INTERVAL_HOURS = 24  # pause between two complete passes
 
 # Google Login
 SOCIAL_AUTH_GOOGLE_OAUTH_KEY = '528330824749-6988ohe7a44is581kr19sgkcebnps269.apps.googleusercontent.com'
@@ -150,6 +237,7 @@ INSTALLED_APPS = [
     'rides',
     'payments',
     'social_django',
+    'django_q',
 ]
 
 MIDDLEWARE = [
@@ -21,6 +21,8 @@ from django.urls import path, include
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('oauth/', include('social_django.urls', namespace='social')),
+    path('payments/', include('payments.urls')),
+    path('rides/', include('rides.urls')),
 
 ]
 urlpatterns += i18n_patterns(